@@ -0,0 +1,94 @@
+#!/usr/bin/python3
+
+# Copyright © 2018 Simon McVittie
+# SPDX-License-Identifier: GPL-2.0+
+# (see vectis/__init__.py)
+
+import os
+import sys
+import unittest
+from tempfile import TemporaryDirectory
+
+import vectis.agent
+from vectis.agent import (
+        AgentError,
+        AgentTimeout,
+        GuestAgent,
+        )
+
+WRAPPER = os.path.join(
+    os.path.dirname(vectis.agent.__file__), 'vectis-command-wrapper')
+
+
+def wrapper_argv(before=''):
+    return ['sh', '-c', '{} exec "$@"'.format(before), 'sh',
+            sys.executable, WRAPPER, '--agent']
+
+
+class AgentTestCase(unittest.TestCase):
+    def test_requests(self):
+        agent = GuestAgent(wrapper_argv())
+
+        try:
+            agent.ping()
+
+            with TemporaryDirectory(prefix='vectis-test-') as tmp:
+                path = os.path.join(tmp, 'file')
+                self.assertFalse(agent.exists(path))
+                agent.write(path, b'hello', mode=0o600)
+                self.assertTrue(agent.exists(path))
+
+                with open(path, 'rb') as reader:
+                    self.assertEqual(reader.read(), b'hello')
+
+            self.assertEqual(
+                agent.run(['echo', 'hello'], capture=True),
+                (0, b'hello\n'))
+            self.assertEqual(agent.run(['false'])[0], 1)
+        finally:
+            agent.close()
+
+    def test_noise(self):
+        # Output that is not a message is ignored
+        agent = GuestAgent(wrapper_argv(
+            'echo "warning: not JSON"; echo "[1]"; echo "{}";'))
+
+        try:
+            agent.ping()
+            self.assertFalse(agent.closed)
+        finally:
+            agent.close()
+
+    def test_exit(self):
+        # Requests fail instead of waiting for an agent that has gone
+        agent = GuestAgent(['sh', '-c', 'read x; echo "not JSON"'])
+
+        try:
+            with self.assertRaises(AgentError):
+                agent.request('ping')
+
+            self.assertTrue(agent.closed)
+
+            with self.assertRaises(AgentError):
+                agent.request('ping')
+        finally:
+            agent.close()
+
+    def test_timeout(self):
+        agent = GuestAgent(['sh', '-c', 'read x; sleep 1; cat >/dev/null'])
+
+        try:
+            with self.assertRaises(AgentTimeout):
+                agent.request('ping', timeout=0.1)
+        finally:
+            agent.close()
+
+    def tearDown(self):
+        pass
+
+
+if __name__ == '__main__':
+    import tap
+    runner = tap.TAPTestRunner()
+    runner.set_stream(True)
+    unittest.main(verbosity=2, testRunner=runner)
@@ -0,0 +1,57 @@
+#!/usr/bin/python3
+
+# Copyright © 2018 Simon McVittie
+# SPDX-License-Identifier: GPL-2.0+
+# (see vectis/__init__.py)
+
+import hashlib
+import os
+import unittest
+from tempfile import TemporaryDirectory
+
+from vectis.apt import (
+        fetch_release,
+        get_release_digest,
+        )
+
+
+class FetchReleaseTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = TemporaryDirectory(prefix='vectis-test-')
+        self.addCleanup(self.tmp.cleanup)
+        self.uri = 'file://' + self.tmp.name
+        os.makedirs(os.path.join(self.tmp.name, 'dists', 'sid'))
+
+    def write(self, suite, name, data):
+        with open(
+                os.path.join(self.tmp.name, 'dists', suite, name),
+                'wb') as writer:
+            writer.write(data)
+
+    def test_fetch(self):
+        self.write('sid', 'Release', b'Date: yesterday\n')
+        self.assertEqual(
+            fetch_release(self.uri, 'sid'), b'Date: yesterday\n')
+        self.assertEqual(
+            get_release_digest(self.uri + '/', 'sid'),
+            hashlib.sha256(b'Date: yesterday\n').hexdigest())
+
+        # Each Release file is only downloaded once per run
+        self.write('sid', 'InRelease', b'Date: today\n')
+        self.assertEqual(
+            fetch_release(self.uri, 'sid'), b'Date: yesterday\n')
+
+    def test_missing(self):
+        self.assertIsNone(fetch_release(self.uri, 'stable'))
+        self.assertIsNone(fetch_release(None, 'stable'))
+        self.assertIsNone(get_release_digest(None, 'stable'))
+
+    def tearDown(self):
+        pass
+
+
+if __name__ == '__main__':
+    import tap
+    runner = tap.TAPTestRunner()
+    runner.set_stream(True)
+    unittest.main(verbosity=2, testRunner=runner)
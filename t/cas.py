@@ -0,0 +1,107 @@
+#!/usr/bin/python3
+
+# Copyright © 2018 Simon McVittie
+# SPDX-License-Identifier: GPL-2.0+
+# (see vectis/__init__.py)
+
+import os
+import shutil
+import subprocess
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import TemporaryDirectory
+
+from vectis.cas import (
+        CacheDisk,
+        )
+from vectis.util import (
+        cached_sha256_file,
+        sha256_file,
+        )
+
+
+class LocalWorker:
+    """
+    Just enough of a worker for CacheDisk, running commands on the host.
+    """
+
+    def call(self, argv, **kwargs):
+        return subprocess.call(argv, **kwargs)
+
+    def check_call(self, argv, **kwargs):
+        subprocess.check_call(argv, **kwargs)
+
+    def check_output(self, argv, **kwargs):
+        return subprocess.check_output(argv, **kwargs)
+
+    def copy_to_guest(self, host_path, guest_path, *, cache=False):
+        shutil.copyfile(host_path, guest_path)
+
+    def guest_path_exists(self, guest_path):
+        return os.path.exists(guest_path)
+
+
+class CacheDiskTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = TemporaryDirectory(prefix='vectis-test-')
+        self.addCleanup(self.tmp.cleanup)
+        self.file = os.path.join(self.tmp.name, 'minbase.tar.gz')
+
+        with open(self.file, 'wb') as writer:
+            writer.write(b'x' * 4096)
+
+        image = os.path.join(self.tmp.name, 'cas', 'cas.img')
+        os.makedirs(os.path.dirname(image))
+
+        with open(image, 'wb') as writer:
+            writer.truncate(1024 * 1024)
+
+        self.disk = CacheDisk(image, size=1024 * 1024)
+        self.disk.mount_point = os.path.join(self.tmp.name, 'mnt')
+
+        for d in ('sha256', 'tmp'):
+            os.makedirs(os.path.join(self.disk.mount_point, d))
+
+    def test_concurrent(self):
+        worker = LocalWorker()
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            futures = [
+                executor.submit(
+                    self.disk.make_file_available, worker, self.file)
+                for i in range(16)]
+
+        paths = set(future.result() for future in futures)
+        self.assertEqual(len(paths), 1)
+        path = paths.pop()
+
+        self.assertEqual(sha256_file(path), sha256_file(self.file))
+        self.assertEqual(
+            os.listdir(os.path.dirname(path)), ['minbase.tar.gz'])
+        self.assertEqual(
+            os.listdir(os.path.join(self.disk.mount_point, 'tmp')), [])
+        self.assertEqual(
+            self.disk.make_file_available(worker, self.file), path)
+
+    def test_cached_sha256_file(self):
+        digests = os.path.join(self.tmp.name, 'digests')
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            futures = [
+                executor.submit(cached_sha256_file, self.file, digests)
+                for i in range(16)]
+
+        for future in futures:
+            self.assertEqual(future.result(), sha256_file(self.file))
+
+        self.assertEqual(len(os.listdir(digests)), 1)
+
+    def tearDown(self):
+        pass
+
+
+if __name__ == '__main__':
+    import tap
+    runner = tap.TAPTestRunner()
+    runner.set_stream(True)
+    unittest.main(verbosity=2, testRunner=runner)
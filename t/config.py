@@ -84,6 +84,14 @@ class DefaultsTestCase(unittest.TestCase):
             c.archive
         self.assertIs(c.build_indep_together, False)
         self.assertIs(c.sbuild_source_together, False)
+        self.assertIs(c.sbuild_host_source, False)
+        self.assertIs(c.source_cache, True)
+        self.assertEqual(c.sbuild_arch_jobs, 1)
+        self.assertEqual(c.sbuild_jobs, 1)
+        self.assertEqual(c.test_jobs, 1)
+        self.assertIsNone(c.autopkgtest_jobs)
+        self.assertGreaterEqual(c.host_jobs, 1)
+        self.assertIsNone(c.memory_budget)
         self.assertEqual(c.output_parent, '..')
         self.assertEqual(c.qemu_image_size, '10G')
         self.assertIsNone(c.sbuild_buildables)
@@ -156,6 +164,74 @@ class DefaultsTestCase(unittest.TestCase):
         self.assertEqual(c.storage,
             '{}/vectis'.format(XDG_CACHE_HOME))
 
+    def test_worker_pool(self):
+        c = self.__config
+
+        self.assertEqual(c.worker_pool_size, 1)
+
+        if os.getenv('XDG_RUNTIME_DIR'):
+            self.assertEqual(c.worker_pool,
+                '{}/vectis/worker-pool'.format(
+                    os.getenv('XDG_RUNTIME_DIR')))
+        else:
+            self.assertIsNone(c.worker_pool)
+
+        self.assertEqual(c.worker_agent, True)
+        self.assertEqual(c.worker_snapshots, False)
+        self.assertEqual(c.get_worker_options(), dict(
+            agent=True,
+            cache_image='{}/cache/vectis-cas.img'.format(c.storage),
+            cache_size=0,
+            pool=c.worker_pool,
+            snapshots=False,
+        ))
+
+    def test_mirror_cache(self):
+        c = self.__config
+
+        self.assertIsNone(c.mirror_cache)
+        self.assertEqual(c.mirror_cache_listen, ('localhost', 3142))
+
+        c.mirror_cache = 'http://10.0.2.2:3142/'
+        ubuntu = c.get_vendor('ubuntu')
+        xenial = c.get_suite(ubuntu, 'xenial')
+        steamrt = c.get_vendor('steamrt')
+        scout = c.get_suite(steamrt, 'scout')
+
+        self.assertEqual(
+            c.get_mirrors().lookup_suite(xenial),
+            'http://10.0.2.2:3142/mirror/ubuntu')
+
+        mirrors = vectis.config.Mirrors({}, cache=c.mirror_cache)
+        self.assertEqual(
+            mirrors.lookup_suite(xenial),
+            'http://10.0.2.2:3142/archive.ubuntu.com/ubuntu')
+        self.assertEqual(
+            mirrors.lookup_suite(scout),
+            'http://10.0.2.2:3142/repo.steamstatic.com/steamrt')
+        self.assertIsNone(vectis.config.Mirrors({}).lookup_suite(scout))
+
+        # The host downloads from the mirror or canonical URI instead
+        self.assertEqual(
+            c.get_mirrors().lookup_suite_from_host(xenial),
+            'http://mirror/ubuntu')
+        self.assertEqual(
+            mirrors.lookup_suite_from_host(xenial),
+            'http://archive.ubuntu.com/ubuntu')
+
+    def test_qemu_image_profile(self):
+        c = self.__config
+
+        self.assertEqual(c.qemu_image_profile, 'qcow2-sparse')
+
+        c.qemu_image_profile = 'qcow2-zstd'
+        self.assertEqual(c.qemu_image_profile, 'qcow2-zstd')
+
+        c.qemu_image_profile = 'vmdk'
+
+        with self.assertRaises(vectis.config.ConfigError):
+            c.qemu_image_profile
+
     def test_substitutions(self):
         c = self.__config
 
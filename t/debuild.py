@@ -0,0 +1,73 @@
+#!/usr/bin/python3
+
+# Copyright © 2018 Simon McVittie
+# SPDX-License-Identifier: GPL-2.0+
+# (see vectis/__init__.py)
+
+import os
+import subprocess
+import unittest
+from tempfile import TemporaryDirectory
+
+from vectis.debuild import (
+        find_orig_paths,
+        get_tar_ignore,
+        )
+from vectis.util import (
+        tar_excluded,
+        )
+
+
+class TarIgnoreTestCase(unittest.TestCase):
+    def test_get_tar_ignore(self):
+        self.assertEqual(get_tar_ignore([]), [])
+        self.assertEqual(get_tar_ignore(['-i', '-Ifoo']), ['foo'])
+        self.assertEqual(
+            get_tar_ignore(['--tar-ignore=foo', '--tar-ignore=*.bar']),
+            ['foo', '*.bar'])
+        self.assertIn('.gitignore', get_tar_ignore(['-I']))
+        self.assertIn('*.so', get_tar_ignore(['--tar-ignore']))
+
+    def test_excluded(self):
+        patterns = get_tar_ignore(['-I'])
+
+        self.assertTrue(tar_excluded('./.git/config', patterns))
+        self.assertTrue(tar_excluded('./src/.gitignore', patterns))
+        self.assertTrue(tar_excluded('./lib/libfoo.so', patterns))
+        self.assertFalse(tar_excluded('./debian/control', patterns))
+        self.assertFalse(tar_excluded(
+            './src/.gitignore', patterns, keep={'src/.gitignore'}))
+
+    def test_find_orig_paths(self):
+        with TemporaryDirectory(prefix='vectis-test-') as tmp:
+            for top, names in (
+                    ('hello-1.0', ['.gitignore', 'lib/prebuilt.so']),
+                    ('extra', ['README'])):
+                for name in names:
+                    path = os.path.join(tmp, top, name)
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    open(path, 'w').close()
+
+            origs = [
+                os.path.join(tmp, 'hello_1.0.orig.tar.gz'),
+                os.path.join(tmp, 'hello_1.0.orig-extra.tar.xz'),
+            ]
+
+            for orig, top in zip(origs, ('hello-1.0', 'extra')):
+                subprocess.check_call(
+                    ['tar', '-caf', orig, top], cwd=tmp)
+
+            self.assertEqual(
+                find_orig_paths(origs),
+                {'.gitignore', 'lib', 'lib/prebuilt.so', 'extra',
+                 'extra/README'})
+
+    def tearDown(self):
+        pass
+
+
+if __name__ == '__main__':
+    import tap
+    runner = tap.TAPTestRunner()
+    runner.set_stream(True)
+    unittest.main(verbosity=2, testRunner=runner)
@@ -0,0 +1,166 @@
+#!/usr/bin/python3
+
+# Copyright © 2018 Simon McVittie
+# SPDX-License-Identifier: GPL-2.0+
+# (see vectis/__init__.py)
+
+import functools
+import http.server
+import os
+import threading
+import time
+import unittest
+import urllib.error
+import urllib.request
+from tempfile import TemporaryDirectory
+
+from vectis.error import (
+        ArgumentError,
+        )
+from vectis.mirrorcache import (
+        MirrorCache,
+        MirrorCacheServer,
+        check_listen_address,
+        )
+
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class MirrorCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        tmp = TemporaryDirectory(prefix='vectis-test-')
+        self.addCleanup(tmp.cleanup)
+        self.upstream = os.path.join(tmp.name, 'upstream')
+        os.makedirs(self.upstream)
+        self.cache = MirrorCache(os.path.join(tmp.name, 'cache'))
+
+        self.server = http.server.ThreadingHTTPServer(
+            ('127.0.0.1', 0),
+            functools.partial(QuietHandler, directory=self.upstream))
+        self.addCleanup(self.server.server_close)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(self.server.shutdown)
+
+        self.host = '127.0.0.1:{}'.format(self.server.server_address[1])
+
+    def publish(self, path, data, *, age=0):
+        path = os.path.join(self.upstream, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        with open(path, 'wb') as writer:
+            writer.write(data)
+
+        # Whole seconds, because that's all that Last-Modified has
+        mtime = int(time.time()) - age
+        os.utime(path, (mtime, mtime))
+
+    def fetch(self, path):
+        url = self.cache.get_url('/{}/{}'.format(self.host, path))
+        result = self.cache.fetch(url)
+
+        if result is None:
+            return None
+
+        with open(result, 'rb') as reader:
+            return reader.read()
+
+    def test_get_url(self):
+        self.assertEqual(
+            self.cache.get_url('/deb.debian.org/debian/pool/x.deb'),
+            'http://deb.debian.org/debian/pool/x.deb')
+        self.assertIsNone(self.cache.get_url('/deb.debian.org'))
+        self.assertIsNone(self.cache.get_url('/deb.debian.org/../etc'))
+        self.assertIsNone(
+            self.cache.get_url('/deb.debian.org/dists/sid/Release'
+                               '.vectis-meta'))
+
+    def test_pool(self):
+        self.publish('debian/pool/main/h/hello.deb', b'hello')
+        self.assertEqual(self.fetch('debian/pool/main/h/hello.deb'), b'hello')
+
+        # Files in pool/ never change, so once cached they are not
+        # downloaded again
+        self.publish('debian/pool/main/h/hello.deb', b'changed')
+        self.assertEqual(self.fetch('debian/pool/main/h/hello.deb'), b'hello')
+
+        self.assertIsNone(self.fetch('debian/pool/main/n/nope.deb'))
+
+    def test_revalidate(self):
+        self.publish('debian/dists/sid/InRelease', b'old', age=60)
+        self.assertEqual(self.fetch('debian/dists/sid/InRelease'), b'old')
+
+        # Index files are revalidated, and downloaded again if they
+        # changed
+        self.publish('debian/dists/sid/InRelease', b'new')
+        self.assertEqual(self.fetch('debian/dists/sid/InRelease'), b'new')
+        self.assertEqual(self.fetch('debian/dists/sid/InRelease'), b'new')
+
+        # The cached copy is used if the upstream server is unavailable
+        self.server.shutdown()
+        self.server.server_close()
+        self.assertEqual(self.fetch('debian/dists/sid/InRelease'), b'new')
+
+        with self.assertRaises(OSError):
+            self.fetch('debian/dists/sid/Release')
+
+    def test_too_large(self):
+        self.cache.max_file_size = 4
+        self.publish('debian/pool/main/b/big.deb', b'too big')
+
+        with self.assertRaises(ValueError):
+            self.fetch('debian/pool/main/b/big.deb')
+
+        self.assertEqual(list(self.cache.list()), [])
+        self.assertEqual(list(self.cache.list_partial()), [])
+
+    def test_server(self):
+        server = MirrorCacheServer(('127.0.0.1', 0), self.cache)
+        self.addCleanup(server.server_close)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(server.shutdown)
+
+        def get(path):
+            with urllib.request.urlopen('http://127.0.0.1:{}/{}/{}'.format(
+                    server.server_address[1], self.host, path)) as response:
+                return response.read()
+
+        self.publish('debian/pool/main/h/hello.deb', b'hello' * 100000)
+
+        # A cache miss, passed on as it is downloaded, then a cache hit
+        for i in range(2):
+            self.assertEqual(
+                get('debian/pool/main/h/hello.deb'), b'hello' * 100000)
+
+        with self.assertRaises(urllib.error.HTTPError) as raised:
+            get('debian/pool/main/n/nope.deb')
+
+        self.assertEqual(raised.exception.code, 404)
+
+    def test_listen_address(self):
+        for host in ('localhost', '127.0.0.1', '127.0.1.1', '::1',
+                     '10.0.2.2'):
+            check_listen_address(host)
+
+        for host in ('', '0.0.0.0', '::', '192.168.122.1', 'example.com'):
+            with self.assertRaises(ArgumentError):
+                check_listen_address(host)
+
+        with self.assertRaises(ArgumentError):
+            MirrorCacheServer(('0.0.0.0', 0), self.cache)
+
+    def tearDown(self):
+        pass
+
+
+if __name__ == '__main__':
+    import tap
+    runner = tap.TAPTestRunner()
+    runner.set_stream(True)
+    unittest.main(verbosity=2, testRunner=runner)
@@ -0,0 +1,238 @@
+#!/usr/bin/python3
+
+# Copyright © 2018 Simon McVittie
+# SPDX-License-Identifier: GPL-2.0+
+# (see vectis/__init__.py)
+
+import json
+import os
+import socket
+import threading
+import unittest
+from tempfile import TemporaryDirectory
+from unittest import mock
+
+from vectis.pool import (
+        WorkerPool,
+        WorkerPoolKey,
+        WorkerPoolServer,
+        )
+from vectis.worker import (
+        WorkerError,
+        )
+
+
+class FakeSuite:
+    def __init__(self, vendor, name):
+        self.vendor = vendor
+        self.name = name
+
+    def __str__(self):
+        return self.name
+
+
+class FakeVirtWorker:
+    """
+    Just enough of a VirtWorker for WorkerPool, without booting
+    anything.
+    """
+
+    lock = threading.Lock()
+    boots = threading.Semaphore(0)
+    failures = 0
+    instances = []
+    exited = threading.Semaphore(0)
+    reverted = threading.Semaphore(0)
+
+    def __init__(self, argv, *, capabilities=('revert',), **kwargs):
+        self.argv = argv
+        self.cache_mounted = False
+        self.call_argv = ['true']
+        self.capabilities = set(capabilities)
+        self.command_wrapper = '/bin/vectis-command-wrapper'
+        self.commands = []
+        self.entered = False
+        self.scratch = '/tmp/scratch'
+        self.user = 'user'
+
+        with self.lock:
+            self.instances.append(self)
+
+    def __enter__(self):
+        self.boots.acquire()
+
+        with self.lock:
+            if FakeVirtWorker.failures:
+                FakeVirtWorker.failures -= 1
+                raise RuntimeError('cannot boot')
+
+        self.entered = True
+        return self
+
+    def __exit__(self, et, ev, tb):
+        self.entered = False
+        self.exited.release()
+
+    def revert(self):
+        self.reverted.release()
+
+    def virt_command(self, command):
+        self.commands.append(command)
+        return 'ok\n'
+
+
+class WorkerPoolTestCase(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch('vectis.pool.VirtWorker', FakeVirtWorker)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        FakeVirtWorker.boots = threading.Semaphore(0)
+        FakeVirtWorker.failures = 0
+        FakeVirtWorker.instances = []
+        FakeVirtWorker.exited = threading.Semaphore(0)
+        FakeVirtWorker.reverted = threading.Semaphore(0)
+
+        self.suite = FakeSuite('debian', 'sid')
+        self.key = WorkerPoolKey(argv=['qemu'], suite=self.suite)
+        self.pool = WorkerPool(mirrors=None, storage='/nonexistent', size=1)
+        self.addCleanup(self.pool.close)
+        # Let any workers that are still booting finish
+        self.addCleanup(self.allow_boots, 100)
+
+    def allow_boots(self, n):
+        for i in range(n):
+            FakeVirtWorker.boots.release()
+
+    def test_key(self):
+        self.assertEqual(
+            self.key,
+            WorkerPoolKey(argv=('qemu',), suite=self.suite, components=()))
+        self.assertNotEqual(
+            self.key,
+            WorkerPoolKey(
+                argv=['qemu'], suite=self.suite, components=['main']))
+        self.assertEqual(
+            hash(WorkerPoolKey(
+                argv=['qemu'], suite=self.suite,
+                components=['main', 'contrib'])),
+            hash(WorkerPoolKey(
+                argv=['qemu'], suite=self.suite,
+                components=['contrib', 'main'])))
+
+    def test_revert(self):
+        self.allow_boots(1)
+        worker = self.pool.acquire(self.key)
+        self.assertTrue(worker.entered)
+
+        # A replacement starts booting as soon as the worker is handed
+        # out, but is not ready yet, so the worker is reverted and goes
+        # back into the pool
+        self.pool.release(self.key, worker)
+        self.assertTrue(FakeVirtWorker.reverted.acquire(timeout=10))
+        self.assertIs(self.pool.acquire(self.key), worker)
+
+        self.allow_boots(1)
+        replacement = self.pool.acquire(self.key)
+        self.assertIsNot(replacement, worker)
+        self.assertTrue(replacement.entered)
+
+    def test_discard(self):
+        self.allow_boots(1)
+        worker = self.pool.acquire(self.key)
+        worker.capabilities = set()
+
+        # A worker that cannot be reverted is shut down
+        self.pool.release(self.key, worker)
+        self.assertTrue(FakeVirtWorker.exited.acquire(timeout=10))
+        self.assertFalse(worker.entered)
+
+        self.allow_boots(1)
+        self.assertIsNot(self.pool.acquire(self.key), worker)
+
+    def test_boot_failure(self):
+        FakeVirtWorker.failures = 1
+        self.allow_boots(1)
+
+        with self.assertRaises(WorkerError):
+            self.pool.acquire(self.key)
+
+        # The failed worker was cleaned up, and the next one works
+        self.assertTrue(FakeVirtWorker.exited.acquire(timeout=10))
+        self.allow_boots(1)
+        self.assertTrue(self.pool.acquire(self.key).entered)
+
+    def test_close(self):
+        self.allow_boots(1)
+        worker = self.pool.acquire(self.key)
+        self.pool.close()
+
+        # A worker that finishes booting after the pool was closed is
+        # shut down, but not the worker that was handed out
+        self.allow_boots(1)
+        self.assertTrue(FakeVirtWorker.exited.acquire(timeout=10))
+        self.assertTrue(worker.entered)
+        self.assertEqual(
+            [w.entered for w in FakeVirtWorker.instances], [True, False])
+
+    def test_server(self):
+        with TemporaryDirectory(prefix='vectis-test-') as tmp:
+            path = os.path.join(tmp, 'socket')
+            server = WorkerPoolServer(
+                path, get_suite=lambda vendor, suite: self.suite,
+                pool=self.pool)
+            self.addCleanup(server.server_close)
+            thread = threading.Thread(target=server.serve_forever)
+            thread.start()
+            self.addCleanup(thread.join)
+            self.addCleanup(server.shutdown)
+
+            self.assertEqual(os.stat(path).st_mode & 0o077, 0)
+            self.allow_boots(1)
+
+            with socket.socket(socket.AF_UNIX) as sock:
+                sock.connect(path)
+                reader = sock.makefile('r')
+                writer = sock.makefile('w')
+
+                def send(line):
+                    writer.write(line + '\n')
+                    writer.flush()
+                    return reader.readline().rstrip('\n')
+
+                reply = send('lease ' + json.dumps(
+                    dict(argv=['qemu'], vendor='debian', suite='sid')))
+                self.assertTrue(reply.startswith('ok '))
+                details = json.loads(reply[len('ok '):])
+                self.assertEqual(details['scratch'], '/tmp/scratch')
+                self.assertEqual(details['cache_image'], None)
+
+                self.assertEqual(send('copydown a b'), 'ok')
+                self.assertTrue(send('revert').startswith('error '))
+                writer.write('quit\n')
+                writer.flush()
+                self.assertEqual(reader.readline(), '')
+                reader.close()
+                writer.close()
+
+            self.assertTrue(FakeVirtWorker.reverted.acquire(timeout=10))
+            leased = [w for w in FakeVirtWorker.instances if w.commands]
+            self.assertEqual(len(leased), 1)
+            self.assertEqual(leased[0].commands, ['copydown a b'])
+
+            with socket.socket(socket.AF_UNIX) as sock:
+                sock.connect(path)
+
+                with sock.makefile('rw') as stream:
+                    stream.write('hello\n')
+                    stream.flush()
+                    self.assertTrue(stream.readline().startswith('error '))
+
+    def tearDown(self):
+        pass
+
+
+if __name__ == '__main__':
+    import tap
+    runner = tap.TAPTestRunner()
+    runner.set_stream(True)
+    unittest.main(verbosity=2, testRunner=runner)
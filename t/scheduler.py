@@ -0,0 +1,191 @@
+#!/usr/bin/python3
+
+# Copyright © 2018 Simon McVittie
+# SPDX-License-Identifier: GPL-2.0+
+# (see vectis/__init__.py)
+
+import json
+import os
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import TemporaryDirectory
+
+from vectis.scheduler import (
+        DONE,
+        FAILED,
+        SKIPPED,
+        Scheduler,
+        )
+from vectis.trace import (
+        OperationTrace,
+        propagate_tag,
+        )
+
+
+class SchedulerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.__lock = threading.Lock()
+        self.log = []
+
+    def record(self, name):
+        with self.__lock:
+            self.log.append(name)
+
+    def test_order(self):
+        scheduler = Scheduler()
+        source = scheduler.add(
+            'source', lambda: self.record('source'))
+        amd64 = scheduler.add(
+            'amd64', lambda: self.record('amd64'), after=[source])
+        i386 = scheduler.add(
+            'i386', lambda: self.record('i386'), after=[source])
+        merge = scheduler.add(
+            'merge', lambda: self.record('merge'), after=[amd64, i386])
+        scheduler.run()
+
+        for task in (source, amd64, i386, merge):
+            self.assertEqual(task.state, DONE)
+
+        self.assertEqual(self.log[0], 'source')
+        self.assertEqual(sorted(self.log[1:3]), ['amd64', 'i386'])
+        self.assertEqual(self.log[3], 'merge')
+
+    def test_added_while_running(self):
+        scheduler = Scheduler()
+
+        def build():
+            self.record('build')
+            scheduler.add(
+                'test', lambda: self.record('test'), after=[built])
+
+        built = scheduler.add('build', build)
+        scheduler.run()
+
+        self.assertEqual(self.log, ['build', 'test'])
+
+    def test_limits(self):
+        scheduler = Scheduler(limits=dict(sbuild=2, host=None))
+        lock = threading.Lock()
+        running = dict(sbuild=0, host=0, other=0)
+        most = dict(sbuild=0, host=0, other=0)
+        gate = threading.Event()
+
+        def use(resource):
+            with lock:
+                running[resource] += 1
+                most[resource] = max(most[resource], running[resource])
+
+            gate.wait(0.1)
+
+            with lock:
+                running[resource] -= 1
+
+        for resource in ('sbuild', 'host', 'other'):
+            for i in range(4):
+                scheduler.add(
+                    '{} {}'.format(resource, i),
+                    lambda resource=resource: use(resource),
+                    resource=resource)
+
+        scheduler.run()
+
+        self.assertEqual(most['sbuild'], 2)
+        self.assertEqual(most['host'], 4)
+        # Resources not in limits are used by one task at a time
+        self.assertEqual(most['other'], 1)
+
+    def test_failure(self):
+        scheduler = Scheduler()
+        cancelled = []
+
+        def fail():
+            raise RuntimeError('build failed')
+
+        build = scheduler.add('build', fail)
+        other = scheduler.add('other', lambda: self.record('other'))
+        test = scheduler.add(
+            'test', lambda: self.record('test'), after=[build],
+            cancel=lambda: cancelled.append('test'))
+        lint = scheduler.add(
+            'lint', lambda: self.record('lint'), after=[test])
+
+        with self.assertRaises(RuntimeError):
+            scheduler.run()
+
+        # The tasks after the failure were skipped, but independent
+        # tasks still ran
+        self.assertEqual(build.state, FAILED)
+        self.assertEqual(other.state, DONE)
+        self.assertEqual(test.state, SKIPPED)
+        self.assertEqual(lint.state, SKIPPED)
+        self.assertEqual(self.log, ['other'])
+        self.assertEqual(cancelled, [])
+
+    def test_first_failure(self):
+        scheduler = Scheduler(limits=dict(sbuild=None))
+        release = threading.Event()
+
+        def fail_late():
+            release.wait(10)
+            raise RuntimeError('first')
+
+        def fail_early():
+            try:
+                raise ValueError('second')
+            finally:
+                release.set()
+
+        scheduler.add('first', fail_late, resource='sbuild')
+        scheduler.add('second', fail_early, resource='sbuild')
+
+        # The error is from the first task added, even though the other
+        # one failed first
+        with self.assertRaises(RuntimeError):
+            scheduler.run()
+
+    def test_tags(self):
+        scheduler = Scheduler(limits=dict(sbuild=None))
+        trace = OperationTrace()
+
+        def op(detail):
+            trace.add(detail=detail, op='call', seconds=1, worker='w')
+
+        def build(name):
+            op('build ' + name)
+
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                for arch in ('amd64', 'i386'):
+                    executor.submit(
+                        propagate_tag(op), '{} {}'.format(name, arch))
+
+            scheduler.add('test ' + name, lambda: op('test ' + name))
+
+        for name in ('hello', 'world'):
+            scheduler.add(
+                name, lambda name=name: build(name), resource='sbuild',
+                tag=name)
+
+        scheduler.run()
+        op('untagged')
+
+        with TemporaryDirectory(prefix='vectis-test-') as tmp:
+            trace.write(os.path.join(tmp, 'hello.jsonl'), tag='hello')
+
+            with open(os.path.join(tmp, 'hello.jsonl')) as reader:
+                details = sorted(
+                    json.loads(line)['detail'] for line in reader)
+
+        self.assertEqual(
+            details,
+            ['build hello', 'hello amd64', 'hello i386', 'test hello'])
+
+    def tearDown(self):
+        pass
+
+
+if __name__ == '__main__':
+    import tap
+    runner = tap.TAPTestRunner()
+    runner.set_stream(True)
+    unittest.main(verbosity=2, testRunner=runner)
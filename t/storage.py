@@ -0,0 +1,304 @@
+#!/usr/bin/python3
+
+# Copyright © 2018 Simon McVittie
+# SPDX-License-Identifier: GPL-2.0+
+# (see vectis/__init__.py)
+
+import hashlib
+import os
+import shutil
+import subprocess
+import time
+import unittest
+from tempfile import TemporaryDirectory
+
+from vectis.snapshot import (
+        SnapshotStore,
+        )
+from vectis.storage import (
+        SourceCache,
+        StorageIndex,
+        _shares_extents,
+        collect_garbage,
+        )
+
+_DAY = 86400
+
+
+class StorageTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = TemporaryDirectory(prefix='vectis-test-')
+        self.addCleanup(self.tmp.cleanup)
+        self.storage = self.tmp.name
+        self.now = time.time()
+
+    def make(self, path, data=b'', *, age=0):
+        path = os.path.join(self.storage, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        with open(path, 'wb') as writer:
+            writer.write(data)
+
+        os.utime(path, (self.now - age, self.now - age))
+        return path
+
+    def exists(self, path):
+        return os.path.exists(os.path.join(self.storage, path))
+
+    def test_index(self):
+        self.make('amd64/debian/sid/sbuild.tar.gz', b'sbuild', age=_DAY)
+        self.make('amd64/debian/sid/autopkgtest.qcow2', b'qemu')
+        self.make('amd64/debian/sid/notes.txt', b'not an artifact')
+        self.make('mirror-cache/deb.debian.org/debian/pool/x.deb', b'x')
+
+        index = StorageIndex(self.storage)
+        entries = index.update()
+
+        self.assertEqual(
+            sorted(entries),
+            ['amd64/debian/sid/autopkgtest.qcow2',
+             'amd64/debian/sid/sbuild.tar.gz'])
+
+        entry = index.lookup(os.path.join(
+            self.storage, 'amd64/debian/sid/sbuild.tar.gz'))
+        self.assertEqual(entry['name'], 'sbuild')
+        self.assertEqual(entry['format'], 'gzip')
+        self.assertEqual(entry['size'], 6)
+
+        self.assertEqual(
+            [e['path'] for e in index.find(architecture='amd64')],
+            ['amd64/debian/sid/autopkgtest.qcow2',
+             'amd64/debian/sid/sbuild.tar.gz'])
+        self.assertEqual(index.find(name='minbase'), [])
+
+        # A fresh index is loaded from disk
+        self.assertEqual(StorageIndex(self.storage).entries, entries)
+
+    def test_leftovers(self):
+        self.make('amd64/debian/sid/sbuild.tar.gz', b'old', age=2 * _DAY)
+        self.make('amd64/debian/sid/sbuild.tar.zst', b'new', age=_DAY)
+        self.make('amd64/debian/sid/minbase.tar.gz.new', age=_DAY)
+        self.make('amd64/debian/sid/lxc-rootfs.tar.gz.tmp')
+        self.make('mirror-cache/deb.debian.org/debian/pool/.x.deb.1', age=_DAY)
+        self.make('mirror-cache/deb.debian.org/debian/pool/.y.deb.2')
+
+        collect_garbage(self.storage)
+
+        self.assertFalse(self.exists('amd64/debian/sid/sbuild.tar.gz'))
+        self.assertTrue(self.exists('amd64/debian/sid/sbuild.tar.zst'))
+        self.assertFalse(self.exists('amd64/debian/sid/minbase.tar.gz.new'))
+        # Too new: it might still be in progress
+        self.assertTrue(self.exists('amd64/debian/sid/lxc-rootfs.tar.gz.tmp'))
+        self.assertFalse(self.exists(
+            'mirror-cache/deb.debian.org/debian/pool/.x.deb.1'))
+        self.assertTrue(self.exists(
+            'mirror-cache/deb.debian.org/debian/pool/.y.deb.2'))
+
+    def test_budgets(self):
+        image = self.make(
+            'amd64/debian/sid/autopkgtest.qcow2', b'i' * 100, age=30 * _DAY)
+        self.make('amd64/debian/sid/sbuild.tar.gz', b's' * 100, age=20 * _DAY)
+        self.make('amd64/debian/sid/minbase.tar.gz', b'm' * 100, age=3 * _DAY)
+        self.make('amd64/debian/sid/lxc-meta.tar.gz', b'l' * 100)
+        self.make('mirror-cache/x/pool/old.deb', b'o' * 100, age=4 * _DAY)
+        self.make('mirror-cache/x/pool/older.deb', b'o' * 100, age=5 * _DAY)
+        self.make('mirror-cache/x/pool/new.deb', b'n' * 100, age=_DAY)
+        self.make('mirror-cache/x/dists/sid/InRelease.vectis-meta', b'{}')
+
+        freed = collect_garbage(
+            self.storage, dry_run=True, keep=[image], max_age=10 * _DAY,
+            max_size=300)
+        self.assertEqual(freed, 400)
+        self.assertTrue(self.exists('amd64/debian/sid/sbuild.tar.gz'))
+
+        freed = collect_garbage(
+            self.storage, keep=[image], max_age=10 * _DAY, max_size=300)
+        self.assertEqual(freed, 400)
+
+        # Too old, but kept
+        self.assertTrue(self.exists('amd64/debian/sid/autopkgtest.qcow2'))
+        # Too old
+        self.assertFalse(self.exists('amd64/debian/sid/sbuild.tar.gz'))
+        # The least recently used of the rest, until they fit
+        self.assertFalse(self.exists('mirror-cache/x/pool/older.deb'))
+        self.assertFalse(self.exists('mirror-cache/x/pool/old.deb'))
+        self.assertFalse(self.exists('amd64/debian/sid/minbase.tar.gz'))
+        self.assertTrue(self.exists('mirror-cache/x/pool/new.deb'))
+        self.assertTrue(self.exists('amd64/debian/sid/lxc-meta.tar.gz'))
+
+    def test_snapshots(self):
+        image = self.make('amd64/debian/sid/autopkgtest.qcow2', b'image')
+        other = self.make('amd64/debian/sid/sbuild.qcow2', b'other')
+        store = SnapshotStore(self.storage)
+        inputs = dict(sources_list='deb http://deb.debian.org/debian sid')
+
+        def snapshot(key, image, package_lists, *, age=0, ready=True):
+            self.make('snapshots/{}.qcow2'.format(key), b'snapshot', age=age)
+            store.record(key, image, dict(inputs, package_lists=package_lists))
+
+            if ready:
+                self.make('snapshots/{}.qcow2.ready'.format(key), age=age)
+
+        snapshot('current', image, ['new'])
+        snapshot('superseded', image, ['old'], age=_DAY)
+        snapshot('other', other, ['old'], age=_DAY)
+        snapshot('unfinished', image, ['new'], age=_DAY, ready=False)
+        snapshot('unused', other, ['new'], age=30 * _DAY)
+        snapshot('replaced', other, ['newer'])
+
+        # Replace the image that "replaced" was made from
+        os.unlink(other)
+        self.make('amd64/debian/sid/sbuild.qcow2', b'replaced')
+
+        with store.lock('current'):
+            pass
+
+        collect_garbage(self.storage, max_age=10 * _DAY)
+
+        self.assertEqual(
+            sorted(s['key'] for s in store.list()), ['current'])
+        self.assertFalse(self.exists('snapshots/replaced.qcow2.ready'))
+        self.assertFalse(self.exists('snapshots/superseded.json'))
+
+    def test_dedup(self):
+        a = self.make('amd64/debian/sid/sbuild.tar.gz', b'same')
+        b = self.make('i386/debian/sid/sbuild.tar.gz', b'same')
+        c = self.make('amd64/debian/sid/autopkgtest.qcow2', b'image')
+        d = self.make('i386/debian/sid/autopkgtest.qcow2', b'image')
+
+        freed = collect_garbage(self.storage)
+
+        self.assertTrue(os.path.samefile(a, b))
+        # qcow2 images can be rewritten in place, so they are never
+        # hard-linked; they might have been reflinked
+        self.assertFalse(os.path.samefile(c, d))
+
+        with open(c, 'rb') as reader:
+            self.assertEqual(reader.read(), b'image')
+
+        with open(d, 'rb') as reader:
+            self.assertEqual(reader.read(), b'image')
+
+        # Only bytes that were actually reclaimed are counted, so doing
+        # it again frees nothing
+        if _shares_extents(c, d):
+            self.assertEqual(freed, 4 + 5)
+        else:
+            self.assertEqual(freed, 4)
+
+        self.assertEqual(collect_garbage(self.storage), 0)
+
+    def test_shares_extents(self):
+        a = self.make('a', b'x' * 8192)
+        b = self.make('b', b'x' * 8192)
+
+        self.assertFalse(_shares_extents(a, b))
+        self.assertFalse(_shares_extents(a, self.make('c', b'x')))
+
+        try:
+            subprocess.check_call(
+                ['cp', '--reflink=always', a, os.path.join(
+                    self.storage, 'd')],
+                stderr=subprocess.DEVNULL)
+        except subprocess.CalledProcessError:
+            self.skipTest('reflinks not supported here')
+
+        self.assertTrue(_shares_extents(a, os.path.join(self.storage, 'd')))
+
+    def tearDown(self):
+        pass
+
+
+class LocalWorker:
+    """
+    Just enough of a worker for SourceCache, with the "guest" being
+    the host.
+    """
+
+    def copy_to_host(self, guest_path, host_path):
+        shutil.copyfile(guest_path, host_path)
+
+
+class SourceCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = TemporaryDirectory(prefix='vectis-test-')
+        self.addCleanup(self.tmp.cleanup)
+        self.cache = SourceCache(os.path.join(self.tmp.name, 'storage'))
+        self.guest = os.path.join(self.tmp.name, 'guest')
+        os.makedirs(self.guest)
+
+        files = []
+        checksums = []
+
+        for name, data in (
+                ('hello_1.0.orig.tar.gz', b'upstream'),
+                ('hello_1.0-1.debian.tar.xz', b'packaging')):
+            with open(os.path.join(self.guest, name), 'wb') as writer:
+                writer.write(data)
+
+            files.append(' {} {} {}'.format(
+                hashlib.md5(data).hexdigest(), len(data), name))
+            checksums.append(' {} {} {}'.format(
+                hashlib.sha256(data).hexdigest(), len(data), name))
+
+        self.dsc = os.path.join(self.guest, 'hello_1.0-1.dsc')
+
+        with open(self.dsc, 'w') as writer:
+            writer.write(
+                'Format: 3.0 (quilt)\n'
+                'Source: hello\n'
+                'Version: 1:1.0-1\n'
+                'Checksums-Sha256:\n' + '\n'.join(checksums) + '\n'
+                'Files:\n' + '\n'.join(files) + '\n')
+
+    def test_add(self):
+        self.assertIsNone(self.cache.lookup('hello', '1:1.0-1'))
+
+        files = self.cache.add(LocalWorker(), self.dsc)
+        directory = self.cache.get_path('hello', '1:1.0-1')
+
+        # The epoch is not part of the filenames
+        self.assertEqual(os.path.basename(directory), '1.0-1')
+        self.assertEqual(
+            files,
+            [os.path.join(directory, name) for name in (
+                'hello_1.0-1.dsc', 'hello_1.0.orig.tar.gz',
+                'hello_1.0-1.debian.tar.xz')])
+        self.assertEqual(self.cache.lookup('hello', '1:1.0-1'), files)
+        self.assertEqual(
+            os.listdir(self.cache.directory), ['hello'])
+
+    def test_corrupt(self):
+        files = self.cache.add(LocalWorker(), self.dsc)
+
+        with open(files[1], 'wb') as writer:
+            writer.write(b'UPSTREAM')
+
+        # A corrupt cached copy is discarded
+        self.assertIsNone(self.cache.lookup('hello', '1:1.0-1'))
+        self.assertFalse(
+            os.path.exists(self.cache.get_path('hello', '1:1.0-1')))
+
+        # A corrupt download is not cached
+        os.unlink(os.path.join(self.guest, 'hello_1.0-1.debian.tar.xz'))
+
+        with open(
+                os.path.join(self.guest, 'hello_1.0-1.debian.tar.xz'),
+                'wb') as writer:
+            writer.write(b'truncated')
+
+        self.assertIsNone(self.cache.add(LocalWorker(), self.dsc))
+        self.assertEqual(
+            os.listdir(self.cache.directory), ['hello'])
+        self.assertEqual(
+            os.listdir(os.path.join(self.cache.directory, 'hello')), [])
+
+    def tearDown(self):
+        pass
+
+
+if __name__ == '__main__':
+    import tap
+    runner = tap.TAPTestRunner()
+    runner.set_stream(True)
+    unittest.main(verbosity=2, testRunner=runner)
@@ -0,0 +1,73 @@
+#!/usr/bin/python3
+
+# Copyright © 2018 Simon McVittie
+# SPDX-License-Identifier: GPL-2.0+
+# (see vectis/__init__.py)
+
+import threading
+import unittest
+
+from vectis.util import (
+        MemoryBudget,
+        )
+
+
+class MemoryBudgetTestCase(unittest.TestCase):
+    def test_acquire(self):
+        budget = MemoryBudget(100)
+
+        self.assertTrue(budget.acquire(60, timeout=0))
+        self.assertTrue(budget.acquire(40, timeout=0))
+        self.assertFalse(budget.acquire(1, timeout=0))
+        self.assertTrue(budget.acquire(None, timeout=0))
+
+        budget.release(60)
+        self.assertFalse(budget.acquire(61, timeout=0))
+        self.assertTrue(budget.acquire(60, timeout=0))
+
+    def test_too_large(self):
+        budget = MemoryBudget(100)
+
+        # More than the whole budget is granted when nothing else holds
+        # any memory, so that it does not wait forever
+        self.assertTrue(budget.acquire(200, timeout=0))
+        self.assertFalse(budget.acquire(1, timeout=0))
+        budget.release(200)
+
+        self.assertTrue(budget.acquire(1, timeout=0))
+        self.assertFalse(budget.acquire(200, timeout=0))
+
+    def test_unlimited(self):
+        budget = MemoryBudget(100)
+        budget.total = None
+
+        for i in range(3):
+            self.assertTrue(budget.acquire(100, timeout=0))
+
+    def test_reserve(self):
+        budget = MemoryBudget(100)
+        acquired = threading.Event()
+
+        def acquire():
+            budget.acquire(100)
+            acquired.set()
+
+        with budget.reserve(100):
+            thread = threading.Thread(target=acquire)
+            thread.start()
+            self.assertFalse(acquired.wait(0.1))
+
+        # The thread gets the memory when the with block ends
+        self.assertTrue(acquired.wait(10))
+        thread.join()
+        self.assertFalse(budget.acquire(1, timeout=0))
+
+    def tearDown(self):
+        pass
+
+
+if __name__ == '__main__':
+    import tap
+    runner = tap.TAPTestRunner()
+    runner.set_stream(True)
+    unittest.main(verbosity=2, testRunner=runner)
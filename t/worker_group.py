@@ -0,0 +1,127 @@
+#!/usr/bin/python3
+
+# Copyright © 2018 Simon McVittie
+# SPDX-License-Identifier: GPL-2.0+
+# (see vectis/__init__.py)
+
+import threading
+import unittest
+
+from vectis.util import (
+        MemoryBudget,
+        )
+from vectis.worker import (
+        BaseWorker,
+        WorkerGroup,
+        )
+
+
+class FakeWorker(BaseWorker):
+    def __init__(self, name, *, failures=0):
+        super().__init__()
+        self.name = name
+        self.failures = failures
+        self.entered = 0
+        self.exited = 0
+        self.started = False
+
+    def _open(self):
+        super()._open()
+        self.stack.callback(self._stop)
+
+        if self.failures:
+            self.failures -= 1
+            raise RuntimeError('cannot boot {}'.format(self.name))
+
+        self.entered += 1
+        self.started = True
+
+    def _stop(self):
+        self.started = False
+        self.exited += 1
+
+
+class WorkerGroupTestCase(unittest.TestCase):
+    def test_reuse(self):
+        a = FakeWorker('a')
+        b = FakeWorker('b')
+
+        with WorkerGroup([a, b]) as group:
+            with group.lease() as first:
+                self.assertIs(first, a)
+
+            with group.lease() as second:
+                self.assertIs(second, a)
+
+                with group.lease() as third:
+                    self.assertIs(third, b)
+
+        self.assertEqual(a.entered, 1)
+        self.assertEqual(a.exited, 1)
+        self.assertEqual(b.entered, 1)
+        self.assertEqual(b.exited, 1)
+
+    def test_open_failure(self):
+        a = FakeWorker('a', failures=1)
+        budget = MemoryBudget(100)
+
+        with WorkerGroup(
+                [a], memory_budget=budget, memory_size=100) as group:
+            with self.assertRaises(RuntimeError):
+                with group.lease():
+                    pass
+
+            # What the failed attempt had set up was torn down
+            self.assertEqual(a.exited, 1)
+
+            # The worker was put back, so the next lease can open it
+            # instead of waiting forever, and its memory was released;
+            # it really is started this time, not just counted as open
+            with group.lease() as worker:
+                self.assertIs(worker, a)
+                self.assertTrue(worker.started)
+
+        self.assertEqual(a.entered, 1)
+        self.assertEqual(a.exited, 2)
+        self.assertFalse(a.started)
+        self.assertTrue(budget.acquire(100, timeout=0))
+
+    def test_open_failure_concurrent(self):
+        a = FakeWorker('a', failures=1)
+        results = {}
+        leasing = threading.Barrier(2)
+
+        with WorkerGroup([a]) as group:
+            def task(i):
+                leasing.wait()
+
+                try:
+                    with group.lease() as worker:
+                        results[i] = worker
+                except RuntimeError as e:
+                    results[i] = e
+
+            threads = [
+                threading.Thread(target=task, args=(i,)) for i in range(2)
+            ]
+
+            for t in threads:
+                t.start()
+
+            for t in threads:
+                t.join(30)
+                self.assertFalse(t.is_alive())
+
+        self.assertEqual(
+            sorted(type(r).__name__ for r in results.values()),
+            ['FakeWorker', 'RuntimeError'])
+
+    def tearDown(self):
+        pass
+
+
+if __name__ == '__main__':
+    import tap
+    runner = tap.TAPTestRunner()
+    runner.set_stream(True)
+    unittest.main(verbosity=2, testRunner=runner)
@@ -0,0 +1,206 @@
+# Copyright © 2018 Simon McVittie
+# SPDX-License-Identifier: GPL-2.0+
+# (see vectis/__init__.py)
+
+import base64
+import json
+import logging
+import subprocess
+import sys
+import threading
+
+from vectis.error import (
+    Error,
+)
+
+logger = logging.getLogger(__name__)
+
+
+# Requests that do not run a command should be answered almost at once,
+# so if there is no reply after this many seconds, the agent is stuck.
+REPLY_TIMEOUT = 60
+
+
+class AgentError(Error):
+    pass
+
+
+class AgentTimeout(AgentError):
+    pass
+
+
+class _Request:
+
+    def __init__(self, output=None):
+        self.done = threading.Event()
+        self.output = output
+        self.reply = None
+
+
+class GuestAgent:
+    """
+    A long-lived "vectis-command-wrapper --agent" process in a worker,
+    to which commands and simple filesystem operations can be sent
+    without starting a new process on the host each time. Requests are
+    multiplexed, so several threads can use the agent concurrently.
+    """
+
+    def __init__(self, argv):
+        self.argv = argv
+        self.__closed = False
+        self.__lock = threading.Lock()
+        self.__next_id = 0
+        self.__pending = {}
+        self.__process = subprocess.Popen(
+            argv,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE)
+        self.__reader = threading.Thread(target=self._read, daemon=True)
+        self.__reader.start()
+
+    @property
+    def closed(self):
+        with self.__lock:
+            return self.__closed
+
+    def _read(self):
+        try:
+            for line in self.__process.stdout:
+                try:
+                    message = json.loads(line.decode('utf-8'))
+                    id = message['id']
+                except (KeyError, TypeError, ValueError):
+                    logger.warning(
+                        'Ignoring unexpected output from agent: %r', line)
+                    continue
+
+                with self.__lock:
+                    request = self.__pending.get(id)
+
+                if request is None:
+                    logger.warning(
+                        'Unexpected message from agent: %r', message)
+                elif 'stream' in message:
+                    request.output(
+                        message['stream'], base64.b64decode(message['data']))
+                else:
+                    with self.__lock:
+                        del self.__pending[id]
+
+                    request.reply = message
+                    request.done.set()
+        finally:
+            # Whatever happened to the reader, nothing else will answer
+            # the pending requests, so fail them all
+            with self.__lock:
+                self.__closed = True
+                pending = list(self.__pending.values())
+                self.__pending.clear()
+
+            for request in pending:
+                request.done.set()
+
+    def request(self, op, *, output=None, timeout=None, **kwargs):
+        """
+        Send a request to the agent and wait for its reply. output is
+        called with a stream number (1 or 2) and some bytes whenever
+        the request produces output. If timeout is not None, raise
+        AgentTimeout if there is no reply after that many seconds.
+        """
+        request = _Request(output=output)
+
+        with self.__lock:
+            if self.__closed:
+                raise AgentError('Agent {!r} has exited'.format(self.argv))
+
+            self.__next_id += 1
+            kwargs['id'] = self.__next_id
+            kwargs['op'] = op
+            self.__pending[kwargs['id']] = request
+
+            try:
+                self.__process.stdin.write(
+                    (json.dumps(kwargs) + '\n').encode('utf-8'))
+                self.__process.stdin.flush()
+            except OSError as e:
+                del self.__pending[kwargs['id']]
+                raise AgentError(
+                    'Unable to send request to agent {!r}: {}'.format(
+                        self.argv, e))
+
+        if not request.done.wait(timeout):
+            with self.__lock:
+                self.__pending.pop(kwargs['id'], None)
+
+            raise AgentTimeout(
+                'Agent {!r} did not reply to {} request within {} '
+                'seconds'.format(self.argv, op, timeout))
+
+        if request.reply is None:
+            raise AgentError('Agent {!r} exited during {} request'.format(
+                self.argv, op))
+
+        if 'error' in request.reply:
+            raise AgentError('Agent {!r} failed to {}: {}'.format(
+                self.argv, op, request.reply['error']))
+
+        return request.reply
+
+    def run(self, argv, *, capture=False):
+        """
+        Run argv in the worker and return a tuple (exit status,
+        standard output). Standard error, and standard output unless
+        capture is true, are copied to ours.
+        """
+        def output(stream, blob):
+            if stream == 1:
+                writer = sys.stdout.buffer
+            else:
+                writer = sys.stderr.buffer
+
+            writer.write(blob)
+            writer.flush()
+
+        reply = self.request(
+            'run', argv=list(argv), capture=capture, output=output)
+
+        if capture:
+            return reply['status'], base64.b64decode(reply['stdout'])
+        else:
+            return reply['status'], None
+
+    def ping(self):
+        self.request('ping', timeout=REPLY_TIMEOUT)
+
+    def exists(self, path):
+        return self.request(
+            'exists', path=path, timeout=REPLY_TIMEOUT)['result']
+
+    def write(self, path, data, *, mode=0o644):
+        self.request(
+            'write',
+            data=base64.b64encode(data).decode('ascii'),
+            mode=mode,
+            path=path,
+            timeout=REPLY_TIMEOUT,
+        )
+
+    def close(self):
+        with self.__lock:
+            self.__closed = True
+
+        if self.__process.stdin is not None:
+            try:
+                self.__process.stdin.close()
+            except OSError:
+                pass
+
+        try:
+            self.__process.wait(REPLY_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            logger.warning('Agent %r did not exit, killing it', self.argv)
+            self.__process.kill()
+            self.__process.wait()
+
+        self.__reader.join()
+        self.__process.stdout.close()
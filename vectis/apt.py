@@ -2,6 +2,12 @@
 # SPDX-License-Identifier: GPL-2.0+
 # (see vectis/__init__.py)
 
+import hashlib
+import logging
+import re
+import threading
+import time
+import urllib.request
 
 try:
     import typing
@@ -9,14 +15,20 @@ except ImportError:
     pass
 else:
     from typing import (
+        Dict,
         Iterable,
         Optional,
         Set,
+        Tuple,
     )
     typing      # silence pyflakes
+    Dict
     Iterable
     Optional
     Set
+    Tuple
+
+logger = logging.getLogger(__name__)
 
 
 class AptSource:
@@ -103,3 +115,94 @@ class AptSource:
             self.uri,
             ' '.join(self.components),
         )
+
+
+# Each InRelease file is downloaded at most once in this many seconds,
+# however many workers and tarballs ask for it
+_RELEASE_CACHE_SECONDS = 300
+_release_cache = {}     # type: Dict[Tuple[str, str], tuple]
+_release_cache_lock = threading.Lock()
+
+
+def fetch_release(
+        uri,                            # type: Optional[str]
+        suite,                          # type: str
+        *,
+        timeout=30                      # type: int
+):
+    # type: (...) -> Optional[bytes]
+    """
+    Return the contents of the InRelease file (or failing that the
+    Release file) for suite in the archive at uri, or None if uri is
+    None or neither can be downloaded. uri must be reachable from the
+    host: see Mirrors.lookup_suite_from_host().
+    """
+    if uri is None:
+        return None
+
+    key = (uri.rstrip('/'), suite)
+
+    with _release_cache_lock:
+        cached = _release_cache.get(key)
+
+        if (cached is not None and
+                time.monotonic() < cached[0] + _RELEASE_CACHE_SECONDS):
+            return cached[1]
+
+        release = None
+
+        for name in ('InRelease', 'Release'):
+            url = '{}/dists/{}/{}'.format(key[0], suite, name)
+
+            try:
+                with urllib.request.urlopen(
+                        url, timeout=timeout) as response:
+                    release = response.read()
+            except OSError as e:
+                logger.debug('Unable to download %s: %s', url, e)
+            else:
+                break
+        else:
+            logger.warning(
+                'Unable to download Release file for %s from %s',
+                suite, uri)
+
+        # Failures are remembered too, so that an unreachable archive
+        # only delays us once
+        _release_cache[key] = (time.monotonic(), release)
+        return release
+
+
+def get_release_date(release):
+    # type: (bytes) -> Optional[str]
+    """
+    Return the Date field of release, the contents of an InRelease or
+    Release file, or None if it has none.
+    """
+    match = re.search(br'^Date:[ \t]*(.*?)[ \t]*$', release, re.MULTILINE)
+
+    if match is None:
+        return None
+
+    return match.group(1).decode('utf-8', errors='replace')
+
+
+def get_release_digest(
+        uri,                            # type: Optional[str]
+        suite,                          # type: str
+        *,
+        timeout=30                      # type: int
+):
+    # type: (...) -> Optional[str]
+    """
+    Return the SHA-256 of the InRelease file (or failing that the
+    Release file) for suite in the archive at uri, or None if neither
+    can be downloaded. This changes whenever the archive's package
+    lists do.
+    """
+    release = fetch_release(uri, suite, timeout=timeout)
+
+    if release is None:
+        return None
+
+    return hashlib.sha256(release).hexdigest()
@@ -6,7 +6,10 @@ import logging
 import os
 import shlex
 import textwrap
+import threading
 import uuid
+import weakref
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import (
     ExitStack,
 )
@@ -14,15 +17,19 @@ from tempfile import (
     TemporaryDirectory,
 )
 
-from debian.deb822 import (
-    Changes,
-    Dsc,
-)
-
 from vectis.lxc import (
     set_up_lxc_net,
     set_up_lxd_net,
 )
+from vectis.provision import (
+    AUTOPKGTEST_LXC,
+    AUTOPKGTEST_LXD,
+    AUTOPKGTEST_SCHROOT,
+    ZSTD,
+)
+from vectis.trace import (
+    propagate_tag,
+)
 from vectis.worker import (
     ContainerWorker,
     FileProvider,
@@ -30,12 +37,33 @@ from vectis.worker import (
 )
 from vectis.util import (
     AtomicWriter,
+    MemoryBudget,
+    find_tarball,
+    get_tar_compress_options,
+    get_tarball_compression,
 )
 
 logger = logging.getLogger(__name__)
 
 _1M = 1024 * 1024
 
+# Container modes set up their containers at fixed paths and names in
+# the worker, and restart its container networking, so only one of them
+# can use a worker at a time, even across concurrent run_autopkgtest()
+_container_worker_locks = weakref.WeakKeyDictionary()
+_container_worker_locks_lock = threading.Lock()
+
+
+def _lock_container_worker(worker):
+    with _container_worker_locks_lock:
+        lock = _container_worker_locks.get(worker)
+
+        if lock is None:
+            lock = threading.Lock()
+            _container_worker_locks[worker] = lock
+
+        return lock
+
 
 class AutopkgtestWorker(ContainerWorker, FileProvider):
 
@@ -182,40 +210,13 @@ class AutopkgtestWorker(ContainerWorker, FileProvider):
 
         return in_autopkgtest
 
-    def make_dsc_file_available(self, filename, owner=None):
-        d = os.path.dirname(filename) or os.curdir
-
-        with open(filename) as reader:
-            dsc = Dsc(reader)
-
-        to = self.new_directory()
-        self.argv.append('--copy={}:{}'.format(
-            filename, '{}/{}'.format(to, os.path.basename(filename))))
-
-        for f in dsc['files']:
-            self.argv.append(
-                '--copy={}:{}'.format(
-                    os.path.join(d, f['name']),
-                    '{}/{}'.format(to, f['name'])))
+    def make_files_available(self, filenames, *, owner=None):
+        d = self.worker.make_files_available(filenames, owner=owner)
 
-        return to, os.path.basename(filename)
-
-    def make_changes_file_available(self, filename, owner=None):
-        d = os.path.dirname(filename) or os.curdir
-
-        with open(filename) as reader:
-            changes = Changes(reader)
-
-        to = self.new_directory()
-        self.argv.append('--copy={}:{}'.format(
-            filename, '{}/{}'.format(to, os.path.basename(filename))))
-
-        for f in changes['files']:
-            self.argv.append('--copy={}:{}'.format(
-                os.path.join(d, f['name']),
-                '{}/{}'.format(to, f['name'])))
-
-        return to, os.path.basename(filename)
+        # assume /tmp is initially empty and uuid4() won't collide
+        to = '/tmp/{}'.format(uuid.uuid4())
+        self.argv.append('--copy={}:{}'.format(d, to))
+        return to
 
     def _open(self):
         super()._open()
@@ -242,9 +243,10 @@ def run_autopkgtest(
         qemu_ram_size=None,
         schroot_worker=None,
         source_dir=None,
+        jobs=None,
+        memory_budget=None,
         source_dsc=None,
         source_package=None):
-    failures = []
 
     if lxc_worker is None:
         lxc_worker = worker
@@ -255,9 +257,9 @@ def run_autopkgtest(
     if schroot_worker is None:
         schroot_worker = worker
 
-    logger.info('Testing in modes: %r', modes)
+    def run_mode(test):
+        failures = []
 
-    for test in modes:
         logger.info('Testing in mode: %s', test)
         with ExitStack() as stack:
             run_as = None
@@ -283,7 +285,7 @@ def run_autopkgtest(
 
                 if not image or not os.path.exists(image):
                     logger.info('Required image %s does not exist', image)
-                    continue
+                    return failures
 
                 output_on_worker = output_dir
                 virt = ['qemu']
@@ -294,46 +296,59 @@ def run_autopkgtest(
                 virt.append(image)
 
             elif test == 'schroot':
-                tarball = os.path.join(
+                tarball = find_tarball(os.path.join(
                     storage,
                     architecture,
                     str(vendor),
                     str(suite.hierarchy[-1]),
-                    'minbase.tar.gz')
+                    'minbase.tar.gz'))
 
                 if not os.path.exists(tarball):
                     logger.info('Required tarball %s does not exist',
                                 tarball)
-                    continue
+                    return failures
+
+                compression = get_tarball_compression(tarball)
+                schroot_worker.provision(AUTOPKGTEST_SCHROOT)
+
+                if compression == 'zstd':
+                    schroot_worker.provision(ZSTD)
 
                 worker = stack.enter_context(schroot_worker)
-                worker.check_call([
-                    'env',
-                    'DEBIAN_FRONTEND=noninteractive',
-                    'apt-get',
-                    '-y',
-                    '-t', worker.suite.apt_suite,
-                    'install',
-
-                    'autopkgtest',
-                    'python3',
-                    'schroot',
-                ])
+                tarball_in_guest = worker.make_file_available(
+                    tarball, cache=True)
+
+                if compression == 'zstd':
+                    # schroot cannot open zstd tarballs as type=file,
+                    # so unpack it and use an overlay on top
+                    directory = worker.new_directory()
+                    worker.check_call(
+                        ['tar', '-C', directory] +
+                        get_tar_compress_options(compression) +
+                        ['-xf', tarball_in_guest])
+                    chroot_type = textwrap.dedent('''\
+                    type=directory
+                    directory={}
+                    union-type=overlay
+                    ''').format(directory)
+                else:
+                    chroot_type = textwrap.dedent('''\
+                    type=file
+                    file={}
+                    ''').format(tarball_in_guest)
 
                 with TemporaryDirectory(prefix='vectis-sbuild-') as tmp:
                     with AtomicWriter(os.path.join(
                             tmp, 'sbuild.conf')) as writer:
                         writer.write(textwrap.dedent('''
                         [autopkgtest]
-                        type=file
+                        {chroot_type}
                         description=Test
-                        file={tarball}
                         groups=root,{user}
                         root-groups=root,{user}
                         profile=default
                         ''').format(
-                            tarball=worker.make_file_available(
-                                tarball, cache=True),
+                            chroot_type=chroot_type.rstrip('\n'),
                             user=worker.user,
                         ))
                     worker.copy_to_guest(
@@ -351,50 +366,48 @@ def run_autopkgtest(
                     suite.hierarchy[-1],
                     architecture,
                 )
-                rootfs = os.path.join(
+                rootfs = find_tarball(os.path.join(
                     storage,
                     architecture,
                     str(vendor),
                     str(suite.hierarchy[-1]),
-                    'lxc-rootfs.tar.gz')
-                meta = os.path.join(
+                    'lxc-rootfs.tar.gz'))
+                meta = find_tarball(os.path.join(
                     storage,
                     architecture,
                     str(vendor),
                     str(suite.hierarchy[-1]),
-                    'lxc-meta.tar.gz')
+                    'lxc-meta.tar.gz'))
 
                 if not os.path.exists(rootfs) or not os.path.exists(meta):
                     logger.info('Required tarball %s or %s does not exist',
                                 rootfs, meta)
-                    continue
+                    return failures
+
+                lxc_worker.provision(AUTOPKGTEST_LXC)
+
+                if 'zstd' in (get_tarball_compression(rootfs),
+                              get_tarball_compression(meta)):
+                    lxc_worker.provision(ZSTD)
 
                 worker = stack.enter_context(lxc_worker)
-                worker.check_call([
-                    'env',
-                    'DEBIAN_FRONTEND=noninteractive',
-                    'apt-get',
-                    '-y',
-                    '-t', lxc_worker.suite.apt_suite,
-                    'install',
-
-                    'autopkgtest',
-                    'lxc',
-                    'python3',
-                ])
                 set_up_lxc_net(worker, lxc_24bit_subnet)
                 worker.check_call(['mkdir', '-p',
                                    '/var/lib/lxc/vectis-new/rootfs'])
                 with open(rootfs, 'rb') as reader:
-                    worker.check_call([
-                        'tar', '-x', '-z',
-                        '-C', '/var/lib/lxc/vectis-new/rootfs',
-                        '-f', '-'], stdin=reader)
+                    worker.check_call(
+                        ['tar', '-x'] +
+                        get_tar_compress_options(
+                            get_tarball_compression(rootfs)) +
+                        ['-C', '/var/lib/lxc/vectis-new/rootfs', '-f', '-'],
+                        stdin=reader)
                 with open(meta, 'rb') as reader:
-                    worker.check_call([
-                        'tar', '-x', '-z',
-                        '-C', '/var/lib/lxc/vectis-new',
-                        '-f', '-'], stdin=reader)
+                    worker.check_call(
+                        ['tar', '-x'] +
+                        get_tar_compress_options(
+                            get_tarball_compression(meta)) +
+                        ['-C', '/var/lib/lxc/vectis-new', '-f', '-'],
+                        stdin=reader)
                 worker.check_call([
                     'mv', '/var/lib/lxc/vectis-new',
                     '/var/lib/lxc/{}'.format(container)])
@@ -430,29 +443,10 @@ def run_autopkgtest(
 
                 if not os.path.exists(tarball):
                     logger.info('Required tarball %s does not exist', tarball)
-                    continue
+                    return failures
 
+                lxd_worker.provision(AUTOPKGTEST_LXD)
                 worker = stack.enter_context(lxd_worker)
-                worker.check_call([
-                    'env',
-                    'DEBIAN_FRONTEND=noninteractive',
-                    'apt-get',
-                    '-y',
-                    '-t', lxd_worker.suite.apt_suite,
-                    'install',
-
-                    'autopkgtest',
-                    'lxd',
-                    'lxd-client',
-                    'python3',
-                ])
-                worker.check_call([
-                    'lxd',
-                    'init',
-                    '--auto',
-                    '--debug',
-                    '--verbose',
-                ])
                 set_up_lxd_net(worker, lxc_24bit_subnet)
                 worker.check_call([
                     'lxc', 'image', 'import',
@@ -465,7 +459,7 @@ def run_autopkgtest(
 
             else:
                 logger.warning('Unknown autopkgtest setup: {}'.format(test))
-                continue
+                return failures
 
             if worker is None:
                 worker = stack.enter_context(HostWorker())
@@ -495,8 +489,60 @@ def run_autopkgtest(
                     failures.append(output_dir)
 
             if output_dir is not None and output_dir != output_on_worker:
-                worker.copy_to_host(
-                    os.path.join(output_on_worker, ''),
-                    os.path.join(output_dir, ''))
+                os.makedirs(output_dir, exist_ok=True)
+                worker.copy_tree_to_host(output_on_worker, output_dir)
+
+        return failures
+
+    container_workers = {
+        'lxc': lxc_worker,
+        'lxd': lxd_worker,
+        'schroot': schroot_worker,
+    }
+
+    def run_mode_exclusively(test, memory_budget=None):
+        with ExitStack() as stack:
+            if test in container_workers:
+                stack.enter_context(
+                    _lock_container_worker(container_workers[test]))
+
+            if memory_budget is not None:
+                # Each mode starts a virtual machine, either for qemu or
+                # as the worker for a container
+                stack.enter_context(memory_budget.reserve(qemu_ram_size))
+
+            return run_mode(test)
+
+    modes = list(modes)
+    logger.info('Testing in modes: %r', modes)
+
+    if jobs is None:
+        jobs = len(modes)
+
+    if jobs <= 1 or len(modes) <= 1:
+        # A memory_budget from our caller is shared with other tests
+        # running at the same time, so it still applies
+        results = [
+            run_mode_exclusively(test, memory_budget) for test in modes]
+    else:
+        if memory_budget is None:
+            memory_budget = MemoryBudget()
+
+        logger.info('Testing up to %d modes concurrently', jobs)
+
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = [
+                executor.submit(
+                    propagate_tag(run_mode_exclusively), test, memory_budget)
+                for test in modes]
+
+        # Report the first error, and the failures, in the order the
+        # modes were listed
+        results = [future.result() for future in futures]
+
+    failures = []
+
+    for result in results:
+        failures.extend(result)
 
     return failures
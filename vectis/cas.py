@@ -0,0 +1,183 @@
+# Copyright © 2018 Simon McVittie
+# SPDX-License-Identifier: GPL-2.0+
+# (see vectis/__init__.py)
+
+import fcntl
+import logging
+import os
+import subprocess
+
+from vectis.util import (
+    cached_sha256_file,
+)
+
+logger = logging.getLogger(__name__)
+
+# The serial number of the cache disk as seen by the guest
+_SERIAL = 'vectis-cas'
+
+# Leave some space for filesystem overhead
+_USABLE = 0.9
+
+
+class CacheDisk:
+    """
+    A persistent disk image attached to workers, holding files copied
+    from the host indexed by their SHA-256, so that large files such as
+    chroot tarballs only need to be copied into a worker once.
+
+    Only one worker can use the disk at a time: this is enforced by
+    holding a lock on the image for as long as the worker is running.
+    """
+
+    def __init__(self, image, *, size):
+        self.image = image
+        self.size = size
+        self.mount_point = '/var/cache/vectis-cas'
+        self.__lock = None
+
+    @property
+    def budget(self):
+        return int(min(self.size, os.path.getsize(self.image)) * _USABLE)
+
+    def acquire(self):
+        """
+        Create the disk image if necessary and lock it. Return True on
+        success, or False if another worker is already using it.
+        """
+        os.makedirs(os.path.dirname(self.image), exist_ok=True)
+        lock = open(self.image + '.lock', 'w')
+
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            logger.info('Cache disk %s is in use by another worker',
+                        self.image)
+            lock.close()
+            return False
+
+        try:
+            if not os.path.exists(self.image):
+                self._create()
+        except Exception:
+            lock.close()
+            raise
+
+        self.__lock = lock
+        return True
+
+    def _create(self):
+        logger.info('Creating %d byte cache disk %s', self.size, self.image)
+
+        with open(self.image + '.tmp', 'wb') as writer:
+            writer.truncate(self.size)
+
+        try:
+            subprocess.check_call([
+                'mkfs.ext4', '-q', '-F', '-m', '0', '-L', _SERIAL,
+                self.image + '.tmp',
+            ])
+        except Exception:
+            os.unlink(self.image + '.tmp')
+            raise
+
+        os.rename(self.image + '.tmp', self.image)
+
+    def release(self):
+        if self.__lock is not None:
+            self.__lock.close()
+            self.__lock = None
+
+    def get_qemu_options(self):
+        return (
+            '-drive file={},format=raw,if=virtio,cache=writeback,'
+            'serial={}'.format(self.image.replace(',', ',,'), _SERIAL))
+
+    def mount(self, worker):
+        """
+        Mount the disk in worker. Return True on success.
+        """
+        status = worker.call([
+            'sh', '-euc',
+            'mkdir -p "$2"; '
+            'mountpoint -q "$2" || mount -o noatime "$1" "$2"; '
+            'rm -fr "$2/tmp"; '
+            'mkdir -p "$2/sha256" "$2/tmp"',
+            'sh', '/dev/disk/by-id/virtio-{}'.format(_SERIAL),
+            self.mount_point,
+        ])
+
+        if status != 0:
+            logger.warning('Unable to mount cache disk in %r', worker)
+            return False
+
+        return True
+
+    def make_file_available(self, worker, filename):
+        """
+        Return the path to a copy of filename in worker, copying it into
+        the cache first if necessary, or None if it cannot be cached.
+        """
+        digest = cached_sha256_file(
+            filename, os.path.join(os.path.dirname(self.image), 'digests'))
+        entry = '{}/sha256/{}'.format(self.mount_point, digest)
+        in_guest = '{}/{}'.format(entry, os.path.basename(filename))
+
+        if worker.guest_path_exists(in_guest):
+            logger.info('host:%s is already cached at guest:%s',
+                        filename, in_guest)
+            # Record the time of use for eviction
+            worker.check_call(['touch', in_guest])
+            return in_guest
+
+        size = os.path.getsize(filename)
+
+        if size > self.budget:
+            logger.info('host:%s is too large to cache', filename)
+            return None
+
+        self._evict(worker, self.budget - size)
+
+        # Other threads might be adding the same file to the cache, so
+        # copy it into a unique directory outside sha256/, which is
+        # cleaned up when the disk is next mounted
+        tmp = worker.check_output([
+            'mktemp', '-d', '-p', '{}/tmp'.format(self.mount_point),
+            '{}.XXXXXX'.format(digest),
+        ], universal_newlines=True).rstrip('\n')
+        worker.copy_to_guest(
+            filename, '{}/{}'.format(tmp, os.path.basename(filename)))
+        # Make sure we never see a partial file after a crash
+        worker.check_call(['sync'])
+        # If another thread got there first, use its copy
+        worker.check_call([
+            'sh', '-euc',
+            'mv -T "$1" "$2" 2>/dev/null || test -e "$3"; rm -fr "$1"',
+            'sh', tmp, entry, in_guest,
+        ])
+        return in_guest
+
+    def _evict(self, worker, budget):
+        """
+        Delete least recently used files from the cache until it uses
+        no more than budget bytes.
+        """
+        entries = []
+        used = 0
+
+        for line in worker.check_output([
+                'find', '{}/sha256'.format(self.mount_point),
+                '-mindepth', '2', '-maxdepth', '2', '-type', 'f',
+                '-printf', '%T@ %s %h\\n',
+        ], universal_newlines=True).splitlines():
+            mtime, size, entry = line.split(' ', 2)
+            entries.append((float(mtime), int(size), entry))
+            used += int(size)
+
+        entries.sort()
+
+        while entries and used > budget:
+            mtime, size, entry = entries.pop(0)
+            logger.info('Evicting guest:%s from cache', entry)
+            worker.check_call(['rm', '-fr', entry])
+            used -= size
@@ -13,6 +13,7 @@ from contextlib import suppress
 
 from vectis.config import (Config)
 from vectis.error import (Error)
+from vectis.util import (QEMU_IMAGE_PROFILES)
 
 logger = logging.getLogger(__name__)
 
@@ -162,6 +163,17 @@ base.add_argument(
     help='Download the given URI or ARCHIVE from its '
          'canonical URI',
 )
+base.add_argument(
+    '--tarball-compression', dest='tarball_compression',
+    choices=('gzip', 'zstd'),
+    help='Compress new chroot tarballs with gzip or multi-threaded zstd '
+         '[default: {}]'.format(args.tarball_compression),
+)
+base.add_argument(
+    '--mirror-cache', dest='mirror_cache', metavar='URI',
+    help='Download http:// URIs via "vectis mirror-cache" at URI, as '
+         'seen by workers [default: {}]'.format(args.mirror_cache),
+)
 base.add_argument(
     '--qemu-ram-size',
     help='Use this much RAM for qemu virtual machines (e.g. 512M, 1G, 4G)',
@@ -191,6 +203,12 @@ p.add_argument(
     help='Virtual machine image to create [default: {}]'.format(
         args.write_qemu_image),
 )
+p.add_argument(
+    '--image-profile', dest='qemu_image_profile',
+    choices=sorted(QEMU_IMAGE_PROFILES),
+    help='How to write the virtual machine image [default: {}]'.format(
+        args.qemu_image_profile),
+)
 p.add_argument(
     '--suite',
     help='Release suite [default: {}]'.format(args.default_suite),
@@ -226,6 +244,12 @@ p.add_argument(
     help='Virtual machine image to create [default: {}]'.format(
         args.write_qemu_image),
 )
+p.add_argument(
+    '--image-profile', dest='qemu_image_profile',
+    choices=sorted(QEMU_IMAGE_PROFILES),
+    help='How to write the virtual machine image [default: {}]'.format(
+        args.qemu_image_profile),
+)
 add_worker_options(p, context='vmdebootstrap', context_implicit=True)
 p.add_argument(
     '--suite',
@@ -253,6 +277,11 @@ p.add_argument(
     dest='_include',
     help='Add an extra package to the image (may be repeated)',
 )
+p.add_argument(
+    '--derive-from', dest='_derive_from', default=None, metavar='IMAGE',
+    help='Create a qcow2 overlay on IMAGE, a previously created image '
+         'for the same suite, instead of a standalone image',
+)
 
 help = ('Run a script or command, which may write output to ./out/ or '
         'equivalently $VECTIS_OUT or $AUTOPKGTEST_ARTIFACTS, and may '
@@ -331,6 +360,11 @@ p.add_argument(
     '--uri', dest='_uri', default=None,
     help='apt URI, e.g. http://mirror/debian [default: auto]',
 )
+p.add_argument(
+    '--refresh', action='store_true', default=False, dest='_refresh',
+    help='Upgrade the packages in the existing tarball instead of '
+         'creating a new one, if it is out of date',
+)
 
 help = 'Create a pbuilder base tarball'
 p = subparsers.add_parser(
@@ -360,6 +394,11 @@ p.add_argument(
     '--uri', dest='_uri', default=None,
     help='apt URI, e.g. http://mirror/debian [default: auto]',
 )
+p.add_argument(
+    '--refresh', action='store_true', default=False, dest='_refresh',
+    help='Upgrade the packages in the existing tarball instead of '
+         'creating a new one, if it is out of date',
+)
 
 help = 'Create a minbase tarball suitable for piuparts'
 p = subparsers.add_parser(
@@ -383,6 +422,11 @@ p.add_argument(
     '--uri', dest='_uri', default=None,
     help='apt URI, e.g. http://mirror/debian [default: auto]',
 )
+p.add_argument(
+    '--refresh', action='store_true', default=False, dest='_refresh',
+    help='Upgrade the packages in the existing tarball instead of '
+         'creating a new one, if it is out of date',
+)
 p.add_argument(
     '--suite',
     help='Release suite [default: {}]'.format(args.default_suite),
@@ -438,6 +482,95 @@ p.add_argument(
     help='apt URI, e.g. http://mirror/debian [default: auto]',
 )
 
+help = 'Run a caching HTTP proxy for apt archives'
+p = subparsers.add_parser(
+    'mirror-cache',
+    help=help, description=help,
+    argument_default=argparse.SUPPRESS,
+    parents=(base,),
+)
+p.add_argument(
+    '--listen', dest='mirror_cache_listen', metavar='HOST:PORT',
+    help='Listen on this address and TCP port [default: {}]'.format(
+        args['mirror_cache_listen']),
+)
+
+help = 'Inspect the images and tarballs in storage'
+p = subparsers.add_parser(
+    'storage',
+    help=help, description=help,
+    argument_default=argparse.SUPPRESS,
+    parents=(base,),
+)
+storage_subparsers = p.add_subparsers(
+    metavar='ACTION', dest='_storage_action')
+
+help = 'List the images and tarballs in storage'
+p = storage_subparsers.add_parser(
+    'list',
+    help=help, description=help,
+    argument_default=argparse.SUPPRESS,
+    parents=(base,),
+)
+p.add_argument(
+    '_patterns', metavar='PATTERN', nargs='*', default=[],
+    help='Only list artifacts whose path relative to the storage '
+         'directory matches one of these shell-style patterns, for '
+         'example "amd64/debian/*/sbuild.*" [default: list everything]',
+)
+p.add_argument(
+    '--packages', action='store_true', dest='_packages', default=False,
+    help='Also list the packages installed in each tarball',
+)
+p.add_argument(
+    '--json', action='store_true', dest='_json', default=False,
+    help='Output the index entries as JSON',
+)
+
+help = ('Delete old and unwanted images and tarballs from storage, and '
+        'deduplicate identical ones')
+p = storage_subparsers.add_parser(
+    'gc',
+    help=help, description=help,
+    argument_default=argparse.SUPPRESS,
+    parents=(base,),
+)
+p.add_argument(
+    '--max-size', dest='storage_max_size', metavar='SIZE',
+    help='Delete the least recently refreshed artifacts until the rest '
+         'fit in SIZE, e.g. 50G [default: {}]'.format(
+             args['storage_max_size']),
+)
+p.add_argument(
+    '--max-age', dest='storage_max_age', metavar='DAYS',
+    help='Delete artifacts that have not been refreshed for DAYS days '
+         '[default: {}]'.format(args['storage_max_age']),
+)
+p.add_argument(
+    '--dry-run', '-n', action='store_true', dest='_dry_run', default=False,
+    help="Only log what would be done",
+)
+
+help = ('Keep virtual machines booted and ready for other vectis '
+        'commands to use')
+p = subparsers.add_parser(
+    'worker-pool',
+    help=help, description=help,
+    argument_default=argparse.SUPPRESS,
+    parents=(base,),
+)
+add_worker_options(p)
+add_worker_options(p, context='sbuild')
+p.add_argument(
+    '--socket', dest='worker_pool',
+    help='Listen on this Unix socket [default: {}]'.format(args.worker_pool),
+)
+p.add_argument(
+    '--size', dest='worker_pool_size', type=int,
+    help='Number of workers of each kind to keep ready [default: {}]'.format(
+        args.worker_pool_size),
+)
+
 help = 'Build a Debian package with sbuild'
 p = subparsers.add_parser(
     'sbuild',
@@ -525,6 +658,43 @@ p.add_argument(
     '--source-apart', dest='sbuild_source_together', action='store_false',
     help='Build architecture-independent packages separately',
 )
+p.add_argument(
+    '--host-source', dest='sbuild_host_source', action='store_true',
+    help='Build the source package on the host and copy only that into '
+         'the worker',
+)
+p.add_argument(
+    '--no-host-source', dest='sbuild_host_source', action='store_false',
+    help='Copy the source tree into the worker and build the source '
+         'package there',
+)
+p.add_argument(
+    '--arch-jobs', dest='sbuild_arch_jobs', type=int, metavar='N',
+    help='Build up to N architectures of each package concurrently, '
+         'after its source package [default: {}]'.format(
+             args.sbuild_arch_jobs),
+)
+p.add_argument(
+    '--jobs', dest='sbuild_jobs', type=int, metavar='N',
+    help='Build up to N source packages concurrently, each in its own '
+         'worker [default: {}]'.format(args.sbuild_jobs),
+)
+p.add_argument(
+    '--test-jobs', dest='test_jobs', type=int, metavar='N',
+    help='Run up to N autopkgtest or piuparts tests concurrently, '
+         'alongside the builds [default: {}]'.format(args.test_jobs),
+)
+p.add_argument(
+    '--host-jobs', dest='host_jobs', type=int, metavar='N',
+    help='Run up to N commands such as lintian on the host concurrently '
+         '[default: {}]'.format(args.host_jobs),
+)
+p.add_argument(
+    '--chroot-mode', dest='sbuild_chroot_mode', choices=('file', 'overlay'),
+    help='Unpack the sbuild tarball for each build (file) or once per '
+         'worker, with an overlay for each build (overlay) '
+         '[default: {}]'.format(args.sbuild_chroot_mode),
+)
 p.add_argument(
     '--reprepro-dir', dest='_reprepro_dir', default=None,
     help='Inject built packages into this reprepro repository',
@@ -572,6 +742,12 @@ p.add_argument(
     const=(),
     help='Do not run autopkgtest after building',
 )
+p.add_argument(
+    '--autopkgtest-jobs', dest='autopkgtest_jobs', type=int, metavar='N',
+    help='Test in up to N autopkgtest modes concurrently, if there is '
+         'enough memory [default: {}]'.format(
+             args.autopkgtest_jobs or 'all'),
+)
 p.add_argument(
     '--piuparts', dest='piuparts_tarballs', nargs='?',
     metavar='TARBALL[,TARBALL]',
@@ -729,6 +905,12 @@ p.add_argument(
     const=(),
     help='Do not run autopkgtest after building',
 )
+p.add_argument(
+    '--autopkgtest-jobs', dest='autopkgtest_jobs', type=int, metavar='N',
+    help='Test in up to N autopkgtest modes concurrently, if there is '
+         'enough memory [default: {}]'.format(
+             args.autopkgtest_jobs or 'all'),
+)
 p.add_argument(
     '--piuparts', dest='piuparts_tarballs', nargs='?',
     metavar='TARBALL[,TARBALL]',
@@ -812,6 +994,12 @@ p.add_argument(
     dest='_built_binaries', default=None,
     help="Don't build and install given source package [default: if no "
          'other binaries given]')
+p.add_argument(
+    '--autopkgtest-jobs', dest='autopkgtest_jobs', type=int, metavar='N',
+    help='Test in up to N autopkgtest modes concurrently, if there is '
+         'enough memory [default: {}]'.format(
+             args.autopkgtest_jobs or 'all'),
+)
 p.add_argument(
     '_things', metavar='CHANGES_OR_DSC_OR_DIR', nargs='+', default=[],
     help='Things to test (source or binary .changes, source .dsc, etc.',
@@ -49,6 +49,7 @@ def _autopkgtest(
         *,
         architecture,
         built_binaries,
+        jobs,
         lxc_24bit_subnet,
         lxc_worker,
         lxd_worker,
@@ -113,6 +114,7 @@ def _autopkgtest(
                 built_binaries=built_binaries,
                 components=(),
                 extra_repositories=extra_repositories,
+                jobs=jobs,
                 lxc_24bit_subnet=lxc_24bit_subnet,
                 lxc_worker=lxc_worker,
                 lxd_worker=lxd_worker,
@@ -148,6 +150,7 @@ def run(args, really=True):
         mirrors=mirrors,
         storage=args.storage,
         suite=args.worker_suite,
+        **args.get_worker_options()
     )
 
     if (args.lxc_worker == args.worker and
@@ -159,6 +162,7 @@ def run(args, really=True):
             mirrors=mirrors,
             storage=args.storage,
             suite=args.lxc_worker_suite,
+            **args.get_worker_options()
         )
 
     if (args.lxd_worker == args.worker and
@@ -170,6 +174,7 @@ def run(args, really=True):
             mirrors=mirrors,
             storage=args.storage,
             suite=args.lxd_worker_suite,
+            **args.get_worker_options()
         )
 
     failures = _autopkgtest(
@@ -177,6 +182,7 @@ def run(args, really=True):
         architecture=args.architecture,
         built_binaries=args._built_binaries,
         extra_repositories=args._extra_repository,
+        jobs=args.autopkgtest_jobs,
         lxc_24bit_subnet=args.lxc_24bit_subnet,
         lxc_worker=lxc_worker,
         lxd_worker=lxd_worker,
@@ -12,9 +12,14 @@ from debian.debian_support import (
     Version,
 )
 
-from vectis.commands.new import vmdebootstrap_argv
+from vectis.commands.new import convert_image, vmdebootstrap_argv
 from vectis.error import ArgumentError
+from vectis.storage import (
+    record_image,
+    replace_image,
+)
 from vectis.worker import (
+    HostWorker,
     VirtWorker,
 )
 
@@ -31,6 +36,7 @@ def run(args):
     kernel_package = args.get_kernel_package(architecture)
     mirrors = args.get_mirrors()
     out = args.write_qemu_image
+    qemu_image_profile = args.qemu_image_profile
     qemu_image_size = args.qemu_image_size
     storage = args.storage
     vendor = args.vendor
@@ -87,12 +93,12 @@ def run(args):
         argv.append('--image={}/output.raw'.format(scratch))
 
         subprocess.check_call(argv)
-        subprocess.check_call([
-            'qemu-img', 'convert', '-f', 'raw',
-            '-O', 'qcow2', '-c', '-p',
-            '{}/output.raw'.format(scratch),
-            '{}/output.qcow2'.format(scratch),
-        ])
+
+        with HostWorker() as host:
+            convert_image(
+                host, qemu_image_profile,
+                '{}/output.raw'.format(scratch),
+                '{}/output.qcow2'.format(scratch))
 
         if out is None:
             out = os.path.join(default_dir, default_name)
@@ -124,4 +130,5 @@ def run(args):
                 os.remove(out + '.new')
             raise
         else:
-            os.rename(out + '.new', out)
+            replace_image(storage, out + '.new', out)
+            record_image(out)
@@ -8,6 +8,20 @@ import os
 from vectis.lxc import (
     set_up_lxc_net,
 )
+from vectis.provision import (
+    LXC_TARBALLS,
+    ZSTD,
+)
+from vectis.storage import (
+    DebootstrapCache,
+    get_release_info,
+    get_tarball_packages,
+    record_tarball,
+)
+from vectis.util import (
+    TARBALL_EXTENSIONS,
+    get_tar_compress_options,
+)
 from vectis.worker import (
     VirtWorker,
 )
@@ -20,6 +34,7 @@ def run(args):
         args.suite = args.default_suite
 
     architecture = args.architecture
+    components = args.components
     mirrors = args.get_mirrors()
     security_uri = args._security_uri
     storage = args.storage
@@ -30,41 +45,40 @@ def run(args):
     worker_suite = args.lxc_worker_suite
 
     apt_key_package = args.apt_key_package
+    compression = args.tarball_compression
+    debootstrap_cache = args.debootstrap_cache
+    extension = TARBALL_EXTENSIONS[compression]
     lxc_24bit_subnet = args.lxc_24bit_subnet
 
     os.makedirs(storage, exist_ok=True)
 
-    rootfs_tarball = '{arch}/{vendor}/{suite}/lxc-rootfs.tar.gz'.format(
+    rootfs_tarball = '{arch}/{vendor}/{suite}/lxc-rootfs{ext}'.format(
         arch=architecture,
+        ext=extension,
         vendor=vendor,
         suite=suite,
     )
-    meta_tarball = '{arch}/{vendor}/{suite}/lxc-meta.tar.gz'.format(
+    meta_tarball = '{arch}/{vendor}/{suite}/lxc-meta{ext}'.format(
         arch=architecture,
+        ext=extension,
         vendor=vendor,
         suite=suite,
     )
     logger.info('Creating tarballs %s, %s...', rootfs_tarball, meta_tarball)
+    release_digests, release_dates = get_release_info(mirrors, suite)
+    recipes = [LXC_TARBALLS]
+
+    if compression == 'zstd':
+        recipes.append(ZSTD)
 
     with VirtWorker(
             worker_argv,
             mirrors=mirrors,
+            recipes=recipes,
             storage=storage,
             suite=worker_suite,
+            **args.get_worker_options()
     ) as worker:
-        logger.info('Installing debootstrap etc.')
-        worker.check_call([
-            'env',
-            'DEBIAN_FRONTEND=noninteractive',
-            'apt-get',
-            '-y',
-            '-t', worker_suite.apt_suite,
-            'install',
-
-            'debootstrap',
-            'lxc',
-            'python3',
-        ])
         set_up_lxc_net(worker, lxc_24bit_subnet)
 
         # FIXME: The lxc templates only allow installing the apt keyring
@@ -94,8 +108,16 @@ def run(args):
         if security_uri is None:
             security_uri = mirrors.lookup_suite(security_suite)
 
-        argv = [
-            'env', 'DEBIAN_FRONTEND=noninteractive',
+        cache = DebootstrapCache(storage, architecture)
+        argv = ['env', 'DEBIAN_FRONTEND=noninteractive']
+
+        if debootstrap_cache:
+            cache.copy_to_guest(worker)
+            # The lxc templates run debootstrap themselves, so put a
+            # wrapper that uses the cache first in their PATH
+            argv.append('PATH={}'.format(cache.write_wrapper(worker)))
+
+        argv += [
             worker.command_wrapper,
             '--',
             'lxc-create',
@@ -112,33 +134,48 @@ def run(args):
             argv.append('--variant=minbase')
 
         worker.check_call(argv)
+        cache.copy_to_host(worker)
 
+        compress_options = get_tar_compress_options(compression)
         worker.check_call([
             'tar', '-C',
             '/var/lib/lxc/{}-{}-{}/rootfs'.format(vendor, suite, architecture),
-            '-f', '{}/rootfs.tar.gz'.format(worker.scratch),
+            '-f', '{}/rootfs{}'.format(worker.scratch, extension),
             '--exclude=./var/cache/apt/archives/*.deb',
-            '-z', '-c', '.',
-        ])
+        ] + compress_options + ['-c', '.'])
         worker.check_call([
             'tar', '-C',
             '/var/lib/lxc/{}-{}-{}'.format(vendor, suite, architecture),
-            '-f', '{}/meta.tar.gz'.format(worker.scratch),
-            '-z', '-c', 'config',
-        ])
+            '-f', '{}/meta{}'.format(worker.scratch, extension),
+        ] + compress_options + ['-c', 'config'])
+
+        packages = get_tarball_packages(
+            worker, '{}/rootfs{}'.format(worker.scratch, extension),
+            compression=compression)
 
         out = os.path.join(storage, rootfs_tarball)
         os.makedirs(os.path.dirname(out) or os.curdir, exist_ok=True)
         worker.copy_to_host(
-            '{}/rootfs.tar.gz'.format(worker.scratch), out + '.new')
+            '{}/rootfs{}'.format(worker.scratch, extension), out + '.new')
         # FIXME: smoke-test it?
         os.rename(out + '.new', out)
+        record_tarball(
+            out,
+            components=components,
+            packages=packages,
+            release_dates=release_dates,
+            release_digests=release_digests)
 
         out = os.path.join(storage, meta_tarball)
         os.makedirs(os.path.dirname(out) or os.curdir, exist_ok=True)
         worker.copy_to_host(
-            '{}/meta.tar.gz'.format(worker.scratch), out + '.new')
+            '{}/meta{}'.format(worker.scratch, extension), out + '.new')
         # FIXME: smoke-test it?
         os.rename(out + '.new', out)
+        record_tarball(
+            out,
+            components=components,
+            release_dates=release_dates,
+            release_digests=release_digests)
 
     logger.info('Created tarballs %s, %s', rootfs_tarball, meta_tarball)
@@ -8,6 +8,9 @@ import os
 from vectis.lxc import (
     set_up_lxd_net,
 )
+from vectis.provision import (
+    LXD_TARBALL,
+)
 from vectis.worker import (
     VirtWorker,
 )
@@ -44,31 +47,11 @@ def run(args):
     with VirtWorker(
             worker_argv,
             mirrors=mirrors,
+            recipes=[LXD_TARBALL],
             storage=storage,
             suite=worker_suite,
+            **args.get_worker_options()
     ) as worker:
-        logger.info('Installing debootstrap etc.')
-        worker.check_call([
-            'env',
-            'DEBIAN_FRONTEND=noninteractive',
-            'apt-get',
-            '-y',
-            '-t', worker_suite.apt_suite,
-            'install',
-
-            'autopkgtest',
-            'debootstrap',
-            'lxd',
-            'lxd-client',
-            'python3',
-        ])
-        worker.check_call([
-            'lxd',
-            'init',
-            '--auto',
-            '--debug',
-            '--verbose',
-        ])
         set_up_lxd_net(worker, lxc_24bit_subnet)
 
         worker.check_call([
@@ -10,6 +10,22 @@ from debian.debian_support import (
 )
 
 from vectis.error import ArgumentError
+from vectis.provision import (
+    MINBASE_TARBALL,
+    ZSTD,
+)
+from vectis.storage import (
+    DebootstrapCache,
+    get_release_info,
+    get_tarball_packages,
+    is_up_to_date,
+    record_tarball,
+    refresh_tarball,
+)
+from vectis.util import (
+    TARBALL_EXTENSIONS,
+    get_tar_compress_options,
+)
 from vectis.worker import (
     VirtWorker,
 )
@@ -25,7 +41,9 @@ def run(args):
             raise ArgumentError('--suite must be specified')
 
     architecture = args.architecture
+    components = args.components
     mirrors = args.get_mirrors()
+    refresh = args._refresh
     storage = args.storage
     suite = args.suite
     uri = args._uri
@@ -35,6 +53,8 @@ def run(args):
 
     apt_key = args.apt_key
     apt_key_package = args.apt_key_package
+    compression = args.tarball_compression
+    debootstrap_cache = args.debootstrap_cache
 
     os.makedirs(storage, exist_ok=True)
 
@@ -53,34 +73,36 @@ def run(args):
     else:
         basename = 'minbase'
 
-    minbase_tarball = '{arch}/{vendor}/{suite}/{basename}.tar.gz'.format(
+    minbase_tarball = '{arch}/{vendor}/{suite}/{basename}{ext}'.format(
         arch=architecture,
         basename=basename,
+        ext=TARBALL_EXTENSIONS[compression],
         vendor=vendor,
         suite=suite,
     )
+    release_digests, release_dates = get_release_info(mirrors, suite)
+
+    if refresh and is_up_to_date(
+            os.path.join(storage, minbase_tarball),
+            components=components,
+            release_digests=release_digests):
+        logger.info('Tarball %s is up to date', minbase_tarball)
+        return
+
     logger.info('Creating tarball %s...', minbase_tarball)
+    recipes = [MINBASE_TARBALL]
+
+    if compression == 'zstd':
+        recipes.append(ZSTD)
 
     with VirtWorker(
             worker_argv,
             mirrors=mirrors,
+            recipes=recipes,
             storage=storage,
             suite=worker_suite,
+            **args.get_worker_options()
     ) as worker:
-        logger.info('Installing debootstrap')
-        worker.check_call([
-            'env',
-            'DEBIAN_FRONTEND=noninteractive',
-            'apt-get',
-            '-y',
-            '-t', worker_suite.apt_suite,
-            '--no-install-recommends',
-            'install',
-
-            'debootstrap',
-            'python3',
-        ])
-
         debootstrap_version = worker.dpkg_version('debootstrap')
 
         if apt_key_package is not None:
@@ -96,64 +118,98 @@ def run(args):
                 apt_key_package,
             ])
 
-        debootstrap_args = []
-
-        if worker.call(['test', '-f', apt_key]) == 0:
-            logger.info('Found apt key worker:{}'.format(apt_key))
-            debootstrap_args.append('--keyring={}'.format(apt_key))
-        elif os.path.exists(apt_key):
-            logger.info('Found apt key host:{}, copying to worker:{}'.format(
-                apt_key, '{}/apt-key.gpg'.format(worker.scratch)))
-            worker.copy_to_guest(
-                apt_key, '{}/apt-key.gpg'.format(worker.scratch))
-            debootstrap_args.append('--keyring={}/apt-key.gpg'.format(
-                worker.scratch))
-        else:
-            logger.warning(
-                'Apt key host:{} not found; leaving it out and hoping for the '
-                'best'.format(apt_key))
-
-        debootstrap_args.append('--components={}'.format(
-            ','.join(args.components)))
-
-        if debootstrap_version >= Version('1.0.86~'):
-            if args._merged_usr:
-                debootstrap_args.append('--merged-usr')
+        output = '{}/output{}'.format(
+            worker.scratch, TARBALL_EXTENSIONS[compression])
+        out = os.path.join(storage, minbase_tarball)
+        refreshed = False
+
+        if refresh and os.path.exists(out):
+            try:
+                refresh_tarball(
+                    worker, out, output, compression=compression)
+            except Exception as e:
+                logger.warning(
+                    'Unable to refresh %s, creating it from scratch: %s',
+                    minbase_tarball, e)
             else:
-                # piuparts really doesn't like merged /usr
-                debootstrap_args.append('--no-merged-usr')
-
-        worker.check_call([
-            'env', 'DEBIAN_FRONTEND=noninteractive',
-            worker.command_wrapper,
-            '--',
-            'debootstrap',
-            '--arch={}'.format(architecture),
-            '--components={}'.format(','.join(args.components)),
-            '--variant=minbase',
-            '--verbose',
-        ] + debootstrap_args + [
-            str(suite),
-            '{}/chroot'.format(worker.scratch),
-            uri,
-            '/usr/share/debootstrap/scripts/{}'.format(
-                args.debootstrap_script),
-        ])
-        worker.check_call([
-            'chroot', '{}/chroot'.format(worker.scratch),
-            'apt-get', 'clean',
-        ])
-        worker.check_call([
-            'tar', '-C', '{}/chroot'.format(worker.scratch),
-            '-f', '{}/output.tar.gz'.format(worker.scratch),
-            '-z', '-c', '.',
-        ])
+                refreshed = True
+
+        if not refreshed:
+            debootstrap_args = []
+
+            if worker.call(['test', '-f', apt_key]) == 0:
+                logger.info('Found apt key worker:{}'.format(apt_key))
+                debootstrap_args.append('--keyring={}'.format(apt_key))
+            elif os.path.exists(apt_key):
+                logger.info(
+                    'Found apt key host:{}, copying to worker:{}'.format(
+                        apt_key, '{}/apt-key.gpg'.format(worker.scratch)))
+                worker.copy_to_guest(
+                    apt_key, '{}/apt-key.gpg'.format(worker.scratch))
+                debootstrap_args.append('--keyring={}/apt-key.gpg'.format(
+                    worker.scratch))
+            else:
+                logger.warning(
+                    'Apt key host:{} not found; leaving it out and hoping '
+                    'for the best'.format(apt_key))
+
+            debootstrap_args.append('--components={}'.format(
+                ','.join(components)))
+
+            if debootstrap_version >= Version('1.0.86~'):
+                if args._merged_usr:
+                    debootstrap_args.append('--merged-usr')
+                else:
+                    # piuparts really doesn't like merged /usr
+                    debootstrap_args.append('--no-merged-usr')
+
+            cache = DebootstrapCache(storage, architecture)
+
+            if debootstrap_cache:
+                cache.copy_to_guest(worker)
+
+            debootstrap_args.extend(cache.debootstrap_options)
+            worker.check_call([
+                'env', 'DEBIAN_FRONTEND=noninteractive',
+                worker.command_wrapper,
+                '--',
+                'debootstrap',
+                '--arch={}'.format(architecture),
+                '--components={}'.format(','.join(components)),
+                '--variant=minbase',
+                '--verbose',
+            ] + debootstrap_args + [
+                str(suite),
+                '{}/chroot'.format(worker.scratch),
+                uri,
+                '/usr/share/debootstrap/scripts/{}'.format(
+                    args.debootstrap_script),
+            ])
+            cache.copy_to_host(worker)
+            worker.check_call([
+                'chroot', '{}/chroot'.format(worker.scratch),
+                'apt-get', 'clean',
+            ])
+            worker.check_call([
+                'tar', '-C', '{}/chroot'.format(worker.scratch),
+                '-f', output,
+            ] + get_tar_compress_options(compression) + ['-c', '.'])
 
-        out = os.path.join(storage, minbase_tarball)
         os.makedirs(os.path.dirname(out) or os.curdir, exist_ok=True)
-        worker.copy_to_host(
-            '{}/output.tar.gz'.format(worker.scratch), out + '.new')
+        packages = get_tarball_packages(
+            worker, output, compression=compression)
+        worker.copy_to_host(output, out + '.new')
         # FIXME: smoke-test it?
         os.rename(out + '.new', out)
-
-    logger.info('Created tarball %s', minbase_tarball)
+        record_tarball(
+            out,
+            components=components,
+            packages=packages,
+            refreshed=refreshed,
+            release_dates=release_dates,
+            release_digests=release_digests)
+
+    if refreshed:
+        logger.info('Refreshed tarball %s', minbase_tarball)
+    else:
+        logger.info('Created tarball %s', minbase_tarball)
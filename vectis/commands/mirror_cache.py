@@ -0,0 +1,36 @@
+# Copyright © 2018 Simon McVittie
+# SPDX-License-Identifier: GPL-2.0+
+# (see vectis/__init__.py)
+
+import logging
+import os
+
+from vectis.mirrorcache import (
+    MirrorCache,
+    MirrorCacheServer,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def run(args):
+    directory = os.path.join(args.storage, 'mirror-cache')
+    os.makedirs(directory, exist_ok=True)
+
+    server = MirrorCacheServer(
+        args.mirror_cache_listen, MirrorCache(directory))
+
+    try:
+        logger.info('Caching apt archives in %s', directory)
+        logger.info('Listening on http://%s:%d/',
+                    *server.server_address[:2])
+
+        if args.mirror_cache is None:
+            logger.warning(
+                'Set mirror_cache to the URI at which workers can reach '
+                'this proxy, for example http://10.0.2.2:%d',
+                server.server_address[1])
+
+        server.serve_forever()
+    finally:
+        server.server_close()
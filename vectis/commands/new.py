@@ -5,19 +5,50 @@
 import logging
 import os
 import subprocess
+import time
+from tempfile import TemporaryDirectory
 
 from debian.debian_support import (
     Version,
 )
 
 from vectis.error import ArgumentError
+from vectis.storage import (
+    DebootstrapCache,
+    create_derived_image,
+    record_image,
+    replace_image,
+)
+from vectis.util import (
+    get_qemu_img_convert_argv,
+)
 from vectis.worker import (
+    HostWorker,
     VirtWorker,
 )
 
 logger = logging.getLogger(__name__)
 
 
+def convert_image(worker, profile, source, dest):
+    """
+    Convert the raw disk image source into the qcow2 image dest on
+    worker, using profile from QEMU_IMAGE_PROFILES, and report how long
+    that took and how large the result is.
+    """
+    start = time.monotonic()
+    worker.check_call(get_qemu_img_convert_argv(profile, source, dest))
+    seconds = time.monotonic() - start
+
+    size, blocks, block_size = worker.check_output(
+        ['stat', '-c', '%s %b %B', dest],
+        universal_newlines=True).split()
+    logger.info(
+        'Created %s image in %.1f seconds: %.1f MiB, %.1f MiB allocated',
+        profile, seconds, int(size) / (1024 * 1024),
+        int(blocks) * int(block_size) / (1024 * 1024))
+
+
 def vmdebootstrap_argv(
         version,
         *,
@@ -115,6 +146,67 @@ def new_ubuntu_cloud(
         return image, out
 
 
+def derive(
+        *,
+        base,
+        default_dir,
+        include=(),
+        merged_usr,
+        mirrors,
+        out,
+        storage,
+        suite):
+    """
+    Create a qcow2 overlay on the existing image base, and install
+    include into it, plus usrmerge if merged_usr is true.
+    """
+    if out is None:
+        if merged_usr:
+            out = os.path.join(default_dir, 'autopkgtest-merged-usr.qcow2')
+        else:
+            raise ArgumentError(
+                '--qemu-image must be specified with --derive-from')
+
+    if os.path.abspath(out) == os.path.abspath(base):
+        raise ArgumentError(
+            'Cannot derive {} from itself'.format(base))
+
+    packages = list(include)
+
+    if merged_usr:
+        packages.append('usrmerge')
+
+    os.makedirs(os.path.dirname(out) or os.curdir, exist_ok=True)
+    logger.info('Deriving %s from %s', out, base)
+    create_derived_image(base, out + '.new')
+
+    try:
+        with VirtWorker(
+                ['qemu', out + '.new'],
+                mirrors=mirrors,
+                storage=storage,
+                suite=suite,
+        ) as worker:
+            if packages:
+                worker.check_call([
+                    'env',
+                    'DEBIAN_FRONTEND=noninteractive',
+                    'apt-get',
+                    '-y',
+                    '-t', suite.apt_suite,
+                    'install',
+                ] + packages)
+                # Keep the overlay small
+                worker.check_call(['apt-get', 'clean'])
+
+            worker.commit_disk()
+    except Exception:
+        os.remove(out + '.new')
+        raise
+
+    return out + '.new', out
+
+
 def new(
         *,
         apt_key,
@@ -122,18 +214,24 @@ def new(
         architecture,
         components,
         default_dir,
+        debootstrap_cache=True,
         include=(),
         kernel_package,
         merged_usr,
         mirrors,
         out,
+        qemu_image_profile,
         qemu_image_size,
         storage,
         suite,
         uri,
         vmdebootstrap_options,
         vmdebootstrap_worker,
-        vmdebootstrap_worker_suite):
+        vmdebootstrap_worker_suite,
+        worker_options=None):
+
+    if worker_options is None:
+        worker_options = {}
 
     for suite in (vmdebootstrap_worker_suite, suite):
         for ancestor in suite.hierarchy:
@@ -147,6 +245,7 @@ def new(
             mirrors=mirrors,
             storage=storage,
             suite=vmdebootstrap_worker_suite,
+            **worker_options
     ) as worker:
         worker.check_call([
             'env', 'DEBIAN_FRONTEND=noninteractive',
@@ -165,6 +264,8 @@ def new(
         optional_worker_packages = [
             'extlinux',
             'mbr',
+            # Faster compression when copying the image to the host
+            'zstd',
         ]
 
         keyring = apt_key_package
@@ -225,6 +326,12 @@ def new(
             logger.warning('Apt key host:{} not found; leaving it out and '
                            'hoping for the best'.format(apt_key))
 
+        cache = DebootstrapCache(storage, architecture)
+
+        if debootstrap_cache:
+            cache.copy_to_guest(worker)
+            debootstrap_args.append('cache-dir={}'.format(cache.in_guest))
+
         if debootstrap_args:
             argv.append('--debootstrapopts={}'.format(
                 ' '.join(debootstrap_args)))
@@ -242,20 +349,25 @@ def new(
             '--customize={}/setup-testbed'.format(worker.scratch),
             '--image={}/output.raw'.format(worker.scratch),
         ])
-
-        worker.check_call([
-            'qemu-img', 'convert', '-f', 'raw', '-O',
-            'qcow2', '-c', '-p',
-            '{}/output.raw'.format(worker.scratch),
-            '{}/output.qcow2'.format(worker.scratch),
-        ])
+        cache.copy_to_host(worker)
 
         if out is None:
             out = os.path.join(default_dir, default_name)
 
-        os.makedirs(os.path.dirname(out) or os.curdir, exist_ok=True)
-        worker.copy_to_host(
-            '{}/output.qcow2'.format(worker.scratch), out + '.new')
+        out_dir = os.path.dirname(out) or os.curdir
+        os.makedirs(out_dir, exist_ok=True)
+
+        # Only the allocated parts of the raw image are transferred;
+        # converting it on the host avoids copying the qcow2 image
+        # across the virtualization channel as well
+        with TemporaryDirectory(prefix='.vectis-new-', dir=out_dir) as tmp:
+            worker.copy_sparse_file_to_host(
+                '{}/output.raw'.format(worker.scratch), tmp)
+
+            with HostWorker() as host:
+                convert_image(
+                    host, qemu_image_profile,
+                    os.path.join(tmp, 'output.raw'), out + '.new')
 
     return out + '.new', out
 
@@ -276,6 +388,7 @@ def run(args):
     include = args._include
     mirrors = args.get_mirrors()
     out = args.write_qemu_image
+    qemu_image_profile = args.qemu_image_profile
     qemu_image_size = args.qemu_image_size
     storage = args.storage
     uri = args._uri
@@ -286,11 +399,30 @@ def run(args):
     vmdebootstrap_worker_suite = args.vmdebootstrap_worker_suite
     default_dir = os.path.join(
         storage, architecture, str(vendor), str(suite))
+    derive_from = args._derive_from
 
     if uri is None:
         uri = mirrors.lookup_suite(suite)
 
-    if False:
+    if derive_from is not None and not os.path.exists(derive_from):
+        derive_from = os.path.join(default_dir, derive_from)
+
+        if not os.path.exists(derive_from):
+            raise ArgumentError(
+                'Base image {} not found'.format(args._derive_from))
+
+    if derive_from is not None:
+        created, out = derive(
+            base=derive_from,
+            default_dir=default_dir,
+            include=include,
+            merged_usr=args._merged_usr,
+            mirrors=mirrors,
+            out=out,
+            storage=storage,
+            suite=suite,
+        )
+    elif False:
         created, out = new_ubuntu_cloud(
             architecture=architecture,
             default_dir=default_dir,
@@ -306,12 +438,14 @@ def run(args):
             apt_key_package=apt_key_package,
             architecture=architecture,
             components=components,
+            debootstrap_cache=args.debootstrap_cache,
             default_dir=default_dir,
             kernel_package=kernel_package,
             include=include,
             merged_usr=args._merged_usr,
             mirrors=mirrors,
             out=out,
+            qemu_image_profile=qemu_image_profile,
             qemu_image_size=qemu_image_size,
             storage=storage,
             suite=suite,
@@ -319,6 +453,7 @@ def run(args):
             vmdebootstrap_options=vmdebootstrap_options,
             vmdebootstrap_worker=vmdebootstrap_worker,
             vmdebootstrap_worker_suite=vmdebootstrap_worker_suite,
+            worker_options=args.get_worker_options(),
         )
 
     try:
@@ -351,4 +486,11 @@ def run(args):
 
         raise
     else:
-        os.rename(created, out)
+        replace_image(storage, created, out)
+
+        if derive_from is not None:
+            record_image(
+                out, base=derive_from, include=include,
+                merged_usr=args._merged_usr)
+        else:
+            record_image(out)
@@ -163,6 +163,7 @@ def run(args):
         storage=args.storage,
         suite=args.suite,
         vendor=args.vendor,
+        worker_options=args.get_worker_options(),
     )
 
     group.select_suites(args)
@@ -215,6 +216,7 @@ def run(args):
     try:
         group.autopkgtest(
             default_architecture=pbuilder_worker.dpkg_architecture,
+            jobs=args.autopkgtest_jobs,
             lxc_24bit_subnet=args.lxc_24bit_subnet,
             lxc_worker=lxc_worker,
             lxd_worker=lxd_worker,
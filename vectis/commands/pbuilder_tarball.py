@@ -8,11 +8,24 @@ import textwrap
 from tempfile import TemporaryDirectory
 
 from vectis.error import ArgumentError
+from vectis.provision import (
+    PBUILDER_TARBALL,
+    ZSTD,
+)
+from vectis.storage import (
+    DebootstrapCache,
+    get_release_info,
+    get_tarball_packages,
+    is_up_to_date,
+    record_tarball,
+)
 from vectis.worker import (
     VirtWorker,
 )
 from vectis.util import (
     AtomicWriter,
+    TARBALL_EXTENSIONS,
+    get_pbuilder_compress_options,
 )
 
 logger = logging.getLogger(__name__)
@@ -30,6 +43,7 @@ def run(args):
     components = args.components
     keep = args._keep
     mirrors = args.get_mirrors()
+    refresh = args._refresh
     storage = args.storage
     suite = args.suite
     test_package = args._test_package
@@ -41,6 +55,8 @@ def run(args):
     # From configuration
     apt_key = args.apt_key
     apt_key_package = args.apt_key_package
+    compression = args.tarball_compression
+    debootstrap_cache = args.debootstrap_cache
 
     os.makedirs(storage, exist_ok=True)
 
@@ -54,34 +70,35 @@ def run(args):
     if uri is None:
         uri = mirrors.lookup_suite(suite)
 
-    tarball = '{arch}/{vendor}/{suite}/pbuilder.tar.gz'.format(
+    tarball = '{arch}/{vendor}/{suite}/pbuilder{ext}'.format(
         arch=architecture,
+        ext=TARBALL_EXTENSIONS[compression],
         vendor=vendor,
         suite=suite,
     )
+    release_digests, release_dates = get_release_info(mirrors, suite)
+
+    if refresh and is_up_to_date(
+            os.path.join(storage, tarball),
+            components=components,
+            release_digests=release_digests):
+        logger.info('Tarball %s is up to date', tarball)
+        return
+
     logger.info('Creating tarball %s...', tarball)
+    recipes = [PBUILDER_TARBALL]
+
+    if compression == 'zstd':
+        recipes.append(ZSTD)
 
     with VirtWorker(
             worker_argv,
             mirrors=mirrors,
+            recipes=recipes,
             storage=storage,
             suite=worker_suite,
+            **args.get_worker_options()
     ) as worker:
-        logger.info('Installing debootstrap and pbuilder')
-        worker.check_call([
-            'env',
-            'DEBIAN_FRONTEND=noninteractive',
-            'apt-get',
-            '-y',
-            '--no-install-recommends',
-            '-t', worker_suite.apt_suite,
-            'install',
-
-            'debootstrap',
-            'python3',
-            'pbuilder',
-        ])
-
         keyring = apt_key_package
 
         if keyring is not None:
@@ -97,52 +114,90 @@ def run(args):
                 keyring,
             ])
 
-        pbuilder_args = [
-            'create',
-            '--aptcache', '',
-            '--architecture', architecture,
-            '--components', ' '.join(components),
-            '--basetgz', '{}/output.tar.gz'.format(worker.scratch),
-            '--mirror', uri,
-            '--distribution', str(suite),
-        ]
-        debootstrap_args = []
-
-        if worker.call(['test', '-f', apt_key]) == 0:
-            logger.info('Found apt key worker:{}'.format(apt_key))
-            pbuilder_args.append('--keyring')
-            pbuilder_args.append(apt_key)
-            debootstrap_args.append('--keyring={}'.format(apt_key))
-        elif os.path.exists(apt_key):
-            logger.info('Found apt key host:{}, copying to worker:{}'.format(
-                apt_key, '{}/apt-key.gpg'.format(worker.scratch)))
-            worker.copy_to_guest(
-                apt_key, '{}/apt-key.gpg'.format(worker.scratch))
-            pbuilder_args.append('--keyring')
-            pbuilder_args.append('{}/apt-key.gpg'.format(worker.scratch))
-            debootstrap_args.append('--keyring={}/apt-key.gpg'.format(
-                worker.scratch))
-        else:
-            logger.warning(
-                'Apt key host:{} not found; leaving it out and hoping '
-                'for the best'.format(apt_key))
-
-        for arg in debootstrap_args:
-            pbuilder_args.append('--debootstrapopts')
-            pbuilder_args.append(arg)
+        output = '{}/output{}'.format(
+            worker.scratch, TARBALL_EXTENSIONS[compression])
+        compress_options = get_pbuilder_compress_options(compression)
+        out = os.path.join(storage, tarball)
+        refreshed = False
 
         worker.check_call([
             'touch', '/root/.pbuilderrc',
         ])
-        logger.info('pbuilder %r', pbuilder_args)
-        worker.check_call([
-            'env', 'DEBIAN_FRONTEND=noninteractive',
-            worker.command_wrapper,
-            '--',
-            'pbuilder',
-        ] + pbuilder_args)
 
-        out = os.path.join(storage, tarball)
+        if refresh and os.path.exists(out):
+            logger.info('Refreshing %s', tarball)
+            worker.copy_to_guest(out, output)
+
+            try:
+                worker.check_call([
+                    'env', 'DEBIAN_FRONTEND=noninteractive',
+                    worker.command_wrapper,
+                    '--',
+                    'pbuilder',
+                    'update',
+                    '--aptcache', '',
+                    '--basetgz', output,
+                ] + compress_options)
+            except Exception as e:
+                logger.warning(
+                    'Unable to refresh %s, creating it from scratch: %s',
+                    tarball, e)
+                worker.check_call(['rm', '-f', output])
+            else:
+                refreshed = True
+
+        if not refreshed:
+            pbuilder_args = [
+                'create',
+                '--aptcache', '',
+                '--architecture', architecture,
+                '--components', ' '.join(components),
+                '--basetgz', output,
+                '--mirror', uri,
+                '--distribution', str(suite),
+            ] + compress_options
+            debootstrap_args = []
+
+            if worker.call(['test', '-f', apt_key]) == 0:
+                logger.info('Found apt key worker:{}'.format(apt_key))
+                pbuilder_args.append('--keyring')
+                pbuilder_args.append(apt_key)
+                debootstrap_args.append('--keyring={}'.format(apt_key))
+            elif os.path.exists(apt_key):
+                logger.info(
+                    'Found apt key host:{}, copying to worker:{}'.format(
+                        apt_key, '{}/apt-key.gpg'.format(worker.scratch)))
+                worker.copy_to_guest(
+                    apt_key, '{}/apt-key.gpg'.format(worker.scratch))
+                pbuilder_args.append('--keyring')
+                pbuilder_args.append('{}/apt-key.gpg'.format(worker.scratch))
+                debootstrap_args.append('--keyring={}/apt-key.gpg'.format(
+                    worker.scratch))
+            else:
+                logger.warning(
+                    'Apt key host:{} not found; leaving it out and hoping '
+                    'for the best'.format(apt_key))
+
+            cache = DebootstrapCache(storage, architecture)
+
+            if debootstrap_cache:
+                cache.copy_to_guest(worker)
+
+            debootstrap_args.extend(cache.debootstrap_options)
+
+            for arg in debootstrap_args:
+                pbuilder_args.append('--debootstrapopts')
+                pbuilder_args.append(arg)
+
+            logger.info('pbuilder %r', pbuilder_args)
+            worker.check_call([
+                'env', 'DEBIAN_FRONTEND=noninteractive',
+                worker.command_wrapper,
+                '--',
+                'pbuilder',
+            ] + pbuilder_args)
+            cache.copy_to_host(worker)
+
         os.makedirs(os.path.dirname(out) or os.curdir, exist_ok=True)
 
         # Smoke-test the new tarball before being prepared to use it.
@@ -178,8 +233,9 @@ def run(args):
                         'pbuilder',
                         'execute',
                         '--aptcache', '',
-                        '--basetgz', '{}/output.tar.gz'.format(worker.scratch),
+                        '--basetgz', output,
                         '--bindmounts', '{}'.format(worker.scratch),
+                    ] + compress_options + [
                         '--',
                         '{}/script'.format(worker.scratch),
                         test_package,
@@ -196,19 +252,29 @@ def run(args):
                     'pbuilder',
                     'build',
                     '--aptcache', '',
-                    '--basetgz', '{}/output.tar.gz'.format(worker.scratch),
+                    '--basetgz', output,
+                ] + compress_options + [
                     '{}.dsc'.format(test_package),
                 ])
             except Exception:
                 if keep:
-                    worker.copy_to_host(
-                        '{}/output.tar.gz'.format(worker.scratch),
-                        out + '.new')
+                    worker.copy_to_host(output, out + '.new')
 
                 raise
 
-        worker.copy_to_host(
-            '{}/output.tar.gz'.format(worker.scratch), out + '.new')
+        packages = get_tarball_packages(
+            worker, output, compression=compression)
+        worker.copy_to_host(output, out + '.new')
         os.rename(out + '.new', out)
+        record_tarball(
+            out,
+            components=components,
+            packages=packages,
+            refreshed=refreshed,
+            release_dates=release_dates,
+            release_digests=release_digests)
 
-    logger.info('Created tarball %s', tarball)
+    if refreshed:
+        logger.info('Refreshed tarball %s', tarball)
+    else:
+        logger.info('Created tarball %s', tarball)
@@ -81,6 +81,7 @@ def run(args):
         mirrors=args.get_mirrors(),
         storage=args.storage,
         suite=args.piuparts_worker_suite,
+        **args.get_worker_options()
     )
     failures = _piuparts(
         args._things,
@@ -72,6 +72,7 @@ def run(args):
             mirrors=mirrors,
             storage=storage,
             suite=suite,
+            **args.get_worker_options()
     ) as worker:
         worker_input = worker.scratch + '/in'
         temp = worker.scratch + '/tmp'
@@ -106,8 +107,7 @@ def run(args):
 
         if input_ is not None:
             if os.path.isdir(input_):
-                worker.copy_to_guest(
-                    os.path.join(input_, ''), worker_input + '/')
+                worker.copy_tree_to_guest(input_, worker_input)
             else:
                 worker_input = worker_input + '/' + os.path.basename(input_)
                 worker.copy_to_guest(input_, worker_input)
@@ -125,7 +125,6 @@ def run(args):
                 logger.info('Command produced no artifacts')
                 os.rmdir(output_dir)
             else:
-                worker.copy_to_host(
-                    artifacts + '/', os.path.join(output_dir, ''))
+                worker.copy_tree_to_host(artifacts, output_dir)
                 logger.info(
                     'Artifacts produced by command are in %s', output_dir)
@@ -2,9 +2,12 @@
 # SPDX-License-Identifier: GPL-2.0+
 # (see vectis/__init__.py)
 
+import functools
 import logging
 import os
 import subprocess
+import sys
+import threading
 
 from vectis.config import (
     Suite,
@@ -15,9 +18,21 @@ from vectis.debuild import (
 from vectis.error import (
     ArgumentError,
 )
+from vectis.scheduler import (
+    Scheduler,
+)
+from vectis.trace import (
+    OperationTrace,
+)
+from vectis.util import (
+    MemoryBudget,
+)
 
 logger = logging.getLogger(__name__)
 
+# Keeps the lintian reports of concurrent tasks from being interleaved
+_output_lock = threading.Lock()
+
 
 def _summarize(buildables):
     for buildable in buildables:
@@ -39,8 +54,16 @@ def _lintian(buildables):
         # Run lintian near the end for better visibility
         for x in 'source+binary', 'binary', 'source':
             if x in buildable.merged_changes:
-                subprocess.call(
-                    ['lintian', '-I', '-i', buildable.merged_changes[x]])
+                report = subprocess.run(
+                    ['lintian', '-I', '-i', buildable.merged_changes[x]],
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.STDOUT,
+                ).stdout
+
+                with _output_lock:
+                    sys.stdout.flush()
+                    sys.stdout.buffer.write(report)
+                    sys.stdout.flush()
 
                 break
 
@@ -74,6 +97,22 @@ def _publish(
                 break
 
 
+def _write_traces(buildables, trace):
+    for buildable in buildables:
+        if (buildable.output_dir is None or
+                not os.path.isdir(buildable.output_dir)):
+            continue
+
+        if len(buildables) == 1:
+            tag = ...
+        else:
+            tag = str(buildable)
+
+        trace.write(
+            os.path.join(buildable.output_dir, 'vectis-trace.jsonl'),
+            tag=tag)
+
+
 def run(args):
     deb_build_options = set()
 
@@ -142,24 +181,36 @@ def run(args):
     for pattern in args.dpkg_source_extend_diff_ignore:
         ds_options.append('--extend-diff-ignore={}'.format(pattern))
 
+    trace = OperationTrace()
+    worker_options = args.get_worker_options()
+    worker_options['trace'] = trace
+
     group = BuildGroup(
+        arch_jobs=args.sbuild_arch_jobs,
         binary_version_suffix=args._append_to_version,
         buildables=(args._buildables or '.'),
+        chroot_mode=args.sbuild_chroot_mode,
         components=args.components,
         deb_build_options=deb_build_options,
         dpkg_buildpackage_options=db_options,
         dpkg_source_options=ds_options,
         extra_repositories=args._extra_repository,
+        host_source=args.sbuild_host_source,
+        jobs=args.sbuild_jobs,
         link_builds=args.link_builds,
+        memory_budget=MemoryBudget(args.memory_budget),
         orig_dirs=args.orig_dirs,
         output_dir=args.output_dir,
         output_parent=args.output_parent,
         mirrors=args.get_mirrors(),
         profiles=profiles,
+        qemu_ram_size=args.qemu_ram_size,
         sbuild_options=args._sbuild_options,
+        source_cache=args.source_cache,
         storage=args.storage,
         suite=args.suite,
         vendor=args.vendor,
+        worker_options=worker_options,
     )
 
     group.select_suites(args)
@@ -178,15 +229,6 @@ def run(args):
         args.sbuild_worker,
         args.sbuild_worker_suite,
     )
-    group.sbuild(
-        sbuild_worker,
-        archs=args._archs,
-        build_source=args._build_source,
-        indep=args._indep,
-        indep_together=args.build_indep_together,
-        source_only=args._source_only,
-        source_together=args.sbuild_source_together,
-    )
 
     misc_worker = group.get_worker(args.worker, args.worker_suite)
 
@@ -205,43 +247,102 @@ def run(args):
         args.lxd_worker_suite,
     )
 
-    interrupted = False
-
-    try:
-        group.autopkgtest(
-            default_architecture=sbuild_worker.dpkg_architecture,
+    # The sbuild workers hold memory from the group's budget until all
+    # the builds have finished, so the tests get a budget of their own,
+    # shared by all of them however many run at a time
+    test_memory_budget = MemoryBudget(args.memory_budget)
+
+    # Each buildable is built, then tested and checked with lintian
+    # while the others are still building
+    scheduler = Scheduler(limits=dict(
+        host=args.host_jobs,
+        sbuild=args.sbuild_jobs,
+        test=args.test_jobs,
+    ))
+
+    def add_test_tasks(buildable):
+        # The first sbuild worker might still be starting up if another
+        # of the sbuild workers finished first
+        with sbuild_worker:
+            default_architecture = sbuild_worker.dpkg_architecture
+
+        group.add_autopkgtest_tasks(
+            scheduler,
+            buildable,
+            default_architecture=default_architecture,
+            jobs=args.autopkgtest_jobs,
             lxc_24bit_subnet=args.lxc_24bit_subnet,
             lxc_worker=lxc_worker,
             lxd_worker=lxd_worker,
+            memory_budget=test_memory_budget,
             modes=args.autopkgtest,
             qemu_ram_size=args.qemu_ram_size,
             schroot_worker=sbuild_worker,
             worker=misc_worker,
         )
-    except KeyboardInterrupt:
-        interrupted = True
 
-    if args.piuparts_tarballs and not interrupted:
-        try:
-            group.piuparts(
-                default_architecture=sbuild_worker.dpkg_architecture,
+        if args.piuparts_tarballs:
+            group.add_piuparts_tasks(
+                scheduler,
+                buildable,
+                default_architecture=default_architecture,
                 tarballs=args.piuparts_tarballs,
                 worker=piuparts_worker,
             )
-        except KeyboardInterrupt:
-            interrupted = True
-
-    _summarize(group.buildables)
 
-    if not interrupted:
-        try:
-            _lintian(group.buildables)
-        except KeyboardInterrupt:
-            logger.warning('lintian interrupted')
-            interrupted = True
+    try:
+        with group.get_sbuild_workers(sbuild_worker) as sbuild_workers:
+            builds = group.add_sbuild_tasks(
+                scheduler,
+                sbuild_workers,
+                archs=args._archs,
+                build_source=args._build_source,
+                indep=args._indep,
+                indep_together=args.build_indep_together,
+                source_only=args._source_only,
+                source_together=args.sbuild_source_together,
+            )
 
-    if args._reprepro_dir and not interrupted:
-        _publish(group.buildables, args._reprepro_dir, args._reprepro_suite)
+            for buildable, build in zip(group.buildables, builds):
+                # The test tasks are tagged like the task that adds them
+                scheduler.add(
+                    'plan tests for {}'.format(buildable),
+                    functools.partial(add_test_tasks, buildable),
+                    after=[build],
+                    tag=str(buildable),
+                )
+                scheduler.add(
+                    'lintian {}'.format(buildable),
+                    functools.partial(_lintian, [buildable]),
+                    after=[build],
+                    resource='host',
+                    tag=str(buildable),
+                )
+
+                if args._reprepro_dir:
+                    # reprepro is not a resource in the scheduler's limits,
+                    # so only one of these runs at a time
+                    scheduler.add(
+                        'publish {}'.format(buildable),
+                        functools.partial(
+                            _publish, [buildable], args._reprepro_dir,
+                            args._reprepro_suite),
+                        after=[build],
+                        resource='reprepro',
+                        tag=str(buildable),
+                    )
+
+            try:
+                scheduler.run()
+            except KeyboardInterrupt:
+                logger.warning('Interrupted, skipping remaining tasks')
+
+        _summarize(group.buildables)
+    finally:
+        # Failed builds are where the timings are most interesting
+        _write_traces(group.buildables, trace)
+
+    trace.log_summary(10)
 
     # We print these separately, right at the end, so that if you built more
     # than one thing, the last screenful of information is the really
@@ -4,12 +4,28 @@
 
 import logging
 import os
+import textwrap
 
 from debian.debian_support import (
     Version,
 )
 
 from vectis.error import ArgumentError
+from vectis.provision import (
+    SBUILD_TARBALL,
+    ZSTD,
+)
+from vectis.storage import (
+    DebootstrapCache,
+    get_release_info,
+    get_tarball_packages,
+    is_up_to_date,
+    record_tarball,
+    refresh_tarball,
+)
+from vectis.util import (
+    TARBALL_EXTENSIONS,
+)
 from vectis.worker import (
     VirtWorker,
 )
@@ -30,6 +46,7 @@ def run(args):
     debootstrap_script = args.debootstrap_script
     keep = args._keep
     mirrors = args.get_mirrors()
+    refresh = args._refresh
     storage = args.storage
     suite = args.suite
     test_package = args._test_package
@@ -41,6 +58,8 @@ def run(args):
     # From configuration
     apt_key = args.apt_key
     apt_key_package = args.apt_key_package
+    compression = args.tarball_compression
+    debootstrap_cache = args.debootstrap_cache
 
     os.makedirs(storage, exist_ok=True)
 
@@ -54,35 +73,35 @@ def run(args):
     if uri is None:
         uri = mirrors.lookup_suite(suite)
 
-    sbuild_tarball = '{arch}/{vendor}/{suite}/sbuild.tar.gz'.format(
+    sbuild_tarball = '{arch}/{vendor}/{suite}/sbuild{ext}'.format(
         arch=architecture,
+        ext=TARBALL_EXTENSIONS[compression],
         vendor=vendor,
         suite=suite,
     )
+    release_digests, release_dates = get_release_info(mirrors, suite)
+
+    if refresh and is_up_to_date(
+            os.path.join(storage, sbuild_tarball),
+            components=components,
+            release_digests=release_digests):
+        logger.info('Tarball %s is up to date', sbuild_tarball)
+        return
+
     logger.info('Creating tarball %s...', sbuild_tarball)
+    recipes = [SBUILD_TARBALL]
+
+    if compression == 'zstd':
+        recipes.append(ZSTD)
 
     with VirtWorker(
             worker_argv,
             mirrors=mirrors,
+            recipes=recipes,
             storage=storage,
             suite=worker_suite,
+            **args.get_worker_options()
     ) as worker:
-        logger.info('Installing debootstrap and sbuild')
-        worker.check_call([
-            'env',
-            'DEBIAN_FRONTEND=noninteractive',
-            'apt-get',
-            '-y',
-            '--no-install-recommends',
-            '-t', worker_suite.apt_suite,
-            'install',
-
-            'debootstrap',
-            'python3',
-            'sbuild',
-            'schroot',
-        ])
-
         keyring = apt_key_package
 
         if keyring is not None:
@@ -98,41 +117,92 @@ def run(args):
                 keyring,
             ])
 
-        debootstrap_args = []
-
-        if worker.call(['test', '-f', apt_key]) == 0:
-            logger.info('Found apt key worker:{}'.format(apt_key))
-            debootstrap_args.append('--keyring={}'.format(apt_key))
-        elif os.path.exists(apt_key):
-            logger.info('Found apt key host:{}, copying to worker:{}'.format(
-                apt_key, '{}/apt-key.gpg'.format(worker.scratch)))
-            worker.copy_to_guest(
-                apt_key, '{}/apt-key.gpg'.format(worker.scratch))
-            debootstrap_args.append('--keyring={}/apt-key.gpg'.format(
-                worker.scratch))
-        else:
-            logger.warning(
-                'Apt key host:{} not found; leaving it out and hoping '
-                'for the best'.format(apt_key))
-
-        debootstrap_args.append(
-            '--components={}'.format(','.join(components)))
-
-        worker.check_call([
-            'env', 'DEBIAN_FRONTEND=noninteractive',
-            worker.command_wrapper,
-            '--',
-            'sbuild-createchroot',
-            '--arch={}'.format(architecture),
-            '--include=fakeroot,sudo,vim',
-            '--components={}'.format(','.join(components)),
-            '--make-sbuild-tarball={}/output.tar.gz'.format(worker.scratch),
-        ] + debootstrap_args + [
-            str(suite), '{}/chroot'.format(worker.scratch), uri,
-            '/usr/share/debootstrap/scripts/{}'.format(debootstrap_script),
-        ])
-
+        output = '{}/output{}'.format(
+            worker.scratch, TARBALL_EXTENSIONS[compression])
         out = os.path.join(storage, sbuild_tarball)
+        refreshed = False
+
+        if refresh and os.path.exists(out):
+            try:
+                chroot = refresh_tarball(
+                    worker, out, output, compression=compression)
+            except Exception as e:
+                logger.warning(
+                    'Unable to refresh %s, creating it from scratch: %s',
+                    sbuild_tarball, e)
+            else:
+                refreshed = True
+                # Stand in for the schroot that sbuild-createchroot
+                # would have configured, for the smoke-test
+                worker.write_to_guest(
+                    '/etc/schroot/chroot.d/{}-{}-sbuild'.format(
+                        suite, architecture),
+                    textwrap.dedent('''
+                    [{}-{}-sbuild]
+                    type=directory
+                    directory={}
+                    groups=root,sbuild
+                    root-groups=root,sbuild
+                    profile=sbuild
+                    ''').format(suite, architecture, chroot))
+
+        if not refreshed:
+            debootstrap_args = []
+
+            if worker.call(['test', '-f', apt_key]) == 0:
+                logger.info('Found apt key worker:{}'.format(apt_key))
+                debootstrap_args.append('--keyring={}'.format(apt_key))
+            elif os.path.exists(apt_key):
+                logger.info(
+                    'Found apt key host:{}, copying to worker:{}'.format(
+                        apt_key, '{}/apt-key.gpg'.format(worker.scratch)))
+                worker.copy_to_guest(
+                    apt_key, '{}/apt-key.gpg'.format(worker.scratch))
+                debootstrap_args.append('--keyring={}/apt-key.gpg'.format(
+                    worker.scratch))
+            else:
+                logger.warning(
+                    'Apt key host:{} not found; leaving it out and hoping '
+                    'for the best'.format(apt_key))
+
+            debootstrap_args.append(
+                '--components={}'.format(','.join(components)))
+
+            cache = DebootstrapCache(storage, architecture)
+            env = ['env', 'DEBIAN_FRONTEND=noninteractive']
+
+            if debootstrap_cache:
+                cache.copy_to_guest(worker)
+                # sbuild-createchroot has no way to pass --cache-dir
+                # to debootstrap, so put a wrapper first in its PATH
+                env.append('PATH={}'.format(cache.write_wrapper(worker)))
+
+            if compression == 'gzip':
+                created = output
+            else:
+                # sbuild-createchroot can't compress with zstd
+                created = '{}/output.tar'.format(worker.scratch)
+
+            worker.check_call(env + [
+                worker.command_wrapper,
+                '--',
+                'sbuild-createchroot',
+                '--arch={}'.format(architecture),
+                '--include=fakeroot,sudo,vim',
+                '--components={}'.format(','.join(components)),
+                '--make-sbuild-tarball={}'.format(created),
+            ] + debootstrap_args + [
+                str(suite), '{}/chroot'.format(worker.scratch), uri,
+                '/usr/share/debootstrap/scripts/{}'.format(
+                    debootstrap_script),
+            ])
+            cache.copy_to_host(worker)
+
+            if created != output:
+                # Keep the uncompressed tarball: the schroot that
+                # sbuild-createchroot configured for the smoke-test uses it
+                worker.check_call(['zstd', '-T0', '-q', '-o', output, created])
+
         os.makedirs(os.path.dirname(out) or os.curdir, exist_ok=True)
 
         # Smoke-test the new tarball before being prepared to use it.
@@ -172,14 +242,23 @@ def run(args):
                 ])
             except Exception:
                 if keep:
-                    worker.copy_to_host(
-                        '{}/output.tar.gz'.format(worker.scratch),
-                        out + '.new')
+                    worker.copy_to_host(output, out + '.new')
 
                 raise
 
-        worker.copy_to_host(
-            '{}/output.tar.gz'.format(worker.scratch), out + '.new')
+        packages = get_tarball_packages(
+            worker, output, compression=compression)
+        worker.copy_to_host(output, out + '.new')
         os.rename(out + '.new', out)
+        record_tarball(
+            out,
+            components=components,
+            packages=packages,
+            refreshed=refreshed,
+            release_dates=release_dates,
+            release_digests=release_digests)
 
-    logger.info('Created tarball %s', sbuild_tarball)
+    if refreshed:
+        logger.info('Refreshed tarball %s', sbuild_tarball)
+    else:
+        logger.info('Created tarball %s', sbuild_tarball)
@@ -0,0 +1,127 @@
+# Copyright © 2018 Simon McVittie
+# SPDX-License-Identifier: GPL-2.0+
+# (see vectis/__init__.py)
+
+import fnmatch
+import json
+import logging
+import os
+import sys
+import time
+
+from vectis.error import ArgumentError
+from vectis.snapshot import (
+    find_image,
+)
+from vectis.storage import (
+    StorageIndex,
+    collect_garbage,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def _format_size(size):
+    if size < 1024:
+        return '{}B'.format(size)
+
+    size /= 1024
+
+    for unit in ('K', 'M', 'G'):
+        if size < 1024:
+            break
+
+        size /= 1024
+    else:
+        unit = 'T'
+
+    return '{:.1f}{}'.format(size, unit)
+
+
+def _format_age(seconds):
+    for unit, length in (('d', 86400), ('h', 3600), ('m', 60)):
+        if seconds >= length:
+            return '{}{}'.format(int(seconds // length), unit)
+
+    return '{}s'.format(int(seconds))
+
+
+def _list(args):
+    index = StorageIndex(args.storage)
+    index.update()
+    entries = [
+        e for e in index.find()
+        if not args._patterns or
+        any(fnmatch.fnmatchcase(e['path'], p) for p in args._patterns)
+    ]
+    entries.sort(key=lambda e: e['path'])
+
+    if args._json:
+        json.dump(entries, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+        return
+
+    now = time.time()
+
+    for entry in entries:
+        release_dates = entry.get('release_dates') or {}
+
+        print('{path}\t{size}\t{age}\t{sha256}\t{release}'.format(
+            age=_format_age(now - entry['refreshed']),
+            path=entry['path'],
+            release=release_dates.get(entry['suite']) or '-',
+            sha256=entry['sha256'][:12],
+            size=_format_size(entry['size']),
+        ))
+
+        if args._packages:
+            for package, version in sorted(
+                    (entry.get('packages') or {}).items()):
+                print('\t{}\t{}'.format(package, version))
+
+
+def _gc(args):
+    keep = set()
+
+    # Don't delete the images that workers boot from
+    for argv in (
+            args.worker,
+            args.lxc_worker,
+            args.lxd_worker,
+            args.pbuilder_worker,
+            args.piuparts_worker,
+            args.sbuild_worker,
+            args.vmdebootstrap_worker,
+    ):
+        argv = [os.path.expanduser(arg) for arg in argv]
+        i = find_image(argv)
+
+        if i is not None:
+            keep.add(argv[i])
+
+    max_age = args.storage_max_age
+
+    if max_age is not None:
+        max_age *= 86400
+
+    freed = collect_garbage(
+        args.storage,
+        dry_run=args._dry_run,
+        keep=keep,
+        max_age=max_age,
+        max_size=args.storage_max_size,
+    )
+
+    if args._dry_run:
+        logger.info('Would free %s', _format_size(freed))
+    else:
+        logger.info('Freed %s', _format_size(freed))
+
+
+def run(args):
+    if args._storage_action == 'list':
+        _list(args)
+    elif args._storage_action == 'gc':
+        _gc(args)
+    else:
+        raise ArgumentError('An action such as "list" is required')
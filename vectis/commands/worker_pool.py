@@ -0,0 +1,69 @@
+# Copyright © 2018 Simon McVittie
+# SPDX-License-Identifier: GPL-2.0+
+# (see vectis/__init__.py)
+
+import logging
+import os
+from contextlib import suppress
+
+from vectis.error import ArgumentError
+from vectis.pool import (
+    WorkerPool,
+    WorkerPoolServer,
+    WorkerPoolKey,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def run(args):
+    mirrors = args.get_mirrors()
+    path = args.worker_pool
+    size = args.worker_pool_size
+
+    if path is None:
+        raise ArgumentError('worker_pool must be configured')
+
+    if size < 1:
+        raise ArgumentError('worker_pool_size must be at least 1')
+
+    for suite in (args.worker_suite, args.sbuild_worker_suite):
+        for ancestor in suite.hierarchy:
+            mirror = mirrors.lookup_suite(ancestor)
+            if mirror is None:
+                raise ArgumentError(
+                    'No mirror configured for {}'.format(ancestor))
+
+    def get_suite(vendor, suite):
+        return args.get_suite(args.get_vendor(vendor), suite)
+
+    # Workers in the pool must not try to lease themselves from the pool
+    worker_options = args.get_worker_options()
+    worker_options['pool'] = None
+
+    pool = WorkerPool(
+        mirrors=mirrors,
+        size=size,
+        storage=args.storage,
+        worker_options=worker_options,
+    )
+
+    os.makedirs(os.path.dirname(path) or os.curdir, exist_ok=True)
+
+    with suppress(FileNotFoundError):
+        os.unlink(path)
+
+    server = WorkerPoolServer(path, get_suite=get_suite, pool=pool)
+
+    try:
+        pool.warm(WorkerPoolKey(argv=args.worker, suite=args.worker_suite))
+        pool.warm(WorkerPoolKey(
+            argv=args.sbuild_worker, suite=args.sbuild_worker_suite))
+        logger.info('Serving workers on %s', path)
+        server.serve_forever()
+    finally:
+        server.server_close()
+        pool.close()
+
+        with suppress(FileNotFoundError):
+            os.unlink(path)
@@ -12,6 +12,7 @@ from string import Template
 from weakref import WeakValueDictionary
 
 from vectis.error import Error
+from vectis.util import QEMU_IMAGE_PROFILES, TARBALL_EXTENSIONS
 
 import yaml
 
@@ -45,19 +46,22 @@ XDG_DATA_HOME = os.getenv(
     'XDG_DATA_HOME', os.path.expanduser('~/.local/share'))
 XDG_DATA_DIRS = os.getenv(
     'XDG_DATA_DIRS', os.path.expanduser('~/.local/share'))
+XDG_RUNTIME_DIR = os.getenv('XDG_RUNTIME_DIR')
 
 _1M = 1024 * 1024
 
 
 class Mirrors:
 
-    def __init__(self, mapping):
-        # type: (Mapping[Optional[str], str]) -> None
+    def __init__(self, mapping, *, cache=None):
+        # type: (Mapping[Optional[str], str], Optional[str]) -> None
         if mapping is None:
             self._raw = {}      # type: Mapping[Optional[str], str]
         else:
             self._raw = mapping
 
+        self.cache = cache
+
     def _lookup_template(self, suite):
         # type: (Suite,) -> Optional[str]
         for uri in suite.uris:
@@ -83,17 +87,48 @@ class Mirrors:
 
         return None
 
-    def lookup_suite(self, suite):
+    def _lookup_uri(self, suite):
         # type: (Suite,) -> Optional[str]
         t = self._lookup_template(suite)
 
         if t is None:
-            return None
+            if self.cache is None:
+                return None
+
+            # The cache can download from the canonical URI for us
+            for uri in suite.uris:
+                if uri.startswith('http://'):
+                    t = uri
+                    break
+            else:
+                return None
 
         return Template(t).substitute(
             archive=suite.archive,
         )
 
+    def lookup_suite(self, suite):
+        # type: (Suite,) -> Optional[str]
+        uri = self._lookup_uri(suite)
+
+        if (uri is not None and self.cache is not None and
+                uri.startswith('http://')):
+            # "vectis mirror-cache" serves http://HOST/PATH as
+            # CACHE/HOST/PATH
+            return '{}/{}'.format(
+                self.cache.rstrip('/'), uri[len('http://'):])
+
+        return uri
+
+    def lookup_suite_from_host(self, suite):
+        # type: (Suite,) -> Optional[str]
+        """
+        Return the URI from which the host, rather than a worker, can
+        download suite. The mirror cache is often only reachable from
+        workers, so this bypasses it.
+        """
+        return self._lookup_uri(suite)
+
 
 class _ConfigLike(metaclass=ABCMeta):
 
@@ -115,6 +150,17 @@ class _ConfigLike(metaclass=ABCMeta):
         # type: (str,) -> int
         return int(self[name])
 
+    def _get_jobs(self, name):
+        # type: (str,) -> int
+        value = self._get_int(name)
+
+        if value < 1:
+            raise ConfigError(
+                '{} must be a positive integer, not {!r}'.format(
+                    name, value))
+
+        return value
+
     @property
     def all_components(self):
         # type: () -> Set[str]
@@ -359,6 +405,7 @@ class Config(_ConfigLike):
 
         # Some things can have better defaults that can't be hard-coded
         d['defaults']['parallel'] = str(os.cpu_count())
+        d['defaults']['host_jobs'] = str(os.cpu_count())
 
         try:
             d['defaults']['architecture'] = subprocess.check_output(
@@ -524,6 +571,68 @@ class Config(_ConfigLike):
     def sbuild_source_together(self):
         return self._get_bool('sbuild_source_together')
 
+    @property
+    def sbuild_host_source(self):
+        return self._get_bool('sbuild_host_source')
+
+    @property
+    def sbuild_arch_jobs(self):
+        return self._get_jobs('sbuild_arch_jobs')
+
+    @property
+    def sbuild_jobs(self):
+        return self._get_jobs('sbuild_jobs')
+
+    @property
+    def autopkgtest_jobs(self):
+        if self['autopkgtest_jobs'] is None:
+            return None
+
+        return self._get_jobs('autopkgtest_jobs')
+
+    @property
+    def test_jobs(self):
+        return self._get_jobs('test_jobs')
+
+    @property
+    def host_jobs(self):
+        return self._get_jobs('host_jobs')
+
+    @property
+    def debootstrap_cache(self):
+        return self._get_bool('debootstrap_cache')
+
+    @property
+    def source_cache(self):
+        return self._get_bool('source_cache')
+
+    @property
+    def tarball_compression(self):
+        value = self['tarball_compression']
+
+        if value in TARBALL_EXTENSIONS:
+            return value
+
+        raise ConfigError(
+            'Invalid value for {!r}: {!r} is not one of {}'.format(
+                'tarball_compression', value,
+                ', '.join(sorted(TARBALL_EXTENSIONS))))
+
+    @property
+    def tarball_extension(self):
+        return TARBALL_EXTENSIONS[self.tarball_compression]
+
+    @property
+    def sbuild_chroot_mode(self):
+        value = self['sbuild_chroot_mode']
+
+        if value in ('file', 'overlay'):
+            return value
+
+        raise ConfigError(
+            'Invalid value for {!r}: {!r} is not "file" or "overlay"'.format(
+                'sbuild_chroot_mode', value))
+
     def _get_bool(self, name):
         value = self[name]
 
@@ -555,9 +664,108 @@ class Config(_ConfigLike):
         return self._get_filename(
             'storage', os.path.join(XDG_CACHE_HOME, 'vectis'))
 
+    @property
+    def mirror_cache_listen(self):
+        """
+        The address and port on which "vectis mirror-cache" listens.
+        """
+        value = self['mirror_cache_listen']
+        host, _, port = value.rpartition(':')
+        return host, int(port)
+
+    @property
+    def worker_pool(self):
+        """
+        The socket on which "vectis worker-pool" listens, or None if
+        worker pools are disabled.
+        """
+        if self['worker_pool'] is False:
+            return None
+
+        if XDG_RUNTIME_DIR is None:
+            default = None
+        else:
+            default = os.path.join(XDG_RUNTIME_DIR, 'vectis', 'worker-pool')
+
+        return self._get_filename('worker_pool', default)
+
+    @property
+    def worker_pool_size(self):
+        return self._get_int('worker_pool_size')
+
+    @property
+    def worker_cache_image(self):
+        return self._get_filename(
+            'worker_cache_image',
+            os.path.join(self.storage, 'cache', 'vectis-cas.img'))
+
+    @property
+    def worker_cache_size(self):
+        return self._get_size('worker_cache_size')
+
+    @property
+    def worker_agent(self):
+        return self._get_bool('worker_agent')
+
+    @property
+    def worker_snapshots(self):
+        return self._get_bool('worker_snapshots')
+
+    def get_worker_options(self):
+        """
+        Return keyword arguments for VirtWorker that do not depend on
+        which worker is being started.
+        """
+        return dict(
+            agent=self.worker_agent,
+            cache_image=self.worker_cache_image,
+            cache_size=self.worker_cache_size,
+            pool=self.worker_pool,
+            snapshots=self.worker_snapshots,
+        )
+
     @property
     def qemu_ram_size(self):
-        value = self['qemu_ram_size']
+        return self._get_size('qemu_ram_size')
+
+    @property
+    def memory_budget(self):
+        return self._get_size('memory_budget')
+
+    @property
+    def storage_max_age(self):
+        """
+        The age in days after which vectis storage gc deletes images and
+        tarballs that have not been refreshed, or None.
+        """
+        value = self['storage_max_age']
+
+        if value is None:
+            return None
+
+        return int(value)
+
+    @property
+    def storage_max_size(self):
+        return self._get_size('storage_max_size')
+
+    @property
+    def qemu_image_profile(self):
+        value = self['qemu_image_profile']
+
+        if value in QEMU_IMAGE_PROFILES:
+            return value
+
+        raise ConfigError(
+            'Invalid value for {!r}: {!r} is not one of {}'.format(
+                'qemu_image_profile', value,
+                ', '.join(sorted(QEMU_IMAGE_PROFILES))))
+
+    def _get_size(self, name):
+        value = self[name]
+
+        if value is None or isinstance(value, int):
+            return value
 
         # TODO: Make this less crude
         if value.endswith('G'):
@@ -1154,7 +1362,7 @@ class Config(_ConfigLike):
         return os.path.join(os.path.dirname(__file__), 'keys', value)
 
     def get_mirrors(self):
-        return Mirrors(self['mirrors'])
+        return Mirrors(self['mirrors'], cache=self['mirror_cache'])
 
     def get_suite(self, vendor, name, create=True):
         original_name = name
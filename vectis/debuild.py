@@ -2,6 +2,7 @@
 # SPDX-License-Identifier: GPL-2.0+
 # (see vectis/__init__.py)
 
+import functools
 import glob
 import logging
 import os
@@ -12,6 +13,7 @@ import time
 from collections import (
     OrderedDict,
 )
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import suppress
 from tempfile import TemporaryDirectory
 
@@ -21,6 +23,7 @@ except ImportError:
     pass
 else:
     from typing import (
+        Dict,
         Iterable,
         List,
         Mapping,
@@ -30,6 +33,7 @@ else:
         Tuple,
     )
     typing      # silence pyflakes
+    Dict
     Iterable
     List
     Mapping
@@ -38,6 +42,13 @@ else:
     Set
     Tuple
 
+    from vectis.scheduler import (
+        Scheduler,
+        Task,
+    )
+    Scheduler
+    Task
+
 from debian.changelog import (
     Changelog,
 )
@@ -67,13 +78,30 @@ from vectis.piuparts import (
     Binary,
     run_piuparts,
 )
+from vectis.provision import (
+    PBUILDER,
+    SBUILD,
+    ZSTD,
+)
+from vectis.storage import (
+    SourceCache,
+)
+from vectis.trace import (
+    propagate_tag,
+)
 from vectis.util import (
     AtomicWriter,
+    MemoryBudget,
+    find_tarball,
+    get_pbuilder_compress_options,
+    get_tarball_compression,
+    tar_excluded,
 )
 from vectis.worker import (
     ContainerWorker,
     SchrootWorker,
     VirtWorker,
+    WorkerGroup,
 )
 
 import vectis.config
@@ -81,6 +109,75 @@ vectis.config                           # noqa
 
 logger = logging.getLogger(__name__)
 
+# The patterns excluded by dpkg-source --tar-ignore with no argument
+_DEFAULT_TAR_IGNORE = (
+    '*.a', '*.la', '*.o', '*.so', '.*.sw?', '*/*~', ',,*', '.[#~]*',
+    '.arch-ids', '.arch-inventory', '.be', '.bzr', '.bzr.backup',
+    '.bzr.tags', '.bzrignore', '.cvsignore', '.deps', '.git',
+    '.gitattributes', '.gitignore', '.gitmodules', '.gitreview', '.hg',
+    '.hgignore', '.hgsigs', '.hgtags', '.mailmap', '.mtn-ignore',
+    '.shelf', '.svn', 'CVS', 'DEADJOE', 'RCS', '_MTN', '_darcs', '{arch}',
+)
+
+
+def _mark_interrupted(failures):
+    if 'interrupted' not in failures:
+        failures.append('interrupted')
+
+
+def get_tar_ignore(dpkg_source_options):
+    """
+    Return the patterns that dpkg-source would exclude from a source
+    package when given dpkg_source_options.
+    """
+    patterns = []
+
+    for option in dpkg_source_options:
+        if option in ('-I', '--tar-ignore'):
+            patterns.extend(_DEFAULT_TAR_IGNORE)
+        elif option.startswith('--tar-ignore='):
+            patterns.append(option[len('--tar-ignore='):])
+        elif option.startswith('-I'):
+            patterns.append(option[len('-I'):])
+
+    return patterns
+
+
+def find_orig_paths(origs):
+    # type: (Iterable[str]) -> Set[str]
+    """
+    Return the paths relative to the top of the source tree of the
+    files and directories in the original tarballs origs.
+
+    dpkg-source compares the tree with these, so they must not be
+    left out because they match tar_ignore, even if dpkg-source
+    would not put them in a tarball of its own.
+    """
+    paths = set()               # type: Set[str]
+
+    for orig in origs:
+        # orig-COMPONENT tarballs unpack into COMPONENT/
+        component = os.path.basename(orig).split('.orig', 1)[1]
+
+        if component.startswith('-'):
+            prefix = [component[1:].split('.tar.', 1)[0]]
+        else:
+            prefix = []
+
+        names = subprocess.check_output(
+            ['tar', '-tf', orig], universal_newlines=True)
+
+        for name in names.splitlines():
+            # Skip the top-level directory
+            parts = [
+                p for p in name.split('/') if p not in ('', '.')][1:]
+            parts = prefix + parts
+
+            for i in range(len(parts)):
+                paths.add('/'.join(parts[:i + 1]))
+
+    return paths
+
 
 class PbuilderWorker(ContainerWorker):
 
@@ -103,9 +200,12 @@ class PbuilderWorker(ContainerWorker):
         if tarball is None:
             assert storage is not None
 
-            tarball = os.path.join(
+            tarball = find_tarball(os.path.join(
                 storage, architecture, str(suite.hierarchy[-1].vendor),
-                str(suite.hierarchy[-1]), 'pbuilder.tar.gz')
+                str(suite.hierarchy[-1]), 'pbuilder.tar.gz'))
+
+        if get_tarball_compression(tarball) == 'zstd':
+            worker.provision(ZSTD)
 
         self.apt_related_argv = []                      # type: Sequence[str]
         self.components = components
@@ -209,6 +309,7 @@ class Buildable:
         self.dirname = None
         self.dsc = None
         self.dsc_name = None
+        self.host_source_dsc = None     # type: Optional[str]
         self.indep = False
         self.indep_together_with = None
         self.link_builds = link_builds
@@ -406,77 +507,273 @@ class Buildable:
         self._binary_version = Version(
             str(self._source_version) + self.binary_version_suffix)
 
-    def copy_source_to(self, worker):
+    def find_orig_tarballs(self):
+        # type: () -> List[str]
+        """
+        Return the original tarballs for a directory buildable that can
+        be found in orig_dirs.
+        """
+        origs_copied = set()
+        origs = []
+
+        for orig_dir in self.orig_dirs:
+            orig_glob_prefix = glob.escape(
+                os.path.join(
+                    self.buildable, orig_dir,
+                    '{}_{}'.format(
+                        self.source_package,
+                        self._source_version.upstream_version)))
+
+            for orig_pattern in (
+                    orig_glob_prefix + '.orig.tar.*',
+                    orig_glob_prefix + '.orig-*.tar.*'):
+                logger.info(
+                    'Looking for original tarballs: %s', orig_pattern)
+
+                for orig in glob.glob(orig_pattern):
+                    base = os.path.basename(orig)
+
+                    if base in origs_copied:
+                        logger.info(
+                            'Already copied %s; ignoring %s', base,
+                            orig)
+                        continue
+
+                    origs_copied.add(base)
+                    logger.info('Copying original tarball: %s', orig)
+                    origs.append(orig)
+
+        return origs
+
+    def build_source_on_host(
+        self,
+        staging,                    # type: str
+        *,
+        dpkg_source_options=(),     # type: Iterable[str]
+        tar_ignore=()               # type: Iterable[str]
+    ):
+        # type: (...) -> List[str]
+        """
+        Build a source package from a directory buildable with
+        dpkg-source on the host, in the existing directory staging.
+        Return the paths of its files, .dsc first.
+
+        dpkg-source applies unapplied patches to the tree it builds, so
+        it runs on a copy of the directory in staging, leaving out
+        files that match tar_ignore and are not in the original
+        tarballs, rather than on the user's checkout.
+        """
+        if shutil.which('dpkg-source') is None:
+            raise ArgumentError(
+                'Building the source package on the host requires '
+                'dpkg-source (from dpkg-dev)')
+
+        origs = []              # type: List[str]
+
+        if self._source_version.debian_revision is not None:
+            origs = self.find_orig_tarballs()
+
+            # dpkg-source looks for the orig.tar.* in the current
+            # directory
+            for orig in origs:
+                os.symlink(
+                    os.path.abspath(orig),
+                    os.path.join(staging, os.path.basename(orig)))
+
+        tar_ignore = list(tar_ignore)
+        keep = find_orig_paths(origs) if tar_ignore else set()
+        top = os.path.abspath(self.buildable)
+
+        def ignore(directory, names):
+            return {
+                name for name in names
+                if tar_excluded(
+                    os.path.relpath(os.path.join(directory, name), top),
+                    tar_ignore, keep=keep)}
+
+        copy = os.path.join(staging, '{}-{}'.format(
+            self.source_package, self._source_version.upstream_version))
+        shutil.copytree(top, copy, symlinks=True, ignore=ignore)
+
+        subprocess.check_call(
+            ['dpkg-source'] + list(dpkg_source_options) +
+            ['-b', os.path.basename(copy)],
+            cwd=staging)
+        shutil.rmtree(copy)
+
+        dscs = glob.glob(os.path.join(staging, '*.dsc'))
+
+        if len(dscs) != 1:
+            raise CannotHappen(
+                'dpkg-source produced {} .dsc files from {!r}'.format(
+                    len(dscs), self))
+
+        with open(dscs[0]) as reader:
+            dsc = Dsc(reader)
+
+        files = [dscs[0]] + [
+            os.path.join(staging, f['name']) for f in dsc['files']]
+        logger.info(
+            'Built source package %s on host: %.1f MiB',
+            os.path.basename(dscs[0]),
+            sum(os.path.getsize(f) for f in files) / (1024 * 1024))
+        return files
+
+    def copy_source_to(
+        self,
+        worker,
+        *,
+        dpkg_source_options=(),     # type: Iterable[str]
+        host_source=False,          # type: bool
+        tar_ignore=()               # type: Iterable[str]
+    ):
         worker.check_call([
             'mkdir', '-p', '-m755', '{}/in'.format(worker.scratch)])
 
         if self.dsc_name is not None:
             assert self.dsc is not None
 
-            worker.copy_to_guest(
-                self.dsc_name,
-                '{}/in/{}'.format(
-                    worker.scratch,
-                    os.path.basename(self.dsc_name)))
-
-            for f in self.dsc['files']:
-                worker.copy_to_guest(
-                    os.path.join(self.dirname, f['name']),
-                    '{}/in/{}'.format(worker.scratch, f['name']))
+            worker.copy_files_to_guest(
+                [self.dsc_name] + [
+                    os.path.join(self.dirname, f['name'])
+                    for f in self.dsc['files']],
+                '{}/in'.format(worker.scratch))
+        elif not self.source_from_archive and host_source:
+            # Only the source package crosses into the worker, not the
+            # whole tree with its version control and build leftovers
+            with TemporaryDirectory(prefix='vectis-source-') as staging:
+                files = self.build_source_on_host(
+                    staging,
+                    dpkg_source_options=dpkg_source_options,
+                    tar_ignore=tar_ignore)
+                worker.copy_files_to_guest(
+                    files, '{}/in'.format(worker.scratch),
+                    owner='sbuild:sbuild')
+
+            self.host_source_dsc = os.path.basename(files[0])
+            origs = [
+                os.path.basename(f) for f in files
+                if '.orig' in os.path.basename(f)]
+
+            if origs:
+                worker.check_call([
+                    'install', '-d', '-m755', '-osbuild', '-gsbuild',
+                    '{}/out'.format(worker.scratch)])
+                worker.check_call(['ln', '-s'] + [
+                    '{}/in/{}'.format(worker.scratch, base)
+                    for base in sorted(origs)
+                ] + ['{}/out/'.format(worker.scratch)])
         elif not self.source_from_archive:
-            worker.copy_to_guest(
-                os.path.join(self.buildable, ''),
-                '{}/in/{}_source/'.format(
+            origs = []
+
+            if self._source_version.debian_revision is not None:
+                origs = self.find_orig_tarballs()
+
+            tar_ignore = list(tar_ignore)
+
+            # dpkg-source would leave out files matching tar_ignore, so
+            # there is no point in copying them, unless they are in the
+            # original tarballs and leaving them out would look like
+            # deleting them
+            worker.copy_tree_to_guest(
+                self.buildable,
+                '{}/in/{}_source'.format(
                     worker.scratch,
-                    self.product_prefix))
+                    self.product_prefix),
+                exclude=tar_ignore,
+                keep=find_orig_paths(origs) if tar_ignore else set(),
+                owner='sbuild:sbuild')
             worker.check_call([
-                'chown', '-R', 'sbuild:sbuild',
+                'chown', 'sbuild:sbuild',
                 '{}/in/'.format(worker.scratch)])
             if self._source_version.debian_revision is not None:
                 worker.check_call([
                     'install', '-d', '-m755', '-osbuild', '-gsbuild',
                     '{}/out'.format(worker.scratch)])
 
-                origs_copied = set()
+                if origs:
+                    worker.copy_files_to_guest(
+                        origs, '{}/in'.format(worker.scratch))
+                    worker.check_call(['ln', '-s'] + [
+                        '{}/in/{}'.format(worker.scratch, base)
+                        for base in sorted(map(os.path.basename, origs))
+                    ] + ['{}/out/'.format(worker.scratch)])
 
-                for orig_dir in self.orig_dirs:
-                    orig_glob_prefix = glob.escape(
-                        os.path.join(
-                            self.buildable, orig_dir,
-                            '{}_{}'.format(
-                                self.source_package,
-                                self._source_version.upstream_version)))
-
-                    for orig_pattern in (
-                            orig_glob_prefix + '.orig.tar.*',
-                            orig_glob_prefix + '.orig-*.tar.*'):
-                        logger.info(
-                            'Looking for original tarballs: %s', orig_pattern)
-
-                        for orig in glob.glob(orig_pattern):
-                            base = os.path.basename(orig)
-
-                            if base in origs_copied:
-                                logger.info(
-                                    'Already copied %s; ignoring %s', base,
-                                    orig)
-                                continue
-
-                            origs_copied.add(base)
-                            logger.info('Copying original tarball: %s', orig)
-                            worker.copy_to_guest(
-                                orig, '{}/in/{}'.format(
-                                    worker.scratch, base))
-                            worker.check_call([
-                                'ln', '-s',
-                                '{}/in/{}'.format(worker.scratch, base),
-                                '{}/out/{}'.format(worker.scratch, base),
-                            ])
+    def _use_dsc(self, dsc):
+        self.dsc = dsc
+        self.source_package = self.dsc['source']
+        self.source_version = Version(
+            self.dsc['version'])
+        self.arch_wildcards = set(
+            self.dsc['architecture'].split())
+        self.binary_packages = [
+            p.strip() for p in self.dsc['binary'].split(',')]
+
+    def get_source_from_cache(
+        self,
+        worker,                     # type: VirtWorker
+        cache,                      # type: SourceCache
+        source=None,                # type: Optional[str]
+        version=None,               # type: Optional[Version]
+    ):
+        # type: (...) -> bool
+        """
+        Copy the source package from cache into the worker if it is
+        there, and return True, or return False if it is not cached.
+        """
+        if source is None:
+            source = self.source_package
+
+        if version is None:
+            version = self.source_version
+
+        if version is None:
+            return False
+
+        files = cache.lookup(source, version)
+
+        if files is None:
+            return False
+
+        logger.info('Using cached source package %s', files[0])
+        worker.copy_files_to_guest(files, '{}/in'.format(worker.scratch))
+
+        with open(files[0]) as reader:
+            self._use_dsc(Dsc(reader))
+
+        return True
+
+    def _resolve_source_version(self, chroot):
+        # type: (SchrootWorker) -> Tuple[Optional[str], Optional[str]]
+        """
+        Return the source package and version (without epoch) that
+        apt-get source would download, without downloading it, or
+        (None, None) if that cannot be determined.
+        """
+        output = chroot.check_output([
+            'sh',
+            '-euc',
+            'cd /build/"$1"; shift; exec "$@"',
+            'sh',   # argv[0]
+            str(self),
+            'apt-get', '-o=APT::Get::Only-Source=true', '--print-uris',
+            'source', self.source_package,
+        ], universal_newlines=True)
+
+        for line in output.splitlines():
+            fields = line.split()
+
+            if len(fields) >= 2 and fields[1].endswith('.dsc'):
+                source, _, version = fields[1][:-len('.dsc')].partition('_')
+                return source, version
+
+        return None, None
 
     def get_source_from_archive(
         self,
         worker,                     # type: VirtWorker
         chroot,                     # type: SchrootWorker
+        cache=None,                 # type: Optional[SourceCache]
     ):
         # We fetch the source ourselves rather than letting sbuild do
         # it, because for source rebuilds we need the orig.tar.* even
@@ -489,6 +786,14 @@ class Buildable:
         worker.check_call([
             'mkdir', '-p', '-m755', '{}/in'.format(worker.scratch)])
 
+        if cache is not None and self.source_version is None:
+            source, version = self._resolve_source_version(chroot)
+
+            if (version is not None and
+                    self.get_source_from_cache(
+                        worker, cache, source, Version(version))):
+                return
+
         if self.source_version is None:
             chroot.check_call([
                 'sh',
@@ -531,20 +836,24 @@ class Buildable:
 
         product = dscs[0]
 
-        with TemporaryDirectory(prefix='vectis-sbuild-') as tmp:
-            copied_back = os.path.join(
-                tmp, '{}.dsc'.format(self.buildable))
-            worker.copy_to_host(product, copied_back)
+        files = None
 
-            self.dsc = Dsc(open(copied_back))
+        if cache is not None:
+            files = cache.add(worker, product)
 
-        self.source_package = self.dsc['source']
-        self.source_version = Version(
-            self.dsc['version'])
-        self.arch_wildcards = set(
-            self.dsc['architecture'].split())
-        self.binary_packages = [
-            p.strip() for p in self.dsc['binary'].split(',')]
+        if files is not None:
+            with open(files[0]) as reader:
+                dsc = Dsc(reader)
+        else:
+            with TemporaryDirectory(prefix='vectis-sbuild-') as tmp:
+                copied_back = os.path.join(
+                    tmp, '{}.dsc'.format(self.buildable))
+                worker.copy_to_host(product, copied_back)
+
+                with open(copied_back) as reader:
+                    dsc = Dsc(reader)
+
+        self._use_dsc(dsc)
 
         worker.check_call([
             'sh',
@@ -830,14 +1139,17 @@ class Build:
             mirrors,
             profiles,
             storage,
+            chroot_mode='file',
             deb_build_options=(),
             dpkg_buildpackage_options=(),
             dpkg_source_options=(),
             environ=None,
             components=(),
-            extra_repositories=()):
+            extra_repositories=(),
+            out_subdir='out'):
         self.arch = arch
         self.buildable = buildable
+        self.chroot_mode = chroot_mode
         self.components = components
         self.dpkg_buildpackage_options = dpkg_buildpackage_options
         self.dpkg_source_options = dpkg_source_options
@@ -845,6 +1157,7 @@ class Build:
         self.extra_repositories = extra_repositories
         assert not isinstance(profiles, str), profiles
         self.mirrors = mirrors
+        self.out_subdir = out_subdir
         self.profiles = set(profiles)
         self.storage = storage
         self.worker = worker
@@ -855,10 +1168,20 @@ class Build:
 
         self.environ['DEB_BUILD_OPTIONS'] = ' '.join(deb_build_options)
 
+    @property
+    def guest_out(self):
+        """
+        The directory in the worker where this build writes its
+        products. Builds that run concurrently need different
+        directories, because sbuild names some products after the
+        worker's architecture rather than the build's.
+        """
+        return '{}/{}'.format(self.worker.scratch, self.out_subdir)
+
     def sbuild(self, *, sbuild_options=()):
         self.worker.check_call([
             'install', '-d', '-m755', '-osbuild', '-gsbuild',
-            '{}/out'.format(self.worker.scratch)])
+            self.guest_out])
 
         logger.info('Building architecture: %s', self.arch)
 
@@ -875,6 +1198,7 @@ class Build:
             components=self.components,
             extra_repositories=self.extra_repositories,
             mirrors=self.mirrors,
+            mode=self.chroot_mode,
             suite=self.buildable.suite,
             worker=self.worker,
         ) as chroot:
@@ -886,7 +1210,7 @@ class Build:
         argv = [
             self.worker.command_wrapper,
             '--chdir',
-            '{}/out'.format(self.worker.scratch),
+            self.guest_out,
             '--',
             'runuser',
             '-u', 'sbuild',
@@ -994,6 +1318,9 @@ class Build:
                     os.path.basename(self.buildable.dsc_name)))
         elif self.buildable.source_from_archive:
             argv.append(self.buildable.buildable)
+        elif self.buildable.host_source_dsc is not None:
+            argv.append('{}/in/{}'.format(
+                self.worker.scratch, self.buildable.host_source_dsc))
         else:
             # jessie sbuild doesn't support --no-clean-source so build
             # the temporary source package ourselves.
@@ -1025,8 +1352,8 @@ class Build:
             # that's what comes out if we do "vectis sbuild --suite=sid hello".
             for prefix in (self.buildable.source_package,
                            self.buildable.product_prefix):
-                product = '{}/out/{}_{}.build'.format(
-                    self.worker.scratch, prefix, chroot.dpkg_architecture)
+                product = '{}/{}_{}.build'.format(
+                    self.guest_out, prefix, chroot.dpkg_architecture)
                 product = self.worker.check_output(
                     ['readlink', '-f', product],
                     universal_newlines=True).rstrip('\n')
@@ -1076,8 +1403,8 @@ class Build:
         product_arch = None
 
         for candidate in (self.arch, self.worker.dpkg_architecture):
-            product = '{}/out/{}_{}.changes'.format(
-                self.worker.scratch, self.buildable.product_prefix,
+            product = '{}/{}_{}.changes'.format(
+                self.guest_out, self.buildable.product_prefix,
                 candidate)
             if self.worker.call(['test', '-e', product]) == 0:
                 product_arch = candidate
@@ -1137,7 +1464,7 @@ class Build:
     def pbuilder(self, *, sbuild_options=()):
         self.worker.check_call([
             'install', '-d', '-m755',
-            '{}/out'.format(self.worker.scratch)])
+            self.guest_out])
 
         logger.info('Building architecture: %s', self.arch)
 
@@ -1162,7 +1489,7 @@ class Build:
         argv = [
             self.worker.command_wrapper,
             '--chdir',
-            '{}/out'.format(self.worker.scratch),
+            self.guest_out,
             '--',
             'env',
         ]
@@ -1210,13 +1537,15 @@ class Build:
 
         argv.append('--basetgz')
         argv.append('{}'.format(worker.tarball_in_guest))
+        argv.extend(get_pbuilder_compress_options(
+            get_tarball_compression(worker.tarball)))
         argv.append('--buildresult')
-        argv.append('{}/out'.format(self.worker.scratch))
+        argv.append(self.guest_out)
         argv.append('--aptcache')
         argv.append('')
         argv.append('--logfile')
-        argv.append('{}/out/{}_{}.build'.format(
-            self.worker.scratch,
+        argv.append('{}/{}_{}.build'.format(
+            self.guest_out,
             self.buildable.product_prefix,
             worker.dpkg_architecture,
         ))
@@ -1232,8 +1561,8 @@ class Build:
         try:
             self.worker.check_call(argv)
         finally:
-            product = '{}/out/{}_{}.build'.format(
-                self.worker.scratch, self.buildable.product_prefix,
+            product = '{}/{}_{}.build'.format(
+                self.guest_out, self.buildable.product_prefix,
                 worker.dpkg_architecture)
             product = self.worker.check_output(
                 ['readlink', '-f', product],
@@ -1264,8 +1593,8 @@ class Build:
         product_arch = None
 
         for candidate in (self.arch, self.worker.dpkg_architecture):
-            product = '{}/out/{}_{}.changes'.format(
-                self.worker.scratch, self.buildable.product_prefix,
+            product = '{}/{}_{}.changes'.format(
+                self.guest_out, self.buildable.product_prefix,
                 candidate)
             if self.worker.call(['test', '-e', product]) == 0:
                 product_arch = candidate
@@ -1314,7 +1643,7 @@ class Build:
             logger.warning('Unexpected build product %r: %s', base, e)
             return None
         else:
-            product = '{}/out/{}'.format(self.worker.scratch, base)
+            product = '{}/{}'.format(self.guest_out, base)
             copied_back = os.path.join(self.buildable.output_dir, to_base)
             copied_back = os.path.abspath(copied_back)
 
@@ -1351,39 +1680,58 @@ class BuildGroup:
         *,
         binary_version_suffix='',       # type: str
         buildables=(),                  # type: Iterable[str]
+        chroot_mode='file',             # type: str
         components=(),                  # type: Iterable[str]
+        arch_jobs=1,                    # type: int
         deb_build_options=(),           # type: Iterable[str]
         dpkg_buildpackage_options=(),   # type: Iterable[str]
         dpkg_source_options=(),         # type: Iterable[str]
         extra_repositories=(),          # type: Iterable[str]
+        host_source=False,              # type: bool
+        jobs=1,                         # type: int
         link_builds,                    # type: Iterable[str]
+        memory_budget=None,             # type: Optional[MemoryBudget]
         orig_dirs=(),                   # type: Iterable[str]
         output_dir,                     # type: Optional[str]
         output_parent,                  # type: str
         mirrors,                        # type: vectis.config.Mirrors
         profiles=(),                    # type: Iterable[str]
+        qemu_ram_size=None,             # type: Optional[int]
         sbuild_options=(),              # type: Iterable[str]
+        source_cache=True,              # type: bool
         storage,                        # type: str
         suite=None,                     # type: Optional[str]
         vendor,                         # type: vectis.config.Vendor
+        worker_options=None,            # type: Optional[Mapping[str, object]]
     ):
         # type: (...) -> None
 
+        self.arch_jobs = arch_jobs
+        self.chroot_mode = chroot_mode
         self.components = components
         self.deb_build_options = deb_build_options
         self.dpkg_buildpackage_options = dpkg_buildpackage_options
         self.dpkg_source_options = dpkg_source_options
         self.extra_repositories = extra_repositories
+        self.host_source = host_source
+        self.jobs = jobs
         self.link_builds = link_builds
         self.orig_dirs = orig_dirs
         self.output_dir = output_dir
         self.output_parent = output_parent
+        self.memory_budget = memory_budget
         self.mirrors = mirrors
         self.profiles = profiles
+        self.qemu_ram_size = qemu_ram_size
         self.sbuild_options = sbuild_options
+        self.source_cache = source_cache
         self.storage = storage
         self.suite = suite
         self.vendor = vendor
+        self.worker_options = dict(worker_options or {})
+
+        if self.memory_budget is None:
+            self.memory_budget = MemoryBudget()
 
         self.buildables = []            # type: List[Buildable]
 
@@ -1415,25 +1763,40 @@ class BuildGroup:
             if argv == a and suite == s:
                 return w
         else:
-            w = VirtWorker(
-                argv,
-                mirrors=self.mirrors,
-                storage=self.storage,
-                suite=suite,
-            )
-            self.workers.append((argv, suite, w))
-            return w
+            return self._new_worker(argv, suite)
+
+    def _new_worker(
+        self,
+        argv,                           # type: List[str]
+        suite,                          # type: str
+    ):
+        """
+        Return a new worker, configured in the same way as every other
+        worker in this group, and remember it in self.workers.
+        """
+        w = VirtWorker(
+            argv,
+            mirrors=self.mirrors,
+            storage=self.storage,
+            suite=suite,
+            **self.worker_options
+        )
+        self.workers.append((argv, suite, w))
+        return w
 
     def new_build(
         self,
         buildable: Buildable,
         arch: str,
         worker: VirtWorker,
+        out_subdir: str = 'out',
     ):
         return Build(
             buildable,
             arch,
             worker,
+            out_subdir=out_subdir,
+            chroot_mode=self.chroot_mode,
             components=self.components,
             deb_build_options=self.deb_build_options,
             dpkg_buildpackage_options=self.dpkg_buildpackage_options,
@@ -1452,6 +1815,16 @@ class BuildGroup:
         use_arch = worker.dpkg_architecture
 
         if buildable.source_from_archive:
+            cache = None
+
+            if self.source_cache:
+                cache = SourceCache(self.storage)
+                worker.check_call([
+                    'mkdir', '-p', '-m755', '{}/in'.format(worker.scratch)])
+
+                if buildable.get_source_from_cache(worker, cache):
+                    return
+
             with SchrootWorker(
                 storage=self.storage,
                 architecture=use_arch,
@@ -1459,26 +1832,74 @@ class BuildGroup:
                 components=self.components,
                 extra_repositories=self.extra_repositories,
                 mirrors=self.mirrors,
+                mode=self.chroot_mode,
                 suite=buildable.suite,
                 worker=worker,
             ) as chroot:
-                buildable.get_source_from_archive(worker, chroot)
+                buildable.get_source_from_archive(worker, chroot, cache)
         else:
-            buildable.copy_source_to(worker)
+            buildable.copy_source_to(
+                worker,
+                dpkg_source_options=self.dpkg_source_options,
+                host_source=self.host_source,
+                tar_ignore=get_tar_ignore(self.dpkg_source_options))
 
-    def sbuild(
+    def get_sbuild_workers(
         self,
         worker,                     # type: VirtWorker
-        *,
-        archs=(),                   # type: Iterable[str]
-        build_source=None,          # type: Optional[bool]  # None -> auto
-        indep=False,
-        indep_together=False,
-        source_only=False,
-        source_together=False,
     ):
-        with worker:
-            self._sbuild(worker)
+        """
+        Return a WorkerGroup of worker and enough similar workers to
+        build jobs buildables at a time, each provisioned for sbuild.
+        Each worker holds qemu_ram_size bytes of memory_budget while
+        it is open.
+        """
+        workers = [worker]
+        worker.provision(SBUILD)
+
+        for i in range(min(self.jobs, len(self.buildables)) - 1):
+            # get_worker() would return worker itself, so make a new one
+            # the same way
+            w = self._new_worker(worker.argv, worker.suite)
+            w.provision(SBUILD)
+            workers.append(w)
+
+        return WorkerGroup(
+            workers,
+            memory_budget=self.memory_budget,
+            memory_size=self.qemu_ram_size,
+        )
+
+    def add_sbuild_tasks(
+        self,
+        scheduler,                  # type: Scheduler
+        workers,                    # type: WorkerGroup
+        **kwargs
+    ):
+        """
+        Add a task to scheduler to build each buildable on a worker
+        leased from workers, using the 'sbuild' resource, with the same
+        keyword arguments as _sbuild(). Return the tasks, in the same
+        order as the buildables.
+        """
+        return [
+            scheduler.add(
+                'sbuild {}'.format(buildable),
+                functools.partial(
+                    self._sbuild_leased, workers, buildable, kwargs),
+                resource='sbuild',
+                tag=str(buildable),
+            )
+            for buildable in self.buildables]
+
+    def _sbuild_leased(
+        self,
+        workers,                    # type: WorkerGroup
+        buildable,                  # type: Buildable
+        kwargs,                     # type: Dict[str, object]
+    ):
+        with workers.lease() as worker:
+            self._sbuild(worker, buildables=[buildable], **kwargs)
 
     def _sbuild(
         self,
@@ -1486,35 +1907,16 @@ class BuildGroup:
         *,
         archs=(),                   # type: Iterable[str]
         build_source=None,          # type: Optional[bool]  # None -> auto
+        buildables=None,            # type: Optional[Iterable[Buildable]]
         indep=False,
         indep_together=False,
         source_only=False,
         source_together=False,
     ):
+        if buildables is None:
+            buildables = self.buildables
 
-        logger.info('Installing sbuild')
-        worker.check_call([
-            'env',
-            'DEBIAN_FRONTEND=noninteractive',
-            'apt-get',
-            '-y',
-            '-t', worker.suite.apt_suite,
-            '--no-install-recommends',
-            'install',
-
-            'python3',
-            'sbuild',
-            'schroot',
-        ])
-        # Be like the real Debian build infrastructure: give sbuild a
-        # nonexistent home directory.
-        worker.check_call([
-            'usermod',
-            '-d', '/nonexistent',
-            'sbuild',
-        ])
-
-        for buildable in self.buildables:
+        for buildable in buildables:
             logger.info('Processing: %s', buildable)
             self.get_source(buildable, worker)
             buildable.select_archs(
@@ -1528,12 +1930,53 @@ class BuildGroup:
             )
 
             logger.info('Builds required: %r', list(buildable.archs))
+            self._sbuild_archs(buildable, worker)
+            buildable.merge_changes()
 
-            for arch in buildable.archs:
+    def _sbuild_archs(
+        self,
+        buildable,                  # type: Buildable
+        worker,                     # type: VirtWorker
+    ):
+        archs = list(buildable.archs)
+
+        # The build that produces the source package must finish first,
+        # because the others build from its output
+        while archs and archs[0] in (
+                'source', buildable.source_together_with):
+            self.new_build(buildable, archs.pop(0), worker).sbuild(
+                sbuild_options=self.sbuild_options)
+
+        if self.arch_jobs <= 1 or len(archs) <= 1:
+            for arch in archs:
                 self.new_build(buildable, arch, worker).sbuild(
                     sbuild_options=self.sbuild_options)
 
-            buildable.merge_changes()
+            return
+
+        logger.info(
+            'Building %r concurrently, up to %d at a time',
+            archs, self.arch_jobs)
+
+        with ThreadPoolExecutor(max_workers=self.arch_jobs) as executor:
+            futures = [
+                executor.submit(
+                    propagate_tag(self.new_build(
+                        buildable, arch, worker,
+                        out_subdir='out-{}'.format(arch),
+                    ).sbuild),
+                    sbuild_options=self.sbuild_options)
+                for arch in archs]
+
+        # Report the first failure in the order the builds were listed
+        for future in futures:
+            future.result()
+
+        # Merge the .changes files in the same order as a sequential build
+        for arch in buildable.archs:
+            if arch in buildable.changes_produced:
+                buildable.changes_produced[arch] = (
+                    buildable.changes_produced.pop(arch))
 
     def pbuilder(
         self,
@@ -1543,6 +1986,8 @@ class BuildGroup:
         indep=False,
         indep_together=False,
     ):
+        worker.provision(PBUILDER)
+
         with worker:
             self._pbuilder(worker)
 
@@ -1559,23 +2004,6 @@ class BuildGroup:
                 raise ArgumentError(
                     'pbuilder can only build a .dsc file')
 
-        logger.info('Installing pbuilder')
-        worker.check_call([
-            'env',
-            'DEBIAN_FRONTEND=noninteractive',
-            'apt-get',
-            '-y',
-            '-t', worker.suite.apt_suite,
-            '--no-install-recommends',
-            'install',
-
-            'eatmydata',
-            'fakeroot',
-            'net-tools',
-            'pbuilder',
-            'python3',
-        ])
-
         for buildable in self.buildables:
             logger.info('Processing: %s', buildable)
             self.get_source(buildable, worker)
@@ -1596,10 +2024,85 @@ class BuildGroup:
 
             buildable.merge_changes()
 
+    def get_test_architectures(
+        self,
+        buildable,                      # type: Buildable
+        default_architecture,           # type: str
+    ):
+        test_architectures = []
+
+        for arch in buildable.archs:
+            if arch != 'all' and arch != 'source':
+                test_architectures.append(arch)
+
+        if 'all' in buildable.archs and not test_architectures:
+            test_architectures.append(default_architecture)
+
+        return test_architectures
+
+    def _get_autopkgtest_source(
+        self,
+        buildable,                      # type: Buildable
+    ):
+        """
+        Return (source_dsc, source_package) for autopkgtest to test
+        buildable, or None if it has no tests that we can run.
+        """
+        source_dsc = None
+        source_package = None
+
+        if buildable.dsc_name is not None:
+            source_dsc = buildable.dsc_name
+            logger.info('Testing source changes file %s', source_dsc)
+        elif buildable.source_from_archive:
+            source_package = buildable.source_package
+            logger.info('Testing source package %s', source_package)
+        else:
+            logger.warning(
+                'Unable to run autopkgtest on %s', buildable.buildable)
+            return None
+
+        if (buildable.dsc is not None and
+                'testsuite' not in buildable.dsc):
+            logger.info('No autopkgtests available')
+            return None
+
+        return source_dsc, source_package
+
+    def _autopkgtest_arch(
+        self,
+        buildable,                      # type: Buildable
+        architecture,                   # type: str
+        source,                         # type: Tuple[str, str]
+        *,
+        memory_budget=None,             # type: Optional[MemoryBudget]
+        **kwargs
+    ):
+        source_dsc, source_package = source
+
+        buildable.autopkgtest_failures.extend(
+            run_autopkgtest(
+                architecture=architecture,
+                binaries=buildable.get_debs(architecture),
+                components=self.components,
+                extra_repositories=self.extra_repositories,
+                memory_budget=memory_budget,
+                mirrors=self.mirrors,
+                output_logs=buildable.output_dir,
+                source_dsc=source_dsc,
+                source_package=source_package,
+                storage=self.storage,
+                suite=buildable.suite,
+                vendor=self.vendor,
+                **kwargs
+            ),
+        )
+
     def autopkgtest(
         self,
         *,
         default_architecture,           # type: str
+        jobs=None,                      # type: Optional[int]
         lxc_24bit_subnet,               # type: str
         lxc_worker,                     # type: List[str]
         lxd_worker,                     # type: List[str]
@@ -1610,63 +2113,101 @@ class BuildGroup:
     ):
         for buildable in self.buildables:
             try:
-                source_dsc = None
-                source_package = None
-
-                if buildable.dsc_name is not None:
-                    source_dsc = buildable.dsc_name
-                    logger.info('Testing source changes file %s', source_dsc)
-                elif buildable.source_from_archive:
-                    source_package = buildable.source_package
-                    logger.info('Testing source package %s', source_package)
-                else:
-                    logger.warning(
-                        'Unable to run autopkgtest on %s', buildable.buildable)
-                    continue
+                source = self._get_autopkgtest_source(buildable)
 
-                if (buildable.dsc is not None and
-                        'testsuite' not in buildable.dsc):
-                    logger.info('No autopkgtests available')
+                if source is None:
                     continue
 
-                test_architectures = []
-
-                for arch in buildable.archs:
-                    if arch != 'all' and arch != 'source':
-                        test_architectures.append(arch)
-
-                if 'all' in buildable.archs and not test_architectures:
-                    test_architectures.append(default_architecture)
-
+                test_architectures = self.get_test_architectures(
+                    buildable, default_architecture)
                 logger.info('Testing on architectures: %r', test_architectures)
 
                 for architecture in test_architectures:
-                    buildable.autopkgtest_failures.extend(
-                        run_autopkgtest(
-                            architecture=architecture,
-                            binaries=buildable.get_debs(architecture),
-                            components=self.components,
-                            extra_repositories=self.extra_repositories,
-                            lxc_24bit_subnet=lxc_24bit_subnet,
-                            lxc_worker=lxc_worker,
-                            lxd_worker=lxd_worker,
-                            mirrors=self.mirrors,
-                            modes=modes,
-                            output_logs=buildable.output_dir,
-                            qemu_ram_size=qemu_ram_size,
-                            schroot_worker=schroot_worker,
-                            source_dsc=source_dsc,
-                            source_package=source_package,
-                            storage=self.storage,
-                            suite=buildable.suite,
-                            vendor=self.vendor,
-                            worker=worker,
-                        ),
+                    self._autopkgtest_arch(
+                        buildable,
+                        architecture,
+                        source,
+                        jobs=jobs,
+                        lxc_24bit_subnet=lxc_24bit_subnet,
+                        lxc_worker=lxc_worker,
+                        lxd_worker=lxd_worker,
+                        modes=modes,
+                        qemu_ram_size=qemu_ram_size,
+                        schroot_worker=schroot_worker,
+                        worker=worker,
                     )
             except KeyboardInterrupt:
                 buildable.autopkgtest_failures.append('interrupted')
                 raise
 
+    def add_autopkgtest_tasks(
+        self,
+        scheduler,                      # type: Scheduler
+        buildable,                      # type: Buildable
+        *,
+        after=(),                       # type: Iterable[Task]
+        default_architecture,           # type: str
+        memory_budget=None,             # type: Optional[MemoryBudget]
+        **kwargs
+    ):
+        """
+        Add a task to scheduler for each architecture of buildable that
+        autopkgtest should test, using the 'test' resource, with the
+        same keyword arguments as autopkgtest(). Return the tasks.
+
+        The virtual machines for all the tests share memory_budget, so
+        pass the same one every time.
+        """
+        source = self._get_autopkgtest_source(buildable)
+
+        if source is None:
+            return []
+
+        test_architectures = self.get_test_architectures(
+            buildable, default_architecture)
+        logger.info(
+            'Testing %s on architectures: %r', buildable, test_architectures)
+
+        return [
+            scheduler.add(
+                'autopkgtest {} {}'.format(buildable, architecture),
+                functools.partial(
+                    self._autopkgtest_arch,
+                    buildable, architecture, source,
+                    memory_budget=memory_budget, **kwargs),
+                after=after,
+                cancel=functools.partial(
+                    _mark_interrupted, buildable.autopkgtest_failures),
+                resource='test',
+            )
+            for architecture in test_architectures]
+
+    def _piuparts_arch(
+        self,
+        buildable,                      # type: Buildable
+        architecture,                   # type: str
+        *,
+        tarballs,                       # type: Iterable[str]
+        worker,                         # type: VirtWorker
+    ):
+        buildable.piuparts_failures.extend(
+            run_piuparts(
+                architecture=architecture,
+                binaries=(
+                    Binary(b, deb=b)
+                    for b in buildable.get_debs(architecture)),
+                components=self.components,
+                extra_repositories=self.extra_repositories,
+                mirrors=self.mirrors,
+                output_logs=buildable.output_dir,
+                storage=self.storage,
+                suite=buildable.suite,
+                tarballs=tarballs,
+                vendor=self.vendor,
+                worker=worker,
+            ),
+        )
+
     def piuparts(
         self,
         *,
@@ -1676,37 +2217,58 @@ class BuildGroup:
     ):
         for buildable in self.buildables:
             try:
-                test_architectures = []
-
-                for arch in buildable.archs:
-                    if arch != 'all' and arch != 'source':
-                        test_architectures.append(arch)
-
-                if 'all' in buildable.archs and not test_architectures:
-                    test_architectures.append(default_architecture)
+                test_architectures = self.get_test_architectures(
+                    buildable, default_architecture)
 
                 logger.info(
                     'Running piuparts on architectures: %r',
                     test_architectures)
 
                 for architecture in test_architectures:
-                    buildable.piuparts_failures.extend(
-                        run_piuparts(
-                            architecture=architecture,
-                            binaries=(
-                                Binary(b, deb=b)
-                                for b in buildable.get_debs(architecture)),
-                            components=self.components,
-                            extra_repositories=self.extra_repositories,
-                            mirrors=self.mirrors,
-                            output_logs=buildable.output_dir,
-                            storage=self.storage,
-                            suite=buildable.suite,
-                            tarballs=tarballs,
-                            vendor=self.vendor,
-                            worker=worker,
-                        ),
+                    self._piuparts_arch(
+                        buildable,
+                        architecture,
+                        tarballs=tarballs,
+                        worker=worker,
                     )
             except KeyboardInterrupt:
                 buildable.piuparts_failures.append('interrupted')
                 raise
+
+    def add_piuparts_tasks(
+        self,
+        scheduler,                      # type: Scheduler
+        buildable,                      # type: Buildable
+        *,
+        after=(),                       # type: Iterable[Task]
+        default_architecture,           # type: str
+        tarballs,                       # type: Iterable[str]
+        worker,                         # type: VirtWorker
+    ):
+        """
+        Add a task to scheduler for each architecture of buildable that
+        piuparts should test, using the 'test' resource. Return the
+        tasks.
+        """
+        test_architectures = self.get_test_architectures(
+            buildable, default_architecture)
+        logger.info(
+            'Running piuparts on %s on architectures: %r',
+            buildable, test_architectures)
+
+        return [
+            scheduler.add(
+                'piuparts {} {}'.format(buildable, architecture),
+                functools.partial(
+                    self._piuparts_arch,
+                    buildable,
+                    architecture,
+                    tarballs=tarballs,
+                    worker=worker,
+                ),
+                after=after,
+                cancel=functools.partial(
+                    _mark_interrupted, buildable.piuparts_failures),
+                resource='test',
+            )
+            for architecture in test_architectures]
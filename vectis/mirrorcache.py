@@ -0,0 +1,374 @@
+# Copyright © 2018 Simon McVittie
+# SPDX-License-Identifier: GPL-2.0+
+# (see vectis/__init__.py)
+
+import email.utils
+import http.server
+import ipaddress
+import json
+import logging
+import os
+import shutil
+import socketserver
+import tempfile
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+from contextlib import suppress
+
+from vectis.error import (
+    ArgumentError,
+)
+
+logger = logging.getLogger(__name__)
+
+# Suffix of the files recording how to revalidate a cached index file
+_META = '.vectis-meta'
+
+# The largest file that will be downloaded into the cache
+_MAX_FILE_SIZE = 2 * 1024 * 1024 * 1024
+
+_CHUNK_SIZE = 64 * 1024
+
+
+def is_immutable(path):
+    """
+    Return True if the file at path in a Debian-style archive never
+    changes once it has been published.
+    """
+    parts = path.split('/')
+    return 'pool' in parts[:-1] or 'by-hash' in parts[:-1]
+
+
+class MirrorCache:
+    """
+    A directory of files downloaded from Debian-style archives.
+
+    Files in pool/ and by-hash/ directories never change, so once they
+    have been downloaded they are served from disk. Anything else, such
+    as the index files in dists/, is revalidated with the upstream
+    server on every request, and only downloaded again if it changed.
+
+    A request for /HOST/PATH is satisfied from http://HOST/PATH.
+    Files larger than max_file_size bytes are not downloaded.
+    """
+
+    def __init__(self, directory, *, max_file_size=_MAX_FILE_SIZE,
+                 timeout=60):
+        self.directory = directory
+        self.max_file_size = max_file_size
+        self.timeout = timeout
+        self.__lock = threading.Lock()
+        self.__url_locks = {}
+
+    def _lock_url(self, url):
+        with self.__lock:
+            return self.__url_locks.setdefault(url, threading.Lock())
+
+    def get_url(self, path):
+        """
+        Return the upstream URL for path, or None if it is not valid.
+        """
+        path = urllib.parse.unquote(path.split('?', 1)[0])
+        parts = path.lstrip('/').split('/')
+
+        if len(parts) < 2 or not parts[0] or not parts[-1]:
+            return None
+
+        if '..' in parts or '.' in parts or '' in parts:
+            return None
+
+        if parts[-1].endswith(_META):
+            return None
+
+        return 'http://' + '/'.join(parts)
+
+    def get_cache_path(self, url):
+        return os.path.join(self.directory, url[len('http://'):])
+
+    def fetch(self, url, *, stream=None):
+        """
+        Make sure an up-to-date copy of url is in the cache, and return
+        its filename, or None if it does not exist upstream.
+
+        If url has to be downloaded and stream is not None, call
+        stream(headers) with the upstream response headers when the
+        download starts. If it returns a file-like object, the
+        download is also written to that object as it arrives.
+        """
+        path = self.get_cache_path(url)
+
+        # Only one thread downloads each file; the others wait for it
+        with self._lock_url(url):
+            if os.path.exists(path) and is_immutable(url):
+                logger.debug('Cache hit: %s', url)
+                # Record the time of use for "vectis storage gc"
+                with suppress(FileNotFoundError):
+                    os.utime(path)
+
+                return path
+
+            return self._download(url, path, stream)
+
+    def list(self):
+        """
+        Yield (path, os.stat_result) for each file in the cache, not
+        including partial downloads.
+        """
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            for name in filenames:
+                if name.startswith('.') or name.endswith(_META):
+                    continue
+
+                with suppress(FileNotFoundError):
+                    path = os.path.join(dirpath, name)
+                    yield path, os.stat(path)
+
+    def list_partial(self):
+        """
+        Yield (path, os.stat_result) for each partial download in the
+        cache, which might still be in progress.
+        """
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            for name in filenames:
+                if name.startswith('.'):
+                    with suppress(FileNotFoundError):
+                        path = os.path.join(dirpath, name)
+                        yield path, os.stat(path)
+
+    def delete(self, path):
+        """
+        Delete path, a file in the cache returned by list().
+        """
+        for f in (path, path + _META):
+            with suppress(FileNotFoundError):
+                os.unlink(f)
+
+    def _download(self, url, path, stream):
+        headers = {}
+        meta = {}
+
+        if os.path.exists(path):
+            with suppress(OSError, ValueError):
+                with open(path + _META) as reader:
+                    meta = json.load(reader)
+
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+
+        request = urllib.request.Request(url, headers=headers)
+
+        try:
+            response = urllib.request.urlopen(request, timeout=self.timeout)
+        except urllib.error.HTTPError as e:
+            if e.code == 304:
+                logger.debug('Not modified: %s', url)
+
+                with suppress(FileNotFoundError):
+                    os.utime(path)
+
+                return path
+
+            if e.code in (404, 410):
+                logger.info('Not found upstream: %s', url)
+                return None
+
+            return self._stale(url, path, e)
+        except OSError as e:
+            return self._stale(url, path, e)
+
+        length = None
+
+        with suppress(TypeError, ValueError):
+            length = int(response.headers.get('Content-Length'))
+
+        if length is not None and length > self.max_file_size:
+            response.close()
+            raise ValueError(
+                '{} is too large to cache: {} bytes'.format(url, length))
+
+        logger.info('Downloading %s', url)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(
+            dir=os.path.dirname(path),
+            prefix='.' + os.path.basename(path) + '.')
+
+        try:
+            with response, open(fd, 'wb') as writer:
+                client = None
+
+                if stream is not None:
+                    client = stream(response.headers)
+
+                size = 0
+
+                for chunk in iter(lambda: response.read(_CHUNK_SIZE), b''):
+                    size += len(chunk)
+
+                    if size > self.max_file_size:
+                        raise ValueError(
+                            '{} is too large to cache: more than {} '
+                            'bytes'.format(url, self.max_file_size))
+
+                    writer.write(chunk)
+
+                    if client is not None:
+                        try:
+                            client.write(chunk)
+                        except OSError as e:
+                            # Finish downloading it for the next client
+                            logger.debug(
+                                'Client stopped receiving %s: %s', url, e)
+                            client = None
+
+            meta = dict(
+                etag=response.headers.get('ETag'),
+                last_modified=response.headers.get('Last-Modified'),
+            )
+
+            if not is_immutable(url):
+                with open(tmp + _META, 'w') as writer:
+                    json.dump(meta, writer)
+
+                os.replace(tmp + _META, path + _META)
+
+            os.replace(tmp, path)
+        except BaseException:
+            with suppress(FileNotFoundError):
+                os.unlink(tmp)
+
+            with suppress(FileNotFoundError):
+                os.unlink(tmp + _META)
+
+            raise
+
+        return path
+
+    def _stale(self, url, path, error):
+        if os.path.exists(path):
+            logger.warning('Unable to revalidate %s, using cached copy: %s',
+                           url, error)
+            return path
+
+        raise error
+
+
+class _CacheHandler(http.server.BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        logger.debug('%s: %s', self.address_string(), format % args)
+
+    def do_HEAD(self):
+        self._serve(send_body=False)
+
+    def do_GET(self):
+        self._serve(send_body=True)
+
+    def _serve(self, *, send_body):
+        cache = self.server.cache
+        url = cache.get_url(self.path)
+
+        if url is None:
+            self.send_error(404)
+            return
+
+        streamed = False
+
+        def stream(headers):
+            nonlocal streamed
+
+            # Pass the download on as it arrives, instead of making the
+            # client wait until it is complete
+            streamed = True
+            self._send_headers(
+                headers.get('Content-Length'),
+                headers.get('Last-Modified'))
+            return self.wfile if send_body else None
+
+        try:
+            path = cache.fetch(url, stream=stream)
+        except Exception as e:
+            logger.warning('Unable to fetch %s: %s', url, e)
+
+            if streamed:
+                # Too late to report an error: the client will see a
+                # truncated response
+                self.close_connection = True
+            else:
+                self.send_error(502, explain=str(e))
+
+            return
+
+        if streamed:
+            return
+
+        if path is None:
+            self.send_error(404)
+            return
+
+        with open(path, 'rb') as reader:
+            stat = os.fstat(reader.fileno())
+            self._send_headers(
+                str(stat.st_size),
+                email.utils.formatdate(stat.st_mtime, usegmt=True))
+
+            if send_body:
+                shutil.copyfileobj(reader, self.wfile)
+
+    def _send_headers(self, length, last_modified):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+
+        if length is not None:
+            self.send_header('Content-Length', length)
+        else:
+            self.close_connection = True
+
+        if last_modified is not None:
+            self.send_header('Last-Modified', last_modified)
+
+        self.end_headers()
+
+
+def check_listen_address(host):
+    """
+    Raise ArgumentError if host is not an address on which the mirror
+    cache may listen: it downloads from any server that its clients
+    ask for, so it must not be reachable from other machines.
+    """
+    if host == 'localhost':
+        return
+
+    try:
+        address = ipaddress.ip_address(host)
+    except ValueError:
+        address = None
+
+    # 10.0.2.2 is how qemu's user-mode networking reaches the host
+    if address is not None and (
+            address.is_loopback or
+            address == ipaddress.ip_address('10.0.2.2')):
+        return
+
+    raise ArgumentError(
+        'The mirror cache can only listen on localhost, a loopback '
+        'address or 10.0.2.2, not {!r}'.format(host))
+
+
+class MirrorCacheServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """
+    A caching HTTP proxy for Debian-style archives, serving the
+    contents of a MirrorCache. The address must be accepted by
+    check_listen_address().
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, cache):
+        check_listen_address(address[0])
+        super().__init__(address, _CacheHandler)
+        self.cache = cache
@@ -13,6 +13,15 @@ from contextlib import (
 from vectis.apt import (
     AptSource,
 )
+from vectis.provision import (
+    PIUPARTS,
+    ZSTD,
+)
+from vectis.util import (
+    find_tarball,
+    get_tar_compress_options,
+    get_tarball_compression,
+)
 from vectis.worker import (
     ContainerWorker,
     FileProvider,
@@ -45,12 +54,15 @@ class PiupartsWorker(FileProvider, ContainerWorker):
             architecture,
             mirrors,
             suite,
-            tarball,
             components=(),
+            existing_chroot=None,
             extra_repositories=(),
+            tarball=None,
             worker=None):
         super().__init__(mirrors=mirrors, suite=suite)
 
+        assert (tarball is None) != (existing_chroot is None)
+
         if worker is None:
             worker = self.stack.enter_context(HostWorker())
 
@@ -61,9 +73,13 @@ class PiupartsWorker(FileProvider, ContainerWorker):
             'piuparts',
             '--arch',
             architecture,
-            '-b',
-            tarball,
         ]
+
+        if existing_chroot is not None:
+            self.argv.extend(['--existing-chroot', existing_chroot])
+        else:
+            self.argv.extend(['-b', tarball])
+
         self.components = components
         self.extra_repositories = extra_repositories
         self.worker = worker
@@ -180,6 +196,11 @@ class PiupartsWorker(FileProvider, ContainerWorker):
 
         return in_guest
 
+    def make_files_available(self, filenames, *, owner=None):
+        d = self.worker.make_files_available(filenames, owner=owner)
+        self.argv.append('--bindmount={}'.format(d))
+        return d
+
     def make_dsc_file_available(self, filename, owner=None):
         d, f = self.worker.make_dsc_file_available(filename)
         self.argv.append('--bindmount={}'.format(d))
@@ -209,40 +230,47 @@ def run_piuparts(
     binaries = list(binaries)
 
     with ExitStack() as stack:
+        worker.provision(PIUPARTS)
         stack.enter_context(worker)
-        worker.check_call([
-            'env',
-            'DEBIAN_FRONTEND=noninteractive',
-            'apt-get',
-            '-y',
-            '-t', worker.suite.apt_suite,
-            'install',
-
-            'piuparts',
-        ])
 
         for basename in tarballs:
-            tarball = os.path.join(
+            tarball = find_tarball(os.path.join(
                 storage,
                 architecture,
                 str(vendor),
                 str(suite.hierarchy[-1]),
-                basename)
+                basename))
 
             if not os.path.exists(tarball):
                 logger.info('Required tarball %s does not exist',
                             tarball)
                 continue
 
+            tarball_in_guest = worker.make_file_available(
+                tarball, cache=True)
+            compression = get_tarball_compression(tarball)
+
+            if compression == 'zstd':
+                # piuparts can only decompress gzip tarballs itself
+                worker.provision(ZSTD)
+                existing_chroot = worker.new_directory()
+                worker.check_call(
+                    ['tar', '-C', existing_chroot] +
+                    get_tar_compress_options(compression) +
+                    ['-xf', tarball_in_guest])
+                tarball_in_guest = None
+            else:
+                existing_chroot = None
+
             piuparts = stack.enter_context(
                 PiupartsWorker(
                     architecture=architecture,
                     components=components,
+                    existing_chroot=existing_chroot,
                     extra_repositories=extra_repositories,
                     mirrors=mirrors,
                     suite=suite,
-                    tarball=worker.make_file_available(
-                        tarball, cache=True),
+                    tarball=tarball_in_guest,
                     worker=worker,
                 )
             )
@@ -268,9 +296,7 @@ def run_piuparts(
                         failures.append(output_dir)
 
                 if output_dir is not None:
-                    worker.copy_to_host(
-                        os.path.join(output_on_worker, ''),
-                        os.path.join(output_dir, ''),
-                    )
+                    os.makedirs(output_dir, exist_ok=True)
+                    worker.copy_tree_to_host(output_on_worker, output_dir)
 
     return failures
@@ -0,0 +1,286 @@
+# Copyright © 2018 Simon McVittie
+# SPDX-License-Identifier: GPL-2.0+
+# (see vectis/__init__.py)
+
+import json
+import logging
+import os
+import queue
+import socketserver
+import threading
+
+from vectis.worker import (
+    VirtWorker,
+    WorkerError,
+)
+
+logger = logging.getLogger(__name__)
+
+# A client that sends one of these is finished with its lease.
+_END_OF_LEASE = ('close', 'quit')
+# Only the pool itself may send these to a worker.
+_FORBIDDEN = ('open', 'revert')
+
+
+class WorkerPoolKey:
+
+    def __init__(
+            self,
+            *,
+            argv,
+            suite,
+            components=(),
+            extra_repositories=()):
+        self.argv = list(argv)
+        self.components = sorted(components)
+        self.extra_repositories = list(extra_repositories)
+        self.suite = suite
+
+    def __hash__(self):
+        return hash(self._tuple())
+
+    def __eq__(self, other):
+        return self._tuple() == other._tuple()
+
+    def __repr__(self):
+        return '<WorkerPoolKey {} {}/{}>'.format(
+            self.argv, self.suite.vendor, self.suite)
+
+    def _tuple(self):
+        return (
+            tuple(self.argv),
+            str(self.suite.vendor),
+            str(self.suite),
+            tuple(self.components),
+            tuple(self.extra_repositories),
+        )
+
+
+class WorkerPool:
+    """
+    A set of booted, apt-configured VirtWorker instances, kept ready
+    so that they can be handed out to vectis processes on demand.
+    """
+
+    def __init__(
+            self,
+            *,
+            mirrors,
+            storage,
+            size=1,
+            worker_options=None):
+        self.mirrors = mirrors
+        self.size = size
+        self.storage = storage
+        self.worker_options = dict(worker_options or {})
+        self.__booting = {}
+        self.__closed = False
+        self.__idle = {}
+        self.__lock = threading.Lock()
+
+    def warm(self, key):
+        """
+        Start keeping self.size workers matching key ready.
+        """
+        with self.__lock:
+            if key not in self.__idle:
+                logger.info('Keeping %d workers ready for %r', self.size, key)
+                self.__idle[key] = queue.Queue()
+                self.__booting[key] = 0
+
+        self._fill(key)
+
+    def _fill(self, key):
+        with self.__lock:
+            if self.__closed:
+                return
+
+            wanted = (
+                self.size - self.__idle[key].qsize() - self.__booting[key])
+
+            for i in range(wanted):
+                self.__booting[key] += 1
+                threading.Thread(
+                    target=self._boot, args=(key,), daemon=True).start()
+
+    def _boot(self, key):
+        worker = VirtWorker(
+            key.argv,
+            components=key.components,
+            extra_repositories=key.extra_repositories,
+            mirrors=self.mirrors,
+            storage=self.storage,
+            suite=key.suite,
+            **self.worker_options
+        )
+
+        try:
+            worker.__enter__()
+        except Exception as e:
+            logger.exception('Unable to start worker for %r', key)
+            worker.__exit__(None, None, None)
+            result = e
+        else:
+            logger.info('Worker %r ready', worker)
+            result = worker
+
+        with self.__lock:
+            self.__booting[key] -= 1
+            closed = self.__closed
+
+            if closed:
+                # Nobody will take it now, but don't leave anyone who is
+                # still waiting in acquire() waiting forever
+                self.__idle[key].put(WorkerError('Worker pool closed'))
+            else:
+                self.__idle[key].put(result)
+
+        if closed and not isinstance(result, Exception):
+            logger.info('Worker pool closed, discarding %r', worker)
+            worker.__exit__(None, None, None)
+
+    def acquire(self, key):
+        """
+        Return a ready worker matching key, waiting for one to boot
+        if necessary.
+        """
+        self.warm(key)
+        worker = self.__idle[key].get()
+        self._fill(key)
+
+        if isinstance(worker, Exception):
+            raise WorkerError(
+                'Unable to start worker for {!r}: {}'.format(key, worker))
+
+        return worker
+
+    def release(self, key, worker):
+        """
+        Take back a worker that was handed out by acquire(). It is
+        reverted to its pristine state if possible, or discarded.
+        """
+        threading.Thread(
+            target=self._recycle, args=(key, worker), daemon=True).start()
+
+    def _recycle(self, key, worker):
+        with self.__lock:
+            keep = (
+                not self.__closed and
+                'revert' in worker.capabilities and
+                self.__idle[key].qsize() < self.size)
+
+        if keep:
+            try:
+                worker.revert()
+            except Exception:
+                logger.exception('Unable to revert worker %r', worker)
+            else:
+                logger.info('Worker %r reverted and ready', worker)
+                self.__idle[key].put(worker)
+                return
+
+        logger.info('Discarding worker %r', worker)
+        worker.__exit__(None, None, None)
+        self._fill(key)
+
+    def close(self):
+        with self.__lock:
+            self.__closed = True
+
+        for idle in self.__idle.values():
+            while True:
+                try:
+                    worker = idle.get_nowait()
+                except queue.Empty:
+                    break
+
+                if not isinstance(worker, Exception):
+                    worker.__exit__(None, None, None)
+
+
+class _LeaseHandler(socketserver.StreamRequestHandler):
+
+    def _reply(self, line):
+        self.wfile.write((line + '\n').encode('utf-8'))
+        self.wfile.flush()
+
+    def handle(self):
+        pool = self.server.pool
+        line = self.rfile.readline().decode('utf-8')
+
+        if not line.startswith('lease '):
+            self._reply('error expected "lease"')
+            return
+
+        try:
+            request = json.loads(line[len('lease '):])
+            suite = self.server.get_suite(
+                request['vendor'], request['suite'])
+            key = WorkerPoolKey(
+                argv=request['argv'],
+                components=request.get('components', ()),
+                extra_repositories=request.get('extra_repositories', ()),
+                suite=suite,
+            )
+            worker = pool.acquire(key)
+        except Exception as e:
+            logger.warning('Unable to lease a worker: %s', e)
+            self._reply('error {}'.format(e))
+            return
+
+        logger.info('Leasing %r', worker)
+
+        try:
+            if worker.cache_mounted:
+                cache_image = worker.cache_disk.image
+                cache_size = worker.cache_disk.size
+            else:
+                cache_image = None
+                cache_size = 0
+
+            self._reply('ok {}'.format(json.dumps({
+                'cache_image': cache_image,
+                'cache_size': cache_size,
+                'call_argv': worker.call_argv,
+                'capabilities': sorted(worker.capabilities),
+                'command_wrapper': worker.command_wrapper,
+                'scratch': worker.scratch,
+                'user': worker.user,
+            })))
+
+            while True:
+                line = self.rfile.readline().decode('utf-8')
+
+                if not line:
+                    break
+
+                command = line.rstrip('\n')
+
+                if command in _END_OF_LEASE:
+                    break
+
+                if command.split(' ', 1)[0] in _FORBIDDEN:
+                    self._reply('error {!r} is managed by the worker '
+                                'pool'.format(command))
+                    continue
+
+                self._reply(worker.virt_command(command).rstrip('\n'))
+        finally:
+            logger.info('Lease of %r ended', worker)
+            pool.release(key, worker)
+
+
+class WorkerPoolServer(socketserver.ThreadingMixIn,
+                       socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, *, get_suite, pool):
+        self.get_suite = get_suite
+        self.pool = pool
+
+        old_umask = os.umask(0o077)
+
+        try:
+            super().__init__(path, _LeaseHandler)
+        finally:
+            os.umask(old_umask)
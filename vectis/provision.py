@@ -0,0 +1,153 @@
+# Copyright © 2018 Simon McVittie
+# SPDX-License-Identifier: GPL-2.0+
+# (see vectis/__init__.py)
+
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class Recipe:
+    """
+    The steps needed to provision a worker for one purpose: packages
+    to install from the worker's suite, then commands to run as root.
+
+    Recipes are compared by content, so that a worker can tell whether
+    it has already been provisioned with an equivalent recipe, and a
+    snapshot of a provisioned worker can be identified by the recipes
+    that were applied to it.
+    """
+
+    def __init__(
+            self,
+            name,
+            *,
+            commands=(),
+            install_recommends=True,
+            packages=()):
+        self.commands = tuple(tuple(argv) for argv in commands)
+        self.install_recommends = install_recommends
+        self.name = name
+        self.packages = tuple(sorted(packages))
+
+    def __str__(self):
+        return self.name
+
+    def __repr__(self):
+        return '<Recipe {}>'.format(self.name)
+
+    def get_inputs(self):
+        """
+        Return a JSON-serializable description of this recipe.
+        """
+        return dict(
+            commands=[list(argv) for argv in self.commands],
+            install_recommends=self.install_recommends,
+            name=self.name,
+            packages=list(self.packages),
+        )
+
+    @property
+    def key(self):
+        return json.dumps(self.get_inputs(), sort_keys=True)
+
+    def __eq__(self, other):
+        return isinstance(other, Recipe) and self.key == other.key
+
+    def __hash__(self):
+        return hash(self.key)
+
+    def apply(self, worker):
+        logger.info('Provisioning %r for %s', worker, self)
+
+        if self.packages:
+            argv = [
+                'env',
+                'DEBIAN_FRONTEND=noninteractive',
+                'apt-get',
+                '-y',
+                '-t', worker.suite.apt_suite,
+            ]
+
+            if not self.install_recommends:
+                argv.append('--no-install-recommends')
+
+            argv.append('install')
+            argv.extend(self.packages)
+            worker.check_call(argv)
+
+        for argv in self.commands:
+            worker.check_call(list(argv))
+
+
+AUTOPKGTEST_LXC = Recipe(
+    'autopkgtest-lxc',
+    packages=['autopkgtest', 'lxc', 'python3'],
+)
+
+AUTOPKGTEST_LXD = Recipe(
+    'autopkgtest-lxd',
+    commands=[['lxd', 'init', '--auto', '--debug', '--verbose']],
+    packages=['autopkgtest', 'lxd', 'lxd-client', 'python3'],
+)
+
+AUTOPKGTEST_SCHROOT = Recipe(
+    'autopkgtest-schroot',
+    packages=['autopkgtest', 'python3', 'schroot'],
+)
+
+LXC_TARBALLS = Recipe(
+    'lxc-tarballs',
+    packages=['debootstrap', 'lxc', 'python3'],
+)
+
+LXD_TARBALL = Recipe(
+    'lxd-tarball',
+    commands=[['lxd', 'init', '--auto', '--debug', '--verbose']],
+    packages=['autopkgtest', 'debootstrap', 'lxd', 'lxd-client', 'python3'],
+)
+
+MINBASE_TARBALL = Recipe(
+    'minbase-tarball',
+    install_recommends=False,
+    packages=['debootstrap', 'python3'],
+)
+
+PBUILDER = Recipe(
+    'pbuilder',
+    install_recommends=False,
+    packages=['eatmydata', 'fakeroot', 'net-tools', 'pbuilder', 'python3'],
+)
+
+PBUILDER_TARBALL = Recipe(
+    'pbuilder-tarball',
+    install_recommends=False,
+    packages=['debootstrap', 'pbuilder', 'python3'],
+)
+
+PIUPARTS = Recipe(
+    'piuparts',
+    packages=['piuparts'],
+)
+
+SBUILD = Recipe(
+    'sbuild',
+    # Be like the real Debian build infrastructure: give sbuild a
+    # nonexistent home directory.
+    commands=[['usermod', '-d', '/nonexistent', 'sbuild']],
+    install_recommends=False,
+    packages=['python3', 'sbuild', 'schroot'],
+)
+
+SBUILD_TARBALL = Recipe(
+    'sbuild-tarball',
+    install_recommends=False,
+    packages=['debootstrap', 'python3', 'sbuild', 'schroot'],
+)
+
+# Needed to read or write tarballs with tarball_compression: zstd
+ZSTD = Recipe(
+    'zstd',
+    packages=['zstd'],
+)
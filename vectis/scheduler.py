@@ -0,0 +1,222 @@
+# Copyright © 2018 Simon McVittie
+# SPDX-License-Identifier: GPL-2.0+
+# (see vectis/__init__.py)
+
+import collections
+import logging
+import threading
+
+from vectis.error import (
+    CannotHappen,
+)
+from vectis.trace import (
+    get_tag,
+    tagged,
+)
+
+logger = logging.getLogger(__name__)
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+SKIPPED = 'skipped'
+
+
+class Task:
+    """
+    One step of a pipeline, run by a Scheduler when all the tasks it
+    comes after have succeeded.
+    """
+
+    def __init__(
+            self,
+            name,
+            function,
+            *,
+            after=(),
+            cancel=None,
+            resource=None,
+            tag=None):
+        self.after = tuple(after)
+        self.cancel = cancel
+        self.error = None
+        self.function = function
+        self.name = name
+        self.resource = resource
+        self.state = PENDING
+        self.tag = tag
+
+    def __str__(self):
+        return self.name
+
+    def __repr__(self):
+        return '<Task {} ({})>'.format(self.name, self.state)
+
+    @property
+    def finished(self):
+        return self.state in (DONE, FAILED, SKIPPED)
+
+
+class Scheduler:
+    """
+    Run a dependency graph of Tasks, each in its own thread, as soon as
+    the tasks they depend on have succeeded.
+
+    Each task can name a resource, such as 'sbuild' for a build worker;
+    limits maps resource names to the number of tasks that can use that
+    resource at the same time, or None for no limit. A resource that is
+    not in limits can only be used by one task at a time, and a task
+    with resource None is not limited.
+
+    Tasks can add more tasks while the scheduler is running, for example
+    to test each architecture that a build turned out to produce.
+    """
+
+    def __init__(self, limits=None):
+        self.limits = dict(limits or {})
+        self.tasks = []
+        self.__condition = threading.Condition()
+        self.__interrupted = False
+        self.__using = collections.Counter()
+
+    def add(
+            self,
+            name,
+            function,
+            *,
+            after=(),
+            cancel=None,
+            resource=None,
+            tag=...):
+        """
+        Add a task that will call function() after the tasks in after
+        have succeeded, and return it. If the scheduler is interrupted
+        before the task has succeeded, cancel() is called instead.
+
+        The operations that the task records in an OperationTrace are
+        tagged with tag, which defaults to the tag of the caller, so
+        that tasks added by a task share its tag.
+        """
+        if tag is ...:
+            tag = get_tag()
+
+        task = Task(
+            name,
+            function,
+            after=after,
+            cancel=cancel,
+            resource=resource,
+            tag=tag,
+        )
+
+        with self.__condition:
+            self.tasks.append(task)
+            self.__condition.notify_all()
+
+        return task
+
+    def _has_room(self, resource):
+        if resource is None:
+            return True
+
+        limit = self.limits.get(resource, 1)
+        return limit is None or self.__using[resource] < limit
+
+    def _start_ready_tasks(self):
+        """
+        Start every task that can run now, and skip tasks that come
+        after a failure. Return True if anything changed.
+        """
+        changed = False
+
+        for task in self.tasks:
+            if task.state != PENDING:
+                continue
+
+            failed = [t for t in task.after if t.state in (FAILED, SKIPPED)]
+
+            if failed:
+                logger.warning(
+                    'Skipping %s because %s did not succeed', task, failed[0])
+                task.state = SKIPPED
+                changed = True
+                continue
+
+            if not all(t.state == DONE for t in task.after):
+                continue
+
+            if not self._has_room(task.resource):
+                continue
+
+            task.state = RUNNING
+            self.__using[task.resource] += 1
+            changed = True
+            threading.Thread(
+                target=self._run_task, args=(task,),
+                name=task.name, daemon=True,
+            ).start()
+
+        return changed
+
+    def _run_task(self, task):
+        logger.info('Starting %s', task)
+
+        try:
+            with tagged(task.tag):
+                task.function()
+        except Exception as e:
+            logger.error('%s failed: %s', task, e)
+            state = FAILED
+            task.error = e
+        else:
+            logger.info('Finished %s', task)
+            state = DONE
+
+        with self.__condition:
+            task.state = state
+            self.__using[task.resource] -= 1
+            self.__condition.notify_all()
+
+    def run(self):
+        """
+        Run all the tasks, including any added while they are running.
+        Raise the exception from the first task that failed, in the
+        order they were added, once all the others have finished.
+
+        On KeyboardInterrupt, wait for the tasks that are already
+        running, cancel the rest and raise KeyboardInterrupt.
+        """
+        with self.__condition:
+            while True:
+                while not self.__interrupted and self._start_ready_tasks():
+                    pass
+
+                if all(t.finished for t in self.tasks):
+                    break
+
+                if not any(t.state == RUNNING for t in self.tasks):
+                    if self.__interrupted:
+                        break
+
+                    raise CannotHappen(
+                        'Tasks cannot start: {!r}'.format(
+                            [t for t in self.tasks if not t.finished]))
+
+                try:
+                    self.__condition.wait()
+                except KeyboardInterrupt:
+                    logger.warning(
+                        'Interrupted, waiting for running tasks to finish')
+                    self.__interrupted = True
+
+            if self.__interrupted:
+                for task in self.tasks:
+                    if task.state != DONE and task.cancel is not None:
+                        task.cancel()
+
+                raise KeyboardInterrupt
+
+        for task in self.tasks:
+            if task.state == FAILED:
+                raise task.error
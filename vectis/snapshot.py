@@ -0,0 +1,237 @@
+# Copyright © 2018 Simon McVittie
+# SPDX-License-Identifier: GPL-2.0+
+# (see vectis/__init__.py)
+
+import contextlib
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import socket
+import subprocess
+
+from vectis.error import (
+    Error,
+)
+from vectis.util import (
+    AtomicWriter,
+    cached_sha256_file,
+)
+
+logger = logging.getLogger(__name__)
+
+# Increment this to invalidate all existing snapshots if the way they
+# are prepared changes incompatibly.
+_FORMAT = 1
+
+_PROMPT = b'(qemu) '
+
+
+class SnapshotError(Error):
+    pass
+
+
+def find_image(argv):
+    """
+    Return the index in argv of the disk image that an
+    autopkgtest-virt-qemu command line will boot, or None if argv does
+    not describe a qemu worker.
+    """
+    if not argv or not os.path.basename(argv[0]).endswith('qemu'):
+        return None
+
+    for i, arg in enumerate(argv[1:], start=1):
+        if not arg.startswith('-') and os.path.isfile(arg):
+            return i
+
+    return None
+
+
+class SnapshotStore:
+    """
+    A directory of qcow2 overlays, each recording the disk state of a
+    worker after it has been prepared for use, so that later workers
+    can boot straight into the prepared state.
+    """
+
+    def __init__(self, storage):
+        self.path = os.path.join(storage, 'snapshots')
+
+    def image_digest(self, image):
+        return cached_sha256_file(image, os.path.join(self.path, 'digests'))
+
+    def get_key(self, image, inputs):
+        """
+        Return a string identifying the snapshot of image that would
+        result from preparing it with inputs, a JSON-serializable
+        description of everything that was done during preparation.
+        """
+        return hashlib.sha256(json.dumps(
+            [_FORMAT, self.image_digest(image), inputs],
+            sort_keys=True,
+        ).encode('utf-8')).hexdigest()
+
+    def get_family(self, image, inputs):
+        """
+        Return a string identifying the snapshots of image prepared with
+        inputs that differ only in the package lists they were prepared
+        from. Only the newest snapshot in a family is worth keeping.
+        """
+        inputs = dict(inputs)
+        inputs.pop('package_lists', None)
+        return hashlib.sha256(json.dumps(
+            [_FORMAT, os.path.abspath(image), inputs],
+            sort_keys=True,
+        ).encode('utf-8')).hexdigest()
+
+    def get_path(self, key):
+        return os.path.join(self.path, key + '.qcow2')
+
+    def record(self, key, image, inputs):
+        """
+        Record which image the snapshot identified by key was made
+        from, so that "vectis storage gc" can tell when it is stale.
+        """
+        path = os.path.join(self.path, key + '.json')
+
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(path + '.tmp')
+
+        with AtomicWriter(path) as writer:
+            json.dump(dict(
+                family=self.get_family(image, inputs),
+                image=os.path.abspath(image),
+                image_sha256=self.image_digest(image),
+            ), writer, sort_keys=True)
+
+    def mark_used(self, key):
+        """
+        Record that the snapshot identified by key was used just now.
+        """
+        with contextlib.suppress(FileNotFoundError):
+            os.utime(self.get_path(key) + '.ready')
+
+    def list(self):
+        """
+        Return a dict for each snapshot in the store, with keys: key,
+        path, size, ready (False if it was never finished), last_used
+        (a timestamp) and what record() recorded, if anything.
+        """
+        snapshots = []
+
+        try:
+            entries = list(os.scandir(self.path))
+        except FileNotFoundError:
+            return snapshots
+
+        for entry in entries:
+            if not entry.name.endswith('.qcow2') or not entry.is_file():
+                continue
+
+            key = entry.name[:-len('.qcow2')]
+            snapshot = dict(
+                key=key,
+                last_used=entry.stat().st_mtime,
+                path=entry.path,
+                ready=False,
+                size=entry.stat().st_size,
+            )
+
+            with contextlib.suppress(FileNotFoundError):
+                snapshot['last_used'] = os.stat(
+                    entry.path + '.ready').st_mtime
+                snapshot['ready'] = True
+
+            with contextlib.suppress(OSError, ValueError):
+                with open(os.path.join(self.path, key + '.json')) as reader:
+                    recorded = json.load(reader)
+
+                if isinstance(recorded, dict):
+                    for k, v in recorded.items():
+                        snapshot.setdefault(k, v)
+
+            snapshots.append(snapshot)
+
+        return snapshots
+
+    def delete(self, key):
+        path = self.get_path(key)
+
+        for f in (path + '.ready', path,
+                  os.path.join(self.path, key + '.json')):
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(f)
+
+    @contextlib.contextmanager
+    def lock(self, key, *, blocking=True):
+        """
+        Hold an exclusive lock on the snapshot identified by key, so
+        that concurrent vectis processes do not create it twice. If
+        blocking is false and another process holds the lock, raise
+        BlockingIOError instead of waiting.
+        """
+        os.makedirs(self.path, exist_ok=True)
+
+        with open(os.path.join(self.path, key + '.lock'), 'w') as lock:
+            if blocking:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            else:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+            yield
+
+    def create_overlay(self, image, path):
+        """
+        Create a new, empty qcow2 image at path, backed by image.
+        """
+        image = os.path.abspath(image)
+        info = json.loads(subprocess.check_output(
+            ['qemu-img', 'info', '--output=json', image],
+            universal_newlines=True))
+
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(path)
+
+        subprocess.check_call([
+            'qemu-img', 'create', '-q',
+            '-f', 'qcow2',
+            '-b', image,
+            '-F', info['format'],
+            path,
+        ])
+
+
+def commit_overlay(monitor):
+    """
+    Ask the qemu process listening on the human monitor socket monitor
+    to write the contents of its temporary overlay into the image that
+    it was started from.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+    with sock:
+        sock.connect(monitor)
+        _read_until_prompt(sock)
+        sock.sendall(b'commit all\n')
+        reply = _read_until_prompt(sock).decode('utf-8', errors='replace')
+
+    # The monitor echoes the command (possibly with terminal control
+    # sequences), then prints nothing on success
+    if 'error' in reply.lower() or 'fail' in reply.lower():
+        raise SnapshotError(
+            'Unable to commit virtual machine state: {}'.format(reply))
+
+
+def _read_until_prompt(sock):
+    buf = b''
+
+    while not buf.endswith(_PROMPT):
+        blob = sock.recv(4096)
+
+        if not blob:
+            raise SnapshotError('qemu monitor closed connection')
+
+        buf += blob
+
+    return buf[:-len(_PROMPT)]
@@ -0,0 +1,1082 @@
+# Copyright © 2018 Simon McVittie
+# SPDX-License-Identifier: GPL-2.0+
+# (see vectis/__init__.py)
+
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shlex
+import shutil
+import struct
+import subprocess
+import tempfile
+import textwrap
+import time
+from contextlib import suppress
+
+from debian.deb822 import (
+    Deb822,
+    Dsc,
+)
+from debian.debian_support import (
+    Version,
+)
+
+from vectis.apt import (
+    fetch_release,
+    get_release_date,
+)
+from vectis.mirrorcache import (
+    MirrorCache,
+)
+from vectis.snapshot import (
+    SnapshotStore,
+)
+from vectis.util import (
+    AtomicWriter,
+    TARBALL_EXTENSIONS,
+    get_tar_compress_options,
+    sha256_file,
+)
+
+logger = logging.getLogger(__name__)
+
+# Suffix of the files recording how an artifact in storage was built
+METADATA_SUFFIX = '.vectis-meta'
+
+
+def read_metadata(path):
+    """
+    Return the metadata recorded for the artifact at path, or an empty
+    dict if there is none.
+    """
+    with suppress(OSError, ValueError):
+        with open(path + METADATA_SUFFIX) as reader:
+            metadata = json.load(reader)
+
+        if isinstance(metadata, dict):
+            return metadata
+
+    return {}
+
+
+def write_metadata(path, metadata):
+    with AtomicWriter(path + METADATA_SUFFIX) as writer:
+        json.dump(metadata, writer, indent=2, sort_keys=True)
+        writer.write('\n')
+
+
+def get_release_info(mirrors, suite):
+    """
+    Return two dicts mapping each suite in suite's hierarchy to the
+    digest and the Date field of its Release file respectively, or to
+    None if it could not be downloaded.
+    """
+    digests = {}
+    dates = {}
+
+    for ancestor in suite.hierarchy:
+        release = fetch_release(
+            mirrors.lookup_suite_from_host(ancestor), ancestor.apt_suite)
+
+        if release is None:
+            digests[str(ancestor)] = None
+            dates[str(ancestor)] = None
+        else:
+            digests[str(ancestor)] = hashlib.sha256(release).hexdigest()
+            dates[str(ancestor)] = get_release_date(release)
+
+    return digests, dates
+
+
+def get_tarball_packages(worker, tarball, *, compression):
+    """
+    Return a dict mapping each package installed in tarball, a chroot
+    tarball in worker, to its version. Multi-Arch: same packages are
+    listed as package:architecture.
+    """
+    status = worker.check_output(
+        ['tar', '--wildcards'] + get_tar_compress_options(compression) +
+        ['-xOf', tarball, '*var/lib/dpkg/status'],
+        universal_newlines=True)
+    packages = {}
+
+    for stanza in Deb822.iter_paragraphs(status.splitlines()):
+        if stanza.get('Status', '').split()[-1:] != ['installed']:
+            continue
+
+        name = stanza['Package']
+
+        if stanza.get('Multi-Arch') == 'same':
+            name = '{}:{}'.format(name, stanza['Architecture'])
+
+        packages[name] = stanza['Version']
+
+    return packages
+
+
+def record_tarball(
+        path,
+        *,
+        components,
+        release_digests,
+        packages=None,
+        refreshed=False,
+        release_dates=None):
+    """
+    Record how the tarball at path was built, so that a later --refresh
+    can tell whether it is up to date, and the storage index can
+    describe it.
+    """
+    metadata = read_metadata(path)
+    now = time.time()
+
+    if not refreshed or 'created' not in metadata:
+        metadata['created'] = now
+
+    metadata['components'] = sorted(components)
+    metadata['packages'] = packages
+    metadata['refreshed'] = now
+    metadata['release_dates'] = release_dates
+    metadata['release_digests'] = release_digests
+    write_metadata(path, metadata)
+
+
+def is_up_to_date(path, *, components, release_digests):
+    """
+    Return True if the tarball at path was built from the same package
+    lists as release_digests describes.
+    """
+    if not os.path.exists(path):
+        return False
+
+    if None in release_digests.values():
+        return False
+
+    metadata = read_metadata(path)
+
+    return (
+        metadata.get('components') == sorted(components) and
+        metadata.get('release_digests') == release_digests
+    )
+
+
+def refresh_tarball(worker, tarball, output, *, compression):
+    """
+    Unpack tarball, a chroot tarball on the host, in worker; upgrade
+    the packages in it; and pack the result into output, a path in
+    the worker. Return the directory in the worker where the chroot
+    was unpacked.
+    """
+    chroot = '{}/refresh'.format(worker.scratch)
+    tarball_in_guest = worker.make_file_available(tarball, cache=True)
+    compress_options = get_tar_compress_options(compression)
+
+    logger.info('Refreshing %s in guest:%s', tarball, chroot)
+    worker.check_call(['rm', '-fr', chroot])
+    worker.check_call(['mkdir', chroot])
+    worker.check_call(
+        ['tar', '-C', chroot] + compress_options +
+        ['-xf', tarball_in_guest])
+    worker.check_call([
+        'sh', '-euc',
+        textwrap.dedent('''\
+        d="$1"
+        policy=
+        # Don't start daemons in the chroot while upgrading them
+        if ! [ -e "$d/usr/sbin/policy-rc.d" ]; then
+            policy="$d/usr/sbin/policy-rc.d"
+            printf '#!/bin/sh\\nexit 101\\n' > "$policy"
+            chmod 0755 "$policy"
+        fi
+        chroot "$d" apt-get -q -y update
+        chroot "$d" env DEBIAN_FRONTEND=noninteractive \\
+            apt-get -q -y \\
+            -o Dpkg::Options::=--force-confdef \\
+            -o Dpkg::Options::=--force-confold \\
+            dist-upgrade
+        chroot "$d" apt-get -q -y clean
+        if [ -n "$policy" ]; then
+            rm -f "$policy"
+        fi
+        '''),
+        'sh', chroot,
+    ])
+    worker.check_call(
+        ['tar', '-C', chroot, '-f', output] + compress_options +
+        ['-c', '.'])
+    return chroot
+
+
+def _backing_file_name(base, path):
+    """
+    Return the name by which the qcow2 image at path should refer to
+    its backing file base: relative to path, so that storage can be
+    moved without breaking the chain.
+    """
+    return os.path.relpath(
+        os.path.abspath(base), os.path.dirname(os.path.abspath(path)))
+
+
+def create_derived_image(base, path):
+    """
+    Create a new, empty qcow2 image at path whose backing file is the
+    qcow2 image base.
+    """
+    info = json.loads(subprocess.check_output(
+        ['qemu-img', 'info', '--output=json', base],
+        universal_newlines=True))
+
+    with suppress(FileNotFoundError):
+        os.unlink(path)
+
+    subprocess.check_call([
+        'qemu-img', 'create', '-q',
+        '-f', 'qcow2',
+        '-b', _backing_file_name(base, path),
+        '-F', info['format'],
+        path,
+    ])
+
+
+def record_image(path, *, base=None, include=(), merged_usr=False):
+    """
+    Record how the virtual machine image at path was built, and if it
+    is a qcow2 overlay, which image it was derived from.
+    """
+    now = time.time()
+    metadata = dict(created=now, refreshed=now)
+
+    if base is not None:
+        metadata.update(
+            backing_file=_backing_file_name(base, path),
+            backing_sha256=sha256_file(base),
+            derived=dict(include=sorted(include), merged_usr=merged_usr),
+        )
+
+    write_metadata(path, metadata)
+
+
+def replace_image(storage, new, path):
+    """
+    Rename the qcow2 image new over path. Images in storage that were
+    derived from path are first rebased onto new, so that their guests
+    see the same disk contents as before, while sharing the blocks that
+    did not change.
+    """
+    index = StorageIndex(storage)
+    index.update()
+    derived = [
+        os.path.join(storage, e['path']) for e in index.find_derived(path)]
+
+    for overlay in derived:
+        logger.info('Rebasing %s onto new version of %s', overlay, path)
+        subprocess.check_call([
+            'qemu-img', 'rebase', '-q',
+            '-f', 'qcow2',
+            '-b', _backing_file_name(new, overlay),
+            '-F', 'qcow2',
+            overlay,
+        ])
+
+    os.rename(new, path)
+
+    if not derived:
+        return
+
+    digest = sha256_file(path)
+
+    for overlay in derived:
+        # The contents are already right, only the name changed
+        subprocess.check_call([
+            'qemu-img', 'rebase', '-q', '-u',
+            '-f', 'qcow2',
+            '-b', _backing_file_name(path, overlay),
+            '-F', 'qcow2',
+            overlay,
+        ])
+        metadata = read_metadata(overlay)
+        metadata['backing_sha256'] = digest
+        write_metadata(overlay, metadata)
+
+    index.update()
+
+
+class DebootstrapCache:
+    """
+    A directory on the host holding the .deb files downloaded by
+    debootstrap for one architecture, so that creating several chroots
+    or images for the same suite only downloads each package once.
+
+    Call copy_to_guest() before running debootstrap in a worker and
+    copy_to_host() afterwards to keep any packages it downloaded.
+    """
+
+    def __init__(self, storage, architecture):
+        self.directory = os.path.join(
+            storage, 'debootstrap-cache', architecture)
+        self.in_guest = None
+
+    @property
+    def debootstrap_options(self):
+        if self.in_guest is None:
+            return []
+
+        return ['--cache-dir={}'.format(self.in_guest)]
+
+    def copy_to_guest(self, worker):
+        os.makedirs(self.directory, exist_ok=True)
+        in_guest = '{}/debootstrap-cache'.format(worker.scratch)
+        worker.copy_tree_to_guest(
+            self.directory, in_guest, exclude=['*.tmp'])
+        # Anything newer than this was downloaded by debootstrap
+        worker.check_call(['touch', in_guest + '.stamp'])
+        self.in_guest = in_guest
+        return in_guest
+
+    def write_wrapper(self, worker):
+        """
+        Write a debootstrap executable into a new directory in worker
+        that runs the real debootstrap with this cache, for tools that
+        run debootstrap without a way to pass options to it. Return a
+        PATH that will find it.
+        """
+        bindir = '{}/debootstrap-cache.bin'.format(worker.scratch)
+        worker.check_call(['mkdir', '-p', bindir])
+        worker.write_to_guest(
+            '{}/debootstrap'.format(bindir),
+            textwrap.dedent('''\
+            #!/bin/sh
+            exec /usr/sbin/debootstrap {} "$@"
+            ''').format(' '.join(
+                shlex.quote(o) for o in self.debootstrap_options)),
+            mode=0o755)
+        return ('{}:/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:'
+                '/sbin:/bin'.format(bindir))
+
+    def copy_to_host(self, worker):
+        if self.in_guest is None:
+            return
+
+        new = '{}/debootstrap-cache.new'.format(worker.scratch)
+        worker.check_call([
+            'sh', '-euc',
+            'mkdir -p "$2"; '
+            'find "$1" -maxdepth 1 -name "*.deb" -newer "$1.stamp" '
+            '-exec ln -t "$2" {} +',
+            'sh', self.in_guest, new,
+        ])
+        worker.copy_tree_to_host(new, self.directory)
+
+
+def verify_dsc_files(dsc_name):
+    """
+    Return the paths of the files making up the source package whose
+    .dsc file is dsc_name, .dsc first, or None if any of them is missing
+    or does not match the checksums in the .dsc.
+    """
+    directory = os.path.dirname(dsc_name)
+
+    with open(dsc_name) as reader:
+        dsc = Dsc(reader)
+
+    files = [dsc_name]
+
+    if dsc.get('checksums-sha256'):
+        checksums = [
+            (f['name'], int(f['size']), 'sha256', f['sha256'])
+            for f in dsc['checksums-sha256']]
+    else:
+        checksums = [
+            (f['name'], int(f['size']), 'md5', f['md5sum'])
+            for f in dsc['files']]
+
+    for name, size, algorithm, expected in checksums:
+        path = os.path.join(directory, name)
+
+        try:
+            if os.path.getsize(path) != size:
+                logger.warning('%s has the wrong size', path)
+                return None
+
+            with open(path, 'rb') as reader:
+                digest = hashlib.new(algorithm)
+
+                for blob in iter(lambda: reader.read(1024 * 1024), b''):
+                    digest.update(blob)
+        except FileNotFoundError:
+            logger.warning('%s is missing', path)
+            return None
+
+        if digest.hexdigest() != expected:
+            logger.warning('%s has the wrong %s checksum', path, algorithm)
+            return None
+
+        files.append(path)
+
+    return files
+
+
+class SourceCache:
+    """
+    A directory on the host holding source packages downloaded from
+    the archive, in STORAGE/source-cache/SOURCE/VERSION, so that
+    rebuilding the same version does not download it again.
+    """
+
+    def __init__(self, storage):
+        self.directory = os.path.join(storage, 'source-cache')
+
+    def get_path(self, source, version):
+        version = Version(str(version))
+        version.epoch = None
+        return os.path.join(self.directory, source, str(version))
+
+    def lookup(self, source, version):
+        """
+        Return the paths of the files making up the given version of
+        the given source package, .dsc first, or None if it is not
+        cached or the cached copy is corrupt.
+        """
+        directory = self.get_path(source, version)
+        dsc_name = os.path.join(
+            directory, '{}_{}.dsc'.format(
+                source, os.path.basename(directory)))
+
+        if not os.path.exists(dsc_name):
+            return None
+
+        files = verify_dsc_files(dsc_name)
+
+        if files is None:
+            logger.warning('Discarding corrupt cached source %s', directory)
+            shutil.rmtree(directory, ignore_errors=True)
+            return None
+
+        # Record when it was last used, for "vectis storage gc"
+        os.utime(directory)
+        return files
+
+    def add(self, worker, guest_dsc):
+        """
+        Copy the source package whose .dsc file in worker is guest_dsc
+        into the cache, and return the same as lookup().
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        tmp = tempfile.mkdtemp(prefix='.tmp-', dir=self.directory)
+
+        try:
+            dsc_name = os.path.join(tmp, os.path.basename(guest_dsc))
+            worker.copy_to_host(guest_dsc, dsc_name)
+
+            with open(dsc_name) as reader:
+                dsc = Dsc(reader)
+
+            for f in dsc['files']:
+                worker.copy_to_host(
+                    os.path.join(os.path.dirname(guest_dsc), f['name']),
+                    os.path.join(tmp, f['name']))
+
+            if verify_dsc_files(dsc_name) is None:
+                logger.warning(
+                    'Not caching source package %s', guest_dsc)
+                return None
+
+            directory = self.get_path(dsc['source'], dsc['version'])
+            os.makedirs(os.path.dirname(directory), exist_ok=True)
+            shutil.rmtree(directory, ignore_errors=True)
+
+            try:
+                os.rename(tmp, directory)
+            except OSError:
+                # A concurrent build might have cached it first
+                if not os.path.isdir(directory):
+                    raise
+            else:
+                tmp = None
+        finally:
+            if tmp is not None:
+                shutil.rmtree(tmp, ignore_errors=True)
+
+        logger.info('Cached source package %s', directory)
+        return self.lookup(dsc['source'], dsc['version'])
+
+
+# Top-level directories in storage that are not organized by
+# architecture, vendor and suite
+_NOT_ARTIFACTS = {
+    'cache', 'debootstrap-cache', 'mirror-cache', 'snapshots', 'source-cache',
+}
+
+_ARTIFACT_EXTENSIONS = {'.qcow2': 'qcow2'}
+_ARTIFACT_EXTENSIONS.update(
+    (extension, compression)
+    for compression, extension in TARBALL_EXTENSIONS.items())
+
+
+def _split_artifact_name(name):
+    """
+    Return (name, format) for a file in storage that looks like an
+    image or tarball, or None.
+    """
+    for extension, format_ in _ARTIFACT_EXTENSIONS.items():
+        if name.endswith(extension) and len(name) > len(extension):
+            return name[:-len(extension)], format_
+
+    return None
+
+
+def _scandir(path):
+    try:
+        return [e for e in os.scandir(path) if e.is_dir()]
+    except FileNotFoundError:
+        return []
+
+
+def _walk(storage):
+    """
+    Yield (architecture, vendor, suite, os.DirEntry) for each file in
+    STORAGE/ARCH/VENDOR/SUITE.
+    """
+    for arch in _scandir(storage):
+        if arch.name in _NOT_ARTIFACTS:
+            continue
+
+        for vendor in _scandir(arch.path):
+            for suite in _scandir(vendor.path):
+                for entry in os.scandir(suite.path):
+                    if entry.is_file():
+                        yield arch.name, vendor.name, suite.name, entry
+
+
+class StorageIndex:
+    """
+    A manifest of the images and tarballs in storage, stored in
+    STORAGE/index.json, so that they can be chosen and checked for
+    staleness without probing or unpacking them.
+
+    Each entry is a dict with keys: path (relative to storage),
+    architecture, vendor, suite, name (for example "sbuild" or
+    "autopkgtest"), format ("qcow2", "gzip" or "zstd"), size, mtime,
+    sha256, and as much as is known about how it was built: created,
+    refreshed, components, release_digests, release_dates and
+    packages. qcow2 images derived from another image also have
+    backing_file (relative to storage) and backing_sha256.
+    """
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.path = os.path.join(storage, 'index.json')
+        self.__entries = None
+
+    @property
+    def entries(self):
+        """
+        The entries as of the last update(), or as loaded from disk.
+        """
+        if self.__entries is None:
+            self.__entries = self._load()
+
+        return self.__entries
+
+    def _load(self):
+        with suppress(OSError, ValueError):
+            with open(self.path) as reader:
+                loaded = json.load(reader)
+
+            if isinstance(loaded, dict):
+                return loaded.get('entries', {})
+
+        return {}
+
+    def _scan(self):
+        for arch, vendor, suite, entry in _walk(self.storage):
+            if _split_artifact_name(entry.name) is not None:
+                yield arch, vendor, suite, entry
+
+    def update(self):
+        """
+        Bring the index up to date with the contents of storage, and
+        return the entries. Only new or modified files are checksummed.
+        """
+        os.makedirs(self.storage, exist_ok=True)
+
+        with open(self.path + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            old = self._load()
+            entries = {}
+
+            for arch, vendor, suite, dir_entry in self._scan():
+                path = os.path.relpath(dir_entry.path, self.storage)
+                stat = dir_entry.stat()
+                identity = [stat.st_dev, stat.st_ino, stat.st_size,
+                            stat.st_mtime_ns]
+                entry = old.get(path)
+                name, format_ = _split_artifact_name(dir_entry.name)
+
+                if entry is None or entry.get('identity') != identity:
+                    logger.info('Indexing %s', path)
+                    entry = dict(
+                        identity=identity,
+                        sha256=sha256_file(dir_entry.path),
+                    )
+
+                metadata = read_metadata(dir_entry.path)
+                backing_file = metadata.get('backing_file')
+
+                if backing_file is not None:
+                    backing_file = os.path.relpath(
+                        os.path.join(
+                            os.path.dirname(dir_entry.path), backing_file),
+                        self.storage)
+
+                entry.update(
+                    architecture=arch,
+                    backing_file=backing_file,
+                    backing_sha256=metadata.get('backing_sha256'),
+                    components=metadata.get('components'),
+                    created=metadata.get('created', stat.st_mtime),
+                    format=format_,
+                    mtime=stat.st_mtime,
+                    name=name,
+                    packages=metadata.get('packages'),
+                    path=path,
+                    refreshed=metadata.get('refreshed', stat.st_mtime),
+                    release_dates=metadata.get('release_dates'),
+                    release_digests=metadata.get('release_digests'),
+                    size=stat.st_size,
+                    suite=suite,
+                    vendor=vendor,
+                )
+                entries[path] = entry
+
+            with suppress(FileNotFoundError):
+                os.unlink(self.path + '.tmp')
+
+            with AtomicWriter(self.path) as writer:
+                json.dump(dict(entries=entries), writer, sort_keys=True)
+
+        self.__entries = entries
+        return entries
+
+    def lookup(self, path):
+        """
+        Return the entry for path, which is either absolute or relative
+        to storage, or None if it is not indexed.
+        """
+        if os.path.isabs(path):
+            path = os.path.relpath(path, self.storage)
+
+        return self.entries.get(path)
+
+    def find(
+            self,
+            *,
+            architecture=None,
+            name=None,
+            suite=None,
+            vendor=None):
+        """
+        Return the entries matching all the given criteria, most
+        recently refreshed first.
+        """
+        results = []
+
+        for entry in self.entries.values():
+            if architecture is not None and entry['architecture'] != str(
+                    architecture):
+                continue
+
+            if name is not None and entry['name'] != name:
+                continue
+
+            if suite is not None and entry['suite'] != str(suite):
+                continue
+
+            if vendor is not None and entry['vendor'] != str(vendor):
+                continue
+
+            results.append(entry)
+
+        results.sort(key=lambda e: e['refreshed'], reverse=True)
+        return results
+
+    def find_derived(self, path):
+        """
+        Return the entries for qcow2 images whose backing file is path,
+        which is either absolute or relative to storage.
+        """
+        if os.path.isabs(path):
+            path = os.path.relpath(path, self.storage)
+
+        path = os.path.normpath(path)
+
+        return [
+            e for e in self.entries.values()
+            if e.get('backing_file') == path]
+
+    @staticmethod
+    def is_stale(entry, release_digests):
+        """
+        Return True if entry was not built from the package lists that
+        release_digests, as returned by get_release_info(), describes.
+        Entries whose provenance is unknown are always stale.
+        """
+        return entry.get('release_digests') != release_digests
+
+
+# From <linux/fiemap.h> and <linux/fs.h>
+_FS_IOC_FIEMAP = 0xC020660B
+_FIEMAP_FLAG_SYNC = 0x1
+_FIEMAP_EXTENT_LAST = 0x1
+# Extents whose physical location is unknown, or that are stored with
+# the metadata, cannot be compared
+_FIEMAP_EXTENT_UNCOMPARABLE = 0x2 | 0x4 | 0x200
+_FIEMAP_HEADER = struct.Struct('=QQLLLL')
+_FIEMAP_EXTENT = struct.Struct('=QQQQQLLLL')
+_FIEMAP_BATCH = 256
+
+
+def _get_extents(path):
+    """
+    Yield (logical offset, physical offset, length) for each extent of
+    path, or raise OSError if the filesystem cannot say where they are.
+    """
+    with open(path, 'rb') as reader:
+        start = 0
+
+        while True:
+            request = bytearray(
+                _FIEMAP_HEADER.pack(
+                    start, 0xFFFFFFFFFFFFFFFF - start, _FIEMAP_FLAG_SYNC,
+                    0, _FIEMAP_BATCH, 0) +
+                bytes(_FIEMAP_EXTENT.size * _FIEMAP_BATCH))
+            fcntl.ioctl(reader.fileno(), _FS_IOC_FIEMAP, request)
+            mapped = _FIEMAP_HEADER.unpack_from(request)[3]
+
+            if not mapped:
+                return
+
+            for i in range(mapped):
+                (logical, physical, length, _, _, flags, _, _,
+                 _) = _FIEMAP_EXTENT.unpack_from(
+                     request, _FIEMAP_HEADER.size + i * _FIEMAP_EXTENT.size)
+
+                if flags & _FIEMAP_EXTENT_UNCOMPARABLE:
+                    raise OSError(
+                        'Location of data in {} is unknown'.format(path))
+
+                yield logical, physical, length
+
+                if flags & _FIEMAP_EXTENT_LAST:
+                    return
+
+            start = logical + length
+
+
+def _shares_extents(a, b):
+    """
+    Return True if a and b are known to be stored in the same blocks,
+    for example because one is a reflink to the other.
+    """
+    if os.path.getsize(a) != os.path.getsize(b):
+        return False
+
+    try:
+        extents_a = _get_extents(a)
+        extents_b = _get_extents(b)
+        sentinel = object()
+
+        # Compare one extent at a time, so that files that differ early
+        # do not need all their extents listed
+        while True:
+            x = next(extents_a, sentinel)
+            y = next(extents_b, sentinel)
+
+            if x != y:
+                return False
+
+            if x is sentinel:
+                return True
+    except OSError:
+        return False
+
+
+def _link_or_copy(source, dest, *, reflink_only=False):
+    """
+    Replace dest with a reflink to source, or failing that a hard link,
+    unless reflink_only is true. Return how, or None if dest was left
+    alone.
+    """
+    tmp = dest + '.tmp'
+
+    with suppress(FileNotFoundError):
+        os.unlink(tmp)
+
+    try:
+        subprocess.check_call(
+            ['cp', '--reflink=always', '--preserve=all', source, tmp],
+            stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        with suppress(FileNotFoundError):
+            os.unlink(tmp)
+
+        if reflink_only:
+            return None
+
+        os.link(source, tmp)
+        how = 'hard link'
+    else:
+        how = 'reflink'
+
+    os.replace(tmp, dest)
+    return how
+
+
+def collect_garbage(
+        storage,
+        *,
+        dry_run=False,
+        keep=(),
+        max_age=None,
+        max_size=None,
+        min_leftover_age=3600):
+    """
+    Delete unwanted files from storage, and deduplicate identical
+    artifacts. Return the number of bytes that were (or with dry_run,
+    would have been) freed.
+
+    This deletes files left behind by interrupted or --keep builds
+    (*.new, *.tmp, unfinished snapshots and partial downloads) once
+    they are older than min_leftover_age seconds; tarballs superseded
+    by a newer tarball with a different compression, which
+    find_tarball() would never choose; snapshots of images that have
+    been deleted or replaced, or superseded by a snapshot prepared
+    from newer package lists; artifacts, snapshots, cached packages
+    and cached source packages not refreshed or used for more than
+    max_age seconds; and then the least recently refreshed or used
+    artifacts and files in the mirror cache until the rest fit in
+    max_size bytes. Artifacts whose path is in keep, such as the
+    images that workers boot from, and images that other images are
+    derived from, are never deleted.
+
+    Identical artifacts are replaced by reflinks or hard links to one
+    copy, except for qcow2 images, which are only reflinked: a qcow2
+    image can be rewritten in place, for example by "qemu-img rebase"
+    when its backing file is replaced.
+    """
+    now = time.time()
+    freed = 0
+    index = StorageIndex(storage)
+    entries = sorted(
+        index.update().values(), key=lambda e: e['refreshed'], reverse=True)
+    keep = {os.path.realpath(p) for p in keep}
+    # Deleting a backing file would break the images derived from it
+    backing_files = {
+        e['backing_file'] for e in entries if e.get('backing_file')}
+    deletable = [
+        e for e in entries
+        if os.path.realpath(os.path.join(storage, e['path'])) not in keep and
+        e['path'] not in backing_files]
+
+    def delete(path, reason):
+        nonlocal freed
+
+        try:
+            size = os.lstat(path).st_size
+        except FileNotFoundError:
+            return
+
+        logger.info('%s %s: %s',
+                    'Would delete' if dry_run else 'Deleting', path, reason)
+        freed += size
+
+        if not dry_run:
+            os.unlink(path)
+
+            with suppress(FileNotFoundError):
+                os.unlink(path + METADATA_SUFFIX)
+
+    def delete_entry(entry, reason):
+        delete(os.path.join(storage, entry['path']), reason)
+        entries.remove(entry)
+        deletable.remove(entry)
+
+    for arch, vendor, suite, dir_entry in _walk(storage):
+        if (dir_entry.name.endswith(('.new', '.tmp')) and
+                now - dir_entry.stat().st_mtime > min_leftover_age):
+            delete(dir_entry.path, 'left over from an earlier build')
+        elif (dir_entry.name.endswith(METADATA_SUFFIX) and
+                not os.path.exists(
+                    dir_entry.path[:-len(METADATA_SUFFIX)])):
+            delete(dir_entry.path, 'describes a deleted artifact')
+
+    newest = {}
+
+    for entry in list(entries):
+        # Entries are newest first, so the first one of each name wins
+        key = (entry['architecture'], entry['vendor'], entry['suite'],
+               entry['name'])
+
+        if key in newest and entry in deletable:
+            delete_entry(entry, 'superseded by {}'.format(
+                newest[key]['path']))
+        else:
+            newest.setdefault(key, entry)
+
+    if max_age is not None:
+        for entry in list(deletable):
+            if now - entry['refreshed'] > max_age:
+                delete_entry(entry, 'not refreshed for {} days'.format(
+                    int((now - entry['refreshed']) // 86400)))
+
+        for directory in _scandir(os.path.join(
+                storage, 'debootstrap-cache')):
+            for dir_entry in os.scandir(directory.path):
+                if now - dir_entry.stat().st_mtime > max_age:
+                    delete(dir_entry.path, 'old cached package')
+
+        for source in _scandir(os.path.join(storage, 'source-cache')):
+            for directory in _scandir(source.path):
+                if now - directory.stat().st_mtime > max_age:
+                    logger.info(
+                        '%s %s: old cached source package',
+                        'Would delete' if dry_run else 'Deleting',
+                        directory.path)
+
+                    for dir_entry in os.scandir(directory.path):
+                        freed += dir_entry.stat().st_size
+
+                    if not dry_run:
+                        shutil.rmtree(directory.path)
+
+    snapshots = SnapshotStore(storage)
+    newest_snapshots = {}
+
+    for snapshot in sorted(
+            snapshots.list(), key=lambda s: s['last_used'], reverse=True):
+        reason = None
+
+        if not snapshot['ready']:
+            if now - snapshot['last_used'] > min_leftover_age:
+                reason = 'left over from an interrupted build'
+        elif max_age is not None and now - snapshot['last_used'] > max_age:
+            reason = 'not used for {} days'.format(
+                int((now - snapshot['last_used']) // 86400))
+        elif 'image' in snapshot:
+            if not os.path.exists(snapshot['image']):
+                reason = 'image {} no longer exists'.format(
+                    snapshot['image'])
+            elif (snapshots.image_digest(snapshot['image']) !=
+                    snapshot['image_sha256']):
+                reason = 'image {} has been replaced'.format(
+                    snapshot['image'])
+            elif snapshot['family'] in newest_snapshots:
+                reason = 'superseded by {}'.format(
+                    newest_snapshots[snapshot['family']]['path'])
+            else:
+                newest_snapshots[snapshot['family']] = snapshot
+
+        if reason is None:
+            continue
+
+        try:
+            with snapshots.lock(snapshot['key'], blocking=False):
+                logger.info(
+                    '%s %s: %s', 'Would delete' if dry_run else 'Deleting',
+                    snapshot['path'], reason)
+                freed += snapshot['size']
+
+                if not dry_run:
+                    snapshots.delete(snapshot['key'])
+        except BlockingIOError:
+            logger.info('Not deleting %s: in use', snapshot['path'])
+
+    mirror_cache = MirrorCache(os.path.join(storage, 'mirror-cache'))
+
+    for path, stat in list(mirror_cache.list_partial()):
+        if now - stat.st_mtime > min_leftover_age:
+            delete(path, 'left over from an interrupted download')
+
+    cached_files = []
+
+    for path, stat in mirror_cache.list():
+        if max_age is not None and now - stat.st_mtime > max_age:
+            logger.info(
+                '%s %s: not used for %d days',
+                'Would delete' if dry_run else 'Deleting', path,
+                (now - stat.st_mtime) // 86400)
+            freed += stat.st_size
+
+            if not dry_run:
+                mirror_cache.delete(path)
+        else:
+            cached_files.append((stat.st_mtime, stat.st_size, path))
+
+    if max_size is not None:
+        total = (sum(e['size'] for e in entries) +
+                 sum(size for mtime, size, path in cached_files))
+        # Least recently refreshed or used first
+        candidates = [(e['refreshed'], e['size'], e) for e in deletable]
+        candidates.extend(cached_files)
+        candidates.sort(key=lambda c: c[0])
+
+        for when, size, candidate in candidates:
+            if total <= max_size:
+                break
+
+            total -= size
+
+            if isinstance(candidate, dict):
+                delete_entry(candidate, 'over the storage size budget')
+            else:
+                logger.info(
+                    '%s %s: over the storage size budget',
+                    'Would delete' if dry_run else 'Deleting', candidate)
+                freed += size
+
+                if not dry_run:
+                    mirror_cache.delete(candidate)
+
+    by_digest = {}
+
+    for entry in entries:
+        by_digest.setdefault(entry['sha256'], []).append(entry)
+
+    for same in by_digest.values():
+        source = os.path.join(storage, same[0]['path'])
+
+        for entry in same[1:]:
+            dest = os.path.join(storage, entry['path'])
+
+            # Already hard-linked or reflinked: there is nothing to free
+            if (os.path.samefile(source, dest) or
+                    _shares_extents(source, dest)):
+                continue
+
+            # A hard link would let rewriting one image in place change
+            # the other too
+            reflink_only = entry['format'] == 'qcow2'
+
+            if dry_run:
+                logger.info('Would deduplicate %s and %s', dest, source)
+            else:
+                how = _link_or_copy(
+                    source, dest, reflink_only=reflink_only)
+
+                if how is None:
+                    logger.info(
+                        'Not deduplicating %s and %s: reflinks are not '
+                        'supported', dest, source)
+                    continue
+
+                logger.info('Replaced %s with a %s to %s', dest, how, source)
+
+            freed += entry['size']
+
+    if not dry_run:
+        index.update()
+
+    return freed
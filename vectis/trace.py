@@ -0,0 +1,114 @@
+# Copyright © 2018 Simon McVittie
+# SPDX-License-Identifier: GPL-2.0+
+# (see vectis/__init__.py)
+
+import json
+import logging
+import threading
+from contextlib import contextmanager
+
+from vectis.util import (
+    AtomicWriter,
+)
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+
+def get_tag():
+    """
+    Return the tag of the work being done by this thread, or None.
+    """
+    return getattr(_local, 'tag', None)
+
+
+@contextmanager
+def tagged(tag):
+    """
+    Tag the operations recorded by this thread until the end of the
+    with block, for example with the name of the package being built.
+    """
+    old = get_tag()
+    _local.tag = tag
+
+    try:
+        yield
+    finally:
+        _local.tag = old
+
+
+def propagate_tag(function):
+    """
+    Return a function that calls function with this thread's current
+    tag, for use as the target of another thread.
+    """
+    tag = get_tag()
+
+    def wrapper(*args, **kwargs):
+        with tagged(tag):
+            return function(*args, **kwargs)
+
+    return wrapper
+
+
+class OperationTrace:
+    """
+    A record of how long each operation on a worker took. Each operation
+    is tagged with the tag of the thread that recorded it.
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.operations = []
+
+    def add(self, **operation):
+        operation.setdefault('tag', get_tag())
+
+        with self.__lock:
+            self.operations.append(operation)
+
+    def write(self, path, *, tag=...):
+        """
+        Write the operations to path, one JSON object per line. If tag
+        is given, only write the operations with that tag.
+        """
+        with self.__lock:
+            operations = [
+                o for o in self.operations
+                if tag is ... or o.get('tag') == tag]
+
+        with AtomicWriter(path) as writer:
+            for operation in operations:
+                writer.write(json.dumps(operation, sort_keys=True) + '\n')
+
+        logger.info('Wrote timings of %d operations to %s',
+                    len(operations), path)
+
+    def log_summary(self, n=10):
+        with self.__lock:
+            operations = list(self.operations)
+
+        if not operations:
+            return
+
+        total = sum(o['seconds'] for o in operations)
+        slowest = sorted(
+            operations, key=lambda o: o['seconds'], reverse=True)[:n]
+        lines = []
+
+        for o in slowest:
+            extra = ''
+
+            if o.get('status') is not None:
+                extra += ' status={}'.format(o['status'])
+
+            if o.get('bytes') is not None:
+                extra += ' bytes={}'.format(o['bytes'])
+
+            lines.append('{:8.1f}s {} {} {}{}'.format(
+                o['seconds'], o['worker'], o['op'], o['detail'], extra))
+
+        logger.info(
+            '%d worker operations took %.1f seconds; slowest %d:\n\t%s',
+            len(operations), total, len(slowest), '\n\t'.join(lines))
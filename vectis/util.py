@@ -3,8 +3,13 @@
 # (see vectis/__init__.py)
 
 import contextlib
+import fnmatch
+import hashlib
+import json
 import logging
 import os
+import tempfile
+import threading
 
 logger = logging.getLogger(__name__)
 
@@ -22,3 +27,260 @@ def AtomicWriter(fn, *a, **k):
         raise
     else:
         os.rename(fn + '.tmp', fn)
+
+
+def tar_excluded(name, patterns, *, keep=frozenset()):
+    """
+    Return True if name, a path in a tar archive, matches any of
+    patterns in the same way as tar --exclude, unless it is one of the
+    relative paths in keep.
+    """
+    parts = [p for p in name.split('/') if p not in ('', '.')]
+
+    if '/'.join(parts) in keep:
+        return False
+
+    # Like tar, a pattern that matches a directory also matches its
+    # contents
+    for pattern in patterns:
+        for i in range(len(parts)):
+            for j in range(i + 1, len(parts) + 1):
+                if fnmatch.fnmatchcase('/'.join(parts[i:j]), pattern):
+                    return True
+
+    return False
+
+
+def sha256_file(path):
+    sha256 = hashlib.sha256()
+
+    with open(path, 'rb') as reader:
+        while True:
+            blob = reader.read(1024 * 1024)
+
+            if not blob:
+                break
+
+            sha256.update(blob)
+
+    return sha256.hexdigest()
+
+
+def cached_sha256_file(path, cache_dir):
+    """
+    Return the SHA-256 of path, re-using a result previously recorded
+    in cache_dir if the file does not appear to have changed since then.
+    """
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    identity = [stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns]
+    cache = os.path.join(
+        cache_dir, hashlib.sha256(path.encode('utf-8')).hexdigest())
+
+    try:
+        with open(cache) as reader:
+            cached = json.load(reader)
+    except (OSError, ValueError):
+        pass
+    else:
+        if cached.get('identity') == identity:
+            return cached['sha256']
+
+    logger.info('Computing checksum of %s', path)
+    digest = sha256_file(path)
+    os.makedirs(cache_dir, exist_ok=True)
+
+    # Other threads might be recording the same checksum, so write it
+    # to a unique temporary file
+    with tempfile.NamedTemporaryFile(
+            'w', dir=cache_dir, prefix='.', suffix='.tmp',
+            delete=False) as writer:
+        try:
+            json.dump(dict(identity=identity, sha256=digest), writer)
+        except BaseException:
+            os.unlink(writer.name)
+            raise
+
+    os.replace(writer.name, cache)
+    return digest
+
+
+# Supported values of tarball_compression, and the file extensions
+# they produce
+TARBALL_EXTENSIONS = {
+    'gzip': '.tar.gz',
+    'zstd': '.tar.zst',
+}
+
+
+def get_tarball_compression(path):
+    """
+    Return the compression used for the tarball at path, guessed from
+    its name.
+    """
+    for compression, extension in TARBALL_EXTENSIONS.items():
+        if path.endswith(extension):
+            return compression
+
+    return 'gzip'
+
+
+def get_tar_compress_options(compression):
+    """
+    Return options for tar(1) to read or write a tarball compressed
+    with compression.
+    """
+    if compression == 'zstd':
+        return ['--use-compress-program=zstd -T0']
+
+    return ['-z']
+
+
+def get_pbuilder_compress_options(compression):
+    """
+    Return options for pbuilder(8) to read or write a base tarball
+    compressed with compression.
+    """
+    if compression == 'zstd':
+        # pzstd is the parallel version of zstd, and unlike "zstd -T0"
+        # it is a single word, which is what pbuilder expects
+        return ['--compressprog', 'pzstd']
+
+    return []
+
+
+def find_tarball(path):
+    """
+    Return the most recently modified tarball that only differs from
+    path by its compression, so that tarballs created with any value of
+    tarball_compression can be used. If there is none, return path
+    unchanged.
+    """
+    stem = path
+
+    for extension in TARBALL_EXTENSIONS.values():
+        if path.endswith(extension):
+            stem = path[:-len(extension)]
+            break
+
+    candidates = []
+
+    for extension in TARBALL_EXTENSIONS.values():
+        with contextlib.suppress(FileNotFoundError):
+            candidates.append(
+                (os.stat(stem + extension).st_mtime, stem + extension))
+
+    if candidates:
+        return max(candidates)[1]
+
+    return path
+
+
+# Supported values of qemu_image_profile, and the options for
+# "qemu-img convert" that produce them
+QEMU_IMAGE_PROFILES = {
+    # Uncompressed, with unallocated clusters left out: quickest to
+    # create and to boot, but the largest
+    'qcow2-sparse': ['-O', 'qcow2'],
+    # Compressed clusters, which are cheap to decompress on read
+    # (requires qemu 5.1)
+    'qcow2-zstd': ['-O', 'qcow2', '-c', '-o', 'compression_type=zstd'],
+    # Compressed clusters, as produced by older versions of vectis:
+    # the smallest, but the slowest to create and to boot
+    'qcow2-zlib': ['-O', 'qcow2', '-c'],
+}
+
+
+def get_qemu_img_convert_argv(profile, source, dest):
+    """
+    Return the argument vector to convert the raw disk image source
+    into dest, using profile from QEMU_IMAGE_PROFILES.
+    """
+    return (
+        ['qemu-img', 'convert', '-p', '-f', 'raw'] +
+        QEMU_IMAGE_PROFILES[profile] +
+        [source, dest]
+    )
+
+
+def get_available_memory():
+    """
+    Return how many bytes of memory the host can give to new processes
+    without swapping, or None if that is unknown.
+    """
+    with contextlib.suppress(OSError, ValueError):
+        with open('/proc/meminfo') as reader:
+            for line in reader:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+
+    return None
+
+
+class MemoryBudget:
+    """
+    An amount of host memory shared between the threads that start
+    workers, so that they do not run more virtual machines at a time
+    than the host can hold. With total None, the host's available
+    memory is used, or if that is unknown, there is no limit.
+    """
+
+    def __init__(self, total=None):
+        if total is None:
+            total = get_available_memory()
+
+        self.total = total
+        self.__condition = threading.Condition()
+        self.__used = 0
+
+    def acquire(self, size, *, timeout=None):
+        """
+        Wait until size bytes are available and take them, or give up
+        after timeout seconds. Return True if the memory was taken.
+        A request larger than the whole budget is granted when nothing
+        else holds any memory, so that it cannot wait forever.
+        """
+        if size is None:
+            size = 0
+
+        with self.__condition:
+            if not self.__fits(size):
+                logger.info(
+                    'Waiting for %.1f MiB of memory (%.1f of %.1f MiB '
+                    'in use)', size / (1024 * 1024),
+                    self.__used / (1024 * 1024), self.total / (1024 * 1024))
+
+                if not self.__condition.wait_for(
+                        lambda: self.__fits(size), timeout):
+                    return False
+
+            self.__used += size
+            return True
+
+    def release(self, size):
+        """
+        Give back size bytes taken by acquire().
+        """
+        if size is None:
+            size = 0
+
+        with self.__condition:
+            self.__used -= size
+            self.__condition.notify_all()
+
+    def __fits(self, size):
+        return (self.total is None or self.__used == 0 or
+                self.__used + size <= self.total)
+
+    @contextlib.contextmanager
+    def reserve(self, size):
+        """
+        Wait until size bytes are available, and hold them until the
+        end of the with block.
+        """
+        self.acquire(size)
+
+        try:
+            yield
+        finally:
+            self.release(size)
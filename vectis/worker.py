@@ -3,15 +3,24 @@
 # SPDX-License-Identifier: GPL-2.0+
 # (see vectis/__init__.py)
 
+import hashlib
+import io
+import json
+import locale
 import logging
 import os
 import shutil
+import socket
 import subprocess
+import sys
+import tarfile
 import textwrap
+import threading
+import time
 import uuid
 import urllib.parse
 from abc import abstractmethod, ABCMeta
-from contextlib import ExitStack
+from contextlib import ExitStack, contextmanager, suppress
 from tempfile import TemporaryDirectory
 
 from debian.deb822 import (
@@ -22,14 +31,35 @@ from debian.debian_support import (
     Version,
 )
 
+from vectis.agent import (
+    AgentError,
+    AgentTimeout,
+    GuestAgent,
+)
 from vectis.apt import (
     AptSource,
+    get_release_digest,
+)
+from vectis.cas import (
+    CacheDisk,
 )
 from vectis.error import (
     Error,
 )
+from vectis.provision import (
+    ZSTD,
+)
+from vectis.snapshot import (
+    SnapshotError,
+    SnapshotStore,
+    commit_overlay,
+    find_image,
+)
 from vectis.util import (
-    AtomicWriter,
+    find_tarball,
+    get_tar_compress_options,
+    get_tarball_compression,
+    tar_excluded,
 )
 
 _WRAPPER = os.path.join(os.path.dirname(__file__), 'vectis-command-wrapper')
@@ -41,21 +71,130 @@ class WorkerError(Error):
     pass
 
 
+def find_virt_provider(name):
+    """
+    Return the executable that implements the autopkgtest virtualization
+    provider name, for example autopkgtest-virt-qemu for 'qemu'.
+    """
+    for prefix in ('autopkgtest-virt-', 'adt-virt-', ''):
+        if shutil.which(prefix + name):
+            return prefix + name
+
+    raise WorkerError('virtualization provider %r not found' % name)
+
+
+def parse_capabilities(argv, line):
+    """
+    Parse the reply to the virtualization server's capabilities command
+    and check that the worker is suitable. Return a tuple
+    (set of capabilities, suggested normal user or None).
+    """
+    if not line.startswith('ok '):
+        raise WorkerError(
+            'Virtual machine {!r} failed to report capabilities: '
+            '{}'.format(argv, line.strip()))
+
+    capabilities = set()
+    user = None
+
+    for word in line.split()[1:]:
+        capabilities.add(word)
+        if word.startswith('suggested-normal-user='):
+            user = word[len('suggested-normal-user='):]
+
+    if 'root-on-testbed' not in capabilities:
+        raise WorkerError(
+            'Virtual machine {!r} does not have root-on-testbed '
+            'capability: {}'.format(argv, line.strip()))
+
+    if ('isolation-machine' not in capabilities and
+            'isolation-container' not in capabilities):
+        raise WorkerError(
+            'Virtual machine {!r} does not have sufficient isolation: '
+            '{}'.format(argv, line.strip()))
+
+    return capabilities, user
+
+
+def parse_execute_command(argv, line):
+    """
+    Parse the reply to the virtualization server's print-execute-command
+    command, returning the argument vector prefix used to run commands.
+    """
+    if not line.startswith('ok '):
+        raise WorkerError(
+            'Failed to get virtual machine {!r} command '
+            'wrapper: {}'.format(argv, line.strip()))
+
+    wrapper_argv = line.rstrip('\n').split(None, 1)[1].split(',')
+    call_argv = list(map(urllib.parse.unquote, wrapper_argv))
+    if not call_argv:
+        raise WorkerError(
+            'Virtual machine {!r} command wrapper did not provide any '
+            'arguments: {}'.format(argv, line.strip()))
+
+    return call_argv
+
+
+def _log_throughput(source, dest, count, seconds):
+    logger.info(
+        'Copied %s to %s: %d compressed bytes in %.1f seconds (%.1f MB/s)',
+        source, dest, count, seconds, count / max(seconds, 0.001) / 1e6)
+
+
+class _Pump(threading.Thread):
+    """
+    Copy everything from reader to writer in a background thread,
+    counting the bytes.
+    """
+
+    def __init__(self, reader, writer):
+        super().__init__(daemon=True)
+        self.count = 0
+        self.error = None
+        self.reader = reader
+        self.writer = writer
+        self.start()
+
+    def run(self):
+        with self.reader:
+            while True:
+                blob = self.reader.read(65536)
+
+                if not blob:
+                    break
+
+                # If the writer has gone away, keep draining the reader
+                # so that the process writing to it does not block;
+                # the caller will notice that the writer failed
+                if self.error is None:
+                    try:
+                        self.writer.write(blob)
+                    except OSError as e:
+                        self.error = e
+
+                self.count += len(blob)
+
+
 class BaseWorker(metaclass=ABCMeta):
 
     def __init__(self, *, mirrors=None):
         super().__init__()
         self.__open = 0
+        # Held while opening or closing, so that concurrent tasks sharing
+        # a worker do not use it before it has finished starting
+        self.__open_lock = threading.RLock()
         self.stack = ExitStack()
 
     def assert_open(self):
         assert self.__open
 
     def __enter__(self):
-        self.__open += 1
+        with self.__open_lock:
+            self.__open += 1
 
-        if self.__open == 1:
-            self._open()
+            if self.__open == 1:
+                self._open()
 
         return self
 
@@ -63,11 +202,12 @@ class BaseWorker(metaclass=ABCMeta):
         pass
 
     def __exit__(self, et, ev, tb):
-        self.__open -= 1
-        if self.__open:
-            return False
-        else:
-            return self.stack.__exit__(et, ev, tb)
+        with self.__open_lock:
+            self.__open -= 1
+            if self.__open:
+                return False
+            else:
+                return self.stack.__exit__(et, ev, tb)
 
 
 class ContainerWorker(BaseWorker, metaclass=ABCMeta):
@@ -139,12 +279,36 @@ class FileProvider(BaseWorker, metaclass=ABCMeta):
         raise NotImplementedError
 
     @abstractmethod
-    def make_changes_file_available(self, filename, owner=None):
+    def make_files_available(self, filenames, *, owner=None):
+        """
+        Make all of filenames available in one new directory, each
+        under its basename, and return that directory.
+        """
         raise NotImplementedError
 
-    @abstractmethod
+    def make_changes_file_available(self, filename, owner=None):
+        d = os.path.dirname(filename) or os.curdir
+
+        with open(filename) as reader:
+            changes = Changes(reader)
+
+        to = self.make_files_available(
+            [filename] + [
+                os.path.join(d, f['name']) for f in changes['files']],
+            owner=owner)
+        return to, os.path.basename(filename)
+
     def make_dsc_file_available(self, filename, owner=None):
-        raise NotImplementedError
+        d = os.path.dirname(filename) or os.curdir
+
+        with open(filename) as reader:
+            dsc = Dsc(reader)
+
+        to = self.make_files_available(
+            [filename] + [
+                os.path.join(d, f['name']) for f in dsc['files']],
+            owner=owner)
+        return to, os.path.basename(filename)
 
 
 class InteractiveWorker(BaseWorker, metaclass=ABCMeta):
@@ -152,6 +316,37 @@ class InteractiveWorker(BaseWorker, metaclass=ABCMeta):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.__dpkg_architecture = None
+        self.trace = None
+
+    @contextmanager
+    def timed(self, op, detail):
+        """
+        Record how long an operation took in self.trace, if set. The
+        caller can fill in the 'status' and 'bytes' of the yielded dict.
+        """
+        record = dict(bytes=None, status=None)
+        start = time.time()
+
+        try:
+            yield record
+        except subprocess.CalledProcessError as e:
+            record['status'] = e.returncode
+            raise
+        finally:
+            self.record_operation(op, detail, start, **record)
+
+    def record_operation(self, op, detail, start, *, bytes=None,
+                         status=None):
+        if self.trace is not None:
+            self.trace.add(
+                bytes=bytes,
+                detail=detail,
+                op=op,
+                seconds=time.time() - start,
+                start=start,
+                status=status,
+                worker=repr(self),
+            )
 
     def call(self, argv, **kwargs):
         raise NotImplementedError
@@ -185,15 +380,26 @@ class HostWorker(InteractiveWorker, FileProvider):
 
     def call(self, argv, **kwargs):
         logger.info('%r: %r', self, argv)
-        return subprocess.call(argv, **kwargs)
+
+        with self.timed('call', argv) as record:
+            record['status'] = subprocess.call(argv, **kwargs)
+            return record['status']
 
     def check_call(self, argv, **kwargs):
         logger.info('%r: %r', self, argv)
-        subprocess.check_call(argv, **kwargs)
+
+        with self.timed('check_call', argv) as record:
+            subprocess.check_call(argv, **kwargs)
+            record['status'] = 0
 
     def check_output(self, argv, **kwargs):
         logger.info('%r: %r', self, argv)
-        return subprocess.check_output(argv, **kwargs)
+
+        with self.timed('check_output', argv) as record:
+            output = subprocess.check_output(argv, **kwargs)
+            record['status'] = 0
+            record['bytes'] = len(output)
+            return output
 
     def make_file_available(
             self,
@@ -211,6 +417,20 @@ class HostWorker(InteractiveWorker, FileProvider):
         return self.stack.enter_context(
             self, TemporaryDirectory(prefix=prefix))
 
+    def make_files_available(self, filenames, *, owner=None):
+        dirs = set(os.path.dirname(f) or os.curdir for f in filenames)
+
+        if len(dirs) == 1:
+            return dirs.pop()
+
+        d = self.stack.enter_context(TemporaryDirectory(prefix='vectis-'))
+
+        for f in filenames:
+            os.symlink(os.path.abspath(f),
+                       os.path.join(d, os.path.basename(f)))
+
+        return d
+
     def make_dsc_file_available(self, filename, owner=None):
         return (
             os.path.dirname(filename) or os.curdir,
@@ -236,24 +456,37 @@ class SchrootWorker(ContainerWorker, InteractiveWorker):
             chroot=None,
             components=(),
             extra_repositories=(),
+            mode='file',
             storage=None,
             tarball=None):
         super().__init__(mirrors=mirrors, suite=suite)
 
+        assert mode in ('file', 'overlay'), mode
+
         if chroot is None:
             chroot = '{}-{}-{}'.format(suite.vendor, suite, architecture)
 
         if tarball is None:
             assert storage is not None
 
-            tarball = os.path.join(
+            tarball = find_tarball(os.path.join(
                 storage, architecture, str(suite.hierarchy[-1].vendor),
-                str(suite.hierarchy[-1]), 'sbuild.tar.gz')
+                str(suite.hierarchy[-1]), 'sbuild.tar.gz'))
+
+        if get_tarball_compression(tarball) == 'zstd':
+            # schroot can only open type=file chroots that tar can
+            # decompress without help, so unpack zstd tarballs instead
+            if mode == 'file':
+                logger.info('Using overlay mode for %s', tarball)
+                mode = 'overlay'
+
+            worker.provision(ZSTD)
 
         self.chroot = chroot
         self.components = components
         self.__dpkg_architecture = architecture
         self.extra_repositories = extra_repositories
+        self.mode = mode
         self.tarball = tarball
         self.worker = worker
 
@@ -270,41 +503,87 @@ class SchrootWorker(ContainerWorker, InteractiveWorker):
 
     def _open(self):
         super()._open()
-        self.set_up_apt()
 
-    def set_up_apt(self):
+        with self.worker.chroot_setup_lock:
+            self.set_up_apt()
+
+    def _unpack(self):
+        """
+        Unpack the tarball into a directory in the worker, unless an
+        earlier SchrootWorker already did, and return the directory.
+        """
+        directory = '/srv/vectis/chroots/{}'.format(self.chroot)
+        stat = os.stat(self.tarball)
+        stamp = '{} {} {}'.format(
+            os.path.abspath(self.tarball), stat.st_size, stat.st_mtime_ns)
+        script = 'test "$(cat "$1.unpacked" 2>/dev/null)" = "$2"'
+
+        if self.worker.call(
+                ['sh', '-c', script, 'sh', directory, stamp]) == 0:
+            logger.info('Reusing unpacked chroot guest:%s', directory)
+            return directory
+
         tarball_in_guest = self.worker.make_file_available(
             self.tarball, cache=True)
+        logger.info('Unpacking %s into guest:%s', self.tarball, directory)
+        self.worker.check_call([
+            'sh', '-euc',
+            'mkdir -p "${1%/*}"; '
+            'exec 9>"$1.lock"; '
+            'flock 9; '
+            # Another SchrootWorker might have done this while we waited
+            'if ' + script + '; then exit 0; fi; '
+            'rm -fr "$1" "$1.unpacked"; '
+            'mkdir "$1"; '
+            'd="$1"; s="$2"; shift 2; '
+            'tar -C "$d" "$@"; '
+            'printf "%s\\n" "$s" > "$d.unpacked"',
+            'sh', directory, stamp,
+        ] + get_tar_compress_options(
+            get_tarball_compression(self.tarball)) + [
+            '-xf', tarball_in_guest,
+        ])
+        return directory
 
-        tmp = TemporaryDirectory(prefix='vectis-worker-')
-        tmp = self.stack.enter_context(tmp)
-        sources_list = os.path.join(tmp, 'sources.list')
+    def set_up_apt(self):
+        if self.mode == 'overlay':
+            # Each session gets its own overlayfs on top of the
+            # unpacked chroot, so it does not need unpacking again
+            chroot_type = textwrap.dedent('''\
+            type=directory
+            directory={}
+            union-type=overlay
+            ''').format(self._unpack())
+        else:
+            chroot_type = textwrap.dedent('''\
+            type=file
+            file={}
+            ''').format(self.worker.make_file_available(
+                self.tarball, cache=True))
 
-        with AtomicWriter(sources_list) as writer:
-            self.write_sources_list(writer)
+        sources_list = io.StringIO()
+        self.write_sources_list(sources_list)
         self.worker.check_call(['mkdir', '-p', '/etc/schroot/sources.list.d'])
-        self.worker.copy_to_guest(
-            sources_list,
-            '/etc/schroot/sources.list.d/{}'.format(self.chroot))
+        self.worker.write_to_guest(
+            '/etc/schroot/sources.list.d/{}'.format(self.chroot),
+            sources_list.getvalue())
 
-        with AtomicWriter(os.path.join(tmp, 'sbuild.conf')) as writer:
-            writer.write(textwrap.dedent('''
+        self.worker.write_to_guest(
+            '/etc/schroot/chroot.d/{}'.format(self.chroot),
+            textwrap.dedent('''
             [{chroot}]
-            type=file
+            {chroot_type}
             description=An autobuilder
-            file={tarball_in_guest}
             groups=root,sbuild
             root-groups=root,sbuild
             profile=sbuild
             ''').format(
                 chroot=self.chroot,
-                tarball_in_guest=tarball_in_guest))
-        self.worker.copy_to_guest(
-            os.path.join(tmp, 'sbuild.conf'),
-            '/etc/schroot/chroot.d/{}'.format(self.chroot))
+                chroot_type=chroot_type.rstrip('\n')))
 
-        with AtomicWriter(os.path.join(tmp, '60vectis-sources')) as writer:
-            writer.write(textwrap.dedent('''\
+        self.worker.write_to_guest(
+            '/etc/schroot/setup.d/60vectis-sources',
+            textwrap.dedent('''\
             #!/bin/sh
             set -e
             set -u
@@ -326,12 +605,8 @@ class SchrootWorker(ContainerWorker, InteractiveWorker):
                         ${CHROOT_PATH}/etc/apt/trusted.gpg.d/
                 fi
             fi
-            '''))
-        self.worker.copy_to_guest(
-            os.path.join(tmp, '60vectis-sources'),
-            '/etc/schroot/setup.d/60vectis-sources')
-        self.worker.check_call(
-            ['chmod', '0755', '/etc/schroot/setup.d/60vectis-sources'])
+            '''),
+            mode=0o755)
         self.install_apt_keys()
 
     def install_apt_key(self, apt_key):
@@ -369,122 +644,552 @@ class VirtWorker(InteractiveWorker, ContainerWorker, FileProvider):
             mirrors,
             storage,
             suite,
+            agent=True,
             apt_update=True,
+            cache_image=None,
+            cache_size=0,
             components=(),
-            extra_repositories=()):
+            extra_repositories=(),
+            pool=None,
+            recipes=(),
+            snapshots=False,
+            trace=None):
         super().__init__(mirrors=mirrors, suite=suite)
 
+        self.__agent = None
+        self.__baked_recipes = set()
+        self.__cache_booted = False
         self.__cached_copies = {}
         self.__command_wrapper_enabled = False
+        self.__prepared = False
+        self.__provisioned = None
+        self.__recipes = []
+        self.agent = agent
         self.apt_update = apt_update
         self.argv = argv
+        self.cache_disk = None
+        self.cache_mounted = False
         self.call_argv = None
         self.capabilities = set()
         self.command_wrapper = None
         self.components = components
         self.extra_repositories = extra_repositories
+        self.pool = pool
+        self.snapshots = snapshots
+        self.storage = storage
+        self.trace = trace
         self.user = 'user'
         self.virt_process = None
+        self.virt_stdin = None
+        self.virt_stdout = None
+        # Serializes use of the virtualization server's protocol by
+        # concurrent builds
+        self.__virt_lock = threading.Lock()
+        self.__provision_lock = threading.RLock()
+        # Held while setting up a chroot in this worker, because
+        # concurrent builds might share the same chroot and tarball
+        self.chroot_setup_lock = threading.Lock()
+
+        if cache_image is not None and cache_size > 0:
+            self.cache_disk = CacheDisk(cache_image, size=cache_size)
+
+        for recipe in recipes:
+            self.provision(recipe)
 
     def __repr__(self):
         return '<{} {}>'.format(self.__class__.__name__, self.argv)
 
     def _open(self):
         super()._open()
-        argv = list(map(os.path.expanduser, self.argv))
 
-        for prefix in ('autopkgtest-virt-', 'adt-virt-', ''):
-            if shutil.which(prefix + argv[0]):
-                argv[0] = prefix + argv[0]
-                break
+        self.__baked_recipes = set()
+        self.__provisioned = set()
+        self.stack.callback(self._forget_provisioning)
+
+        if self.pool is not None and self._lease_from_pool():
+            pass
+        else:
+            self._lock_cache_disk()
+
+            if not (self.snapshots and self._open_snapshot()):
+                self._start()
+                self._negotiate()
+                self._prepare()
+
+        self._provision()
+
+    def _forget_provisioning(self):
+        self.__provisioned = None
+
+    def provision(self, recipe):
+        """
+        Make sure the worker has been provisioned with recipe, a
+        vectis.provision.Recipe. If the worker is not open yet, this is
+        done when it is opened; if snapshots are enabled, the result is
+        saved as part of the snapshot, so that later workers with the
+        same recipes do not need to repeat it.
+        """
+        with self.__provision_lock:
+            if recipe not in self.__recipes:
+                self.__recipes.append(recipe)
+
+            if self.__provisioned is not None:
+                self._provision()
+
+    def _provision(self):
+        with self.__provision_lock:
+            for recipe in self.__recipes:
+                if recipe not in self.__provisioned:
+                    recipe.apply(self)
+                    self.__provisioned.add(recipe)
+
+    def _lock_cache_disk(self):
+        if self.cache_disk is None:
+            return
+
+        if find_image(list(map(os.path.expanduser, self.argv))) is None:
+            logger.warning(
+                'Unable to attach cache disk to %r: only '
+                'autopkgtest-virt-qemu is supported', self)
+            self.cache_disk = None
+        elif self.cache_disk.acquire():
+            self.stack.callback(self.cache_disk.release)
         else:
-            raise WorkerError('virtualization provider %r not found' % argv[0])
+            self.cache_disk = None
+
+    def _start(self, argv=None, *, attach_cache=True):
+        if argv is None:
+            argv = self.argv
+
+        argv = list(map(os.path.expanduser, argv))
+
+        if attach_cache and self.cache_disk is not None:
+            options = self.cache_disk.get_qemu_options()
+
+            for i, arg in enumerate(argv):
+                if arg.startswith('--qemu-options='):
+                    argv[i] = '{} {}'.format(arg, options)
+                    break
+            else:
+                argv.insert(1, '--qemu-options={}'.format(options))
+
+            self.__cache_booted = True
 
+        argv[0] = find_virt_provider(argv[0])
         logger.info('Starting worker: %r', argv)
         self.virt_process = subprocess.Popen(
             argv,
             stdin=subprocess.PIPE,
             stdout=subprocess.PIPE,
             universal_newlines=True)
+        self.virt_stdin = self.virt_process.stdin
+        self.virt_stdout = self.virt_process.stdout
         self.stack.enter_context(self.virt_process)
         self.stack.callback(self.virt_process.terminate)
         # FIXME: timed wait for a response?
         self.stack.callback(self.virt_process.stdin.flush)
         self.stack.callback(self.virt_process.stdin.write, 'quit\n')
 
-        line = self.virt_process.stdout.readline()
+        line = self.virt_stdout.readline()
 
         if line != 'ok\n':
             raise WorkerError('Virtual machine {!r} failed to start: '
                               '{}'.format(argv, line.strip()))
 
-        self.virt_process.stdin.write('capabilities\n')
-        self.virt_process.stdin.flush()
-        line = self.virt_process.stdout.readline()
+    def _negotiate(self):
+        argv = self.argv
+        line = self.virt_command('capabilities')
+        self.capabilities, user = parse_capabilities(argv, line)
 
-        if not line.startswith('ok '):
-            raise WorkerError(
-                'Virtual machine {!r} failed to report capabilities: '
-                '{}'.format(line.strip()))
-
-        for word in line.split()[1:]:
-            self.capabilities.add(word)
-            if word.startswith('suggested-normal-user='):
-                self.user = word[len('suggested-normal-user='):]
-
-        if 'root-on-testbed' not in self.capabilities:
-            raise WorkerError(
-                'Virtual machine {!r} does not have root-on-testbed '
-                'capability: {}'.format(argv, line.strip()))
-
-        if ('isolation-machine' not in self.capabilities and
-                'isolation-container' not in self.capabilities):
-            raise WorkerError(
-                'Virtual machine {!r} does not have sufficient isolation: '
-                '{}'.format(argv, line.strip()))
+        if user is not None:
+            self.user = user
 
-        self.virt_process.stdin.write('open\n')
-        self.virt_process.stdin.flush()
-        line = self.virt_process.stdout.readline()
+        line = self.virt_command('open')
         if not line.startswith('ok '):
             raise WorkerError(
                 'Failed to open virtual machine session '
                 '{!r}: {}'.format(argv, line))
         self.scratch = line[3:].rstrip('\n')
 
-        self.virt_process.stdin.write('print-execute-command\n')
-        self.virt_process.stdin.flush()
-        line = self.virt_process.stdout.readline()
-        if not line.startswith('ok '):
-            raise WorkerError(
-                'Failed to get virtual machine {!r} command '
-                'wrapper: {}'.format(argv, line.strip()))
+        self._get_execute_command()
 
-        wrapper_argv = line.rstrip('\n').split(None, 1)[1].split(',')
-        self.call_argv = list(map(urllib.parse.unquote, wrapper_argv))
-        if not self.call_argv:
-            raise WorkerError(
-                'Virtual machine {!r} command wrapper did not provide any '
-                'arguments: {}'.format(argv, line.strip()))
+    def _get_execute_command(self):
+        line = self.virt_command('print-execute-command')
+        self.call_argv = parse_execute_command(self.argv, line)
 
+    def _prepare(self):
         wrapper = '{}/vectis-command-wrapper'.format(self.scratch)
         self.copy_to_guest(_WRAPPER, wrapper)
         self.check_call(['chmod', '+x', wrapper])
         self.command_wrapper = wrapper
+        self._start_agent()
+
+        if self.__cache_booted:
+            self.cache_mounted = self.cache_disk.mount(self)
+
+        if self.__prepared:
+            # sources.list and keys are already in place, but the
+            # snapshot's package lists might be out of date
+            self.apt_get_update()
+        else:
+            self.set_up_apt()
+
+    def _start_agent(self):
+        if not self.agent:
+            return
+
+        if self.__agent is not None:
+            self.__agent.close()
+            self.__agent = None
+
+        agent = GuestAgent(self.call_argv + [self.command_wrapper, '--agent'])
+
+        try:
+            agent.ping()
+        except AgentError as e:
+            logger.warning(
+                'Unable to start agent in %r, running commands '
+                'individually: %s', self, e)
+            agent.close()
+        else:
+            self.__agent = agent
+            self.stack.callback(self._stop_agent, agent)
+
+    def _stop_agent(self, agent):
+        if self.__agent is agent:
+            self.__agent = None
+
+        agent.close()
+
+    def _get_live_agent(self):
+        agent = self.__agent
+
+        if agent is not None and agent.closed:
+            logger.warning(
+                'Agent in %r has exited, running commands individually',
+                self)
+            self.__agent = None
+            return None
+
+        return agent
+
+    def _abandon_agent(self, agent, error):
+        logger.warning(
+            'Agent in %r is not responding, running commands '
+            'individually: %s', self, error)
+
+        if self.__agent is agent:
+            self.__agent = None
+
+    def _get_preparation_inputs(self, recipes=()):
+        sources_list = io.StringIO()
+        self.write_sources_list(sources_list)
+        apt_keys = []
+
+        for ancestor in self.suite.hierarchy:
+            if ancestor.apt_key is not None:
+                with open(ancestor.apt_key, 'rb') as reader:
+                    apt_keys.append(
+                        hashlib.sha256(reader.read()).hexdigest())
+
+        inputs = dict(
+            apt_keys=apt_keys,
+            sources_list=sources_list.getvalue(),
+        )
+
+        if recipes:
+            # Packages installed by the recipes should be upgraded
+            # whenever the archive changes, so a change to any of the
+            # package lists invalidates the snapshot
+            inputs['recipes'] = sorted(
+                (r.get_inputs() for r in recipes),
+                key=lambda i: i['name'])
+            inputs['package_lists'] = [
+                get_release_digest(
+                    self.mirrors.lookup_suite_from_host(ancestor),
+                    ancestor.apt_suite)
+                for ancestor in self.suite.hierarchy]
+
+        return inputs
+
+    def _open_snapshot(self):
+        """
+        Boot from a snapshot of the worker's disk as it was after
+        _prepare(), creating the snapshot first if necessary. Return
+        True on success, or False if the caller should boot the worker
+        normally.
+        """
+        argv = list(map(os.path.expanduser, self.argv))
+        i = find_image(argv)
+
+        if i is None:
+            logger.warning(
+                'Unable to snapshot %r: only autopkgtest-virt-qemu with a '
+                'disk image is supported', self)
+            return False
 
-        self.set_up_apt()
+        recipes = list(self.__recipes)
+        inputs = self._get_preparation_inputs(recipes)
+
+        if None in inputs.get('package_lists', ()):
+            # We can't tell whether the snapshot is up to date
+            logger.info('Not using snapshot for %r with %r', self, recipes)
+            recipes = []
+            inputs = self._get_preparation_inputs()
+
+        store = SnapshotStore(self.storage)
+        key = store.get_key(argv[i], inputs)
+        path = store.get_path(key)
+
+        with store.lock(key):
+            if os.path.exists(path + '.ready'):
+                logger.info('Restoring %r from snapshot %s', self, path)
+                store.mark_used(key)
+                argv[i] = path
+                self._start(argv)
+                self._negotiate()
+                self.__prepared = True
+                self.__baked_recipes = set(recipes)
+                self.__provisioned = set(recipes)
+                self._prepare()
+                return True
+
+            logger.info('Creating snapshot %s of %r', path, self)
+            store.create_overlay(argv[i], path)
+            store.record(key, argv[i], inputs)
+            argv[i] = path
+            # Don't let the cache disk's contents become part of the
+            # snapshot
+            self._start(argv, attach_cache=False)
+            self._negotiate()
+            self._prepare()
+            self._provision()
+
+            try:
+                self.commit_disk()
+            except (OSError, SnapshotError) as e:
+                logger.warning('Unable to save snapshot %s: %s', path, e)
+            else:
+                with open(path + '.ready', 'w'):
+                    pass
+
+                self.__prepared = True
+                self.__baked_recipes = set(recipes)
+
+        return True
+
+    def commit_disk(self):
+        """
+        Write the changes made to the worker's disk so far into the
+        image that it was booted from, instead of letting
+        autopkgtest-virt-qemu discard them when the worker is closed.
+        """
+        self.check_call(['sync'])
+        commit_overlay(
+            os.path.join(os.path.dirname(self.call_argv[0]), 'monitor'))
+
+    def _lease_from_pool(self):
+        """
+        Try to take over an already-booted worker from a running
+        "vectis worker-pool" service. Return True on success, or False
+        if the caller should boot a worker itself.
+        """
+        if not os.path.exists(self.pool):
+            return False
+
+        request = {
+            'argv': list(self.argv),
+            'components': sorted(self.components),
+            'extra_repositories': list(self.extra_repositories),
+            'suite': str(self.suite),
+            'vendor': str(self.suite.vendor),
+        }
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+        try:
+            sock.connect(self.pool)
+            channel = sock.makefile('rw', encoding='utf-8')
+            channel.write('lease {}\n'.format(json.dumps(request)))
+            channel.flush()
+            line = channel.readline()
+        except OSError as e:
+            sock.close()
+            logger.warning(
+                'Unable to lease a worker from pool %s, starting one '
+                'instead: %s', self.pool, e)
+            return False
+
+        if not line.startswith('ok '):
+            channel.close()
+            sock.close()
+            logger.warning(
+                'Worker pool %s could not provide %r, starting one '
+                'instead: %s', self.pool, self.argv, line.strip())
+            return False
+
+        self.stack.callback(sock.close)
+        self.stack.callback(channel.close)
+        self.virt_stdin = channel
+        self.virt_stdout = channel
+
+        lease = json.loads(line[3:])
+        self.capabilities = set(lease['capabilities'])
+        self.call_argv = lease['call_argv']
+        self.command_wrapper = lease['command_wrapper']
+        self.scratch = lease['scratch']
+        self.user = lease['user']
+
+        if lease.get('cache_image') is not None:
+            self.cache_disk = CacheDisk(
+                lease['cache_image'], size=lease['cache_size'])
+            self.cache_mounted = True
+
+        logger.info('Leased worker %r from pool %s', self, self.pool)
+        self._start_agent()
+        return True
+
+    def virt_command(self, command):
+        """
+        Send one command to the autopkgtest virtualization server and
+        return its single-line reply.
+        """
+        with self.__virt_lock:
+            self.virt_stdin.write(command + '\n')
+            self.virt_stdin.flush()
+            return self.virt_stdout.readline()
+
+    def revert(self):
+        """
+        Revert the worker to its pristine state, discarding everything
+        that was done to it since it was opened, and prepare it again.
+        """
+        if 'revert' not in self.capabilities:
+            raise WorkerError(
+                'Virtual machine {!r} cannot be reverted'.format(self.argv))
+
+        line = self.virt_command('revert')
+        if not line.startswith('ok '):
+            raise WorkerError(
+                'Failed to revert virtual machine {!r}: {}'.format(
+                    self.argv, line.strip()))
+        self.scratch = line[3:].rstrip('\n')
+        self.__cached_copies = {}
+
+        if self.__agent is not None:
+            self.__agent.close()
+            self.__agent = None
+
+        self._get_execute_command()
+        self._prepare()
+        # Anything that was not part of the image we booted from has
+        # been lost
+        self.__provisioned = set(self.__baked_recipes)
+        self._provision()
+
+    def _get_agent(self, kwargs):
+        # The agent can only be used for commands that don't need their
+        # standard input or output redirected elsewhere
+        if set(kwargs) <= {'universal_newlines'}:
+            return self._get_live_agent()
+
+        return None
+
+    def _run_in_agent(self, agent, argv, *, check, capture,
+                      universal_newlines=False):
+        status, output = agent.run(argv, capture=capture)
+
+        if check and status != 0:
+            raise subprocess.CalledProcessError(
+                status, self.call_argv + list(argv), output=output)
+
+        if output is not None and universal_newlines:
+            output = output.decode(locale.getpreferredencoding(False))
+
+        return status, output
 
     def call(self, argv, **kwargs):
         logger.info('%r: %r', self, argv)
-        return subprocess.call(self.call_argv + list(argv), **kwargs)
+        agent = self._get_agent(kwargs)
+
+        with self.timed('call', argv) as record:
+            if agent is not None:
+                record['status'] = self._run_in_agent(
+                    agent, argv, check=False, capture=False, **kwargs)[0]
+            else:
+                record['status'] = subprocess.call(
+                    self.call_argv + list(argv), **kwargs)
+
+            return record['status']
 
     def check_call(self, argv, **kwargs):
         logger.info('%r: %r', self, argv)
-        subprocess.check_call(self.call_argv + list(argv), **kwargs)
+        agent = self._get_agent(kwargs)
+
+        with self.timed('check_call', argv) as record:
+            if agent is not None:
+                self._run_in_agent(
+                    agent, argv, check=True, capture=False, **kwargs)
+            else:
+                subprocess.check_call(self.call_argv + list(argv), **kwargs)
+
+            record['status'] = 0
 
     def check_output(self, argv, **kwargs):
         logger.info('%r: %r', self, argv)
-        return subprocess.check_output(self.call_argv + list(argv), **kwargs)
+        agent = self._get_agent(kwargs)
+
+        with self.timed('check_output', argv) as record:
+            if agent is not None:
+                output = self._run_in_agent(
+                    agent, argv, check=True, capture=True, **kwargs)[1]
+            else:
+                output = subprocess.check_output(
+                    self.call_argv + list(argv), **kwargs)
+
+            record['status'] = 0
+            record['bytes'] = len(output)
+            return output
+
+    def guest_path_exists(self, guest_path):
+        agent = self._get_live_agent()
+
+        if agent is not None:
+            try:
+                return agent.exists(guest_path)
+            except AgentTimeout as e:
+                self._abandon_agent(agent, e)
+
+        return self.call(['test', '-e', guest_path]) == 0
+
+    def write_to_guest(self, guest_path, data, *, mode=0o644):
+        """
+        Write data, which may be str or bytes, to guest_path.
+        """
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+
+        logger.info('Writing %d bytes to guest:%s', len(data), guest_path)
+
+        agent = self._get_live_agent()
+
+        if agent is not None:
+            try:
+                agent.write(guest_path, data, mode=mode)
+            except AgentTimeout as e:
+                self._abandon_agent(agent, e)
+            else:
+                return
+
+        with TemporaryDirectory(prefix='vectis-worker-') as tmp:
+            host_path = os.path.join(tmp, os.path.basename(guest_path))
+
+            with open(host_path, 'wb') as writer:
+                writer.write(data)
+
+            self.copy_to_guest(host_path, guest_path)
+
+        self.check_call(['chmod', '{:o}'.format(mode), guest_path])
 
     def copy_to_guest(self, host_path, guest_path, *, cache=False):
         assert host_path is not None
@@ -509,14 +1214,17 @@ class VirtWorker(InteractiveWorker, ContainerWorker, FileProvider):
         else:
             suffix = ''
 
-        self.virt_process.stdin.write('copydown {}{} {}{}\n'.format(
-            urllib.parse.quote(host_path),
-            suffix,
-            urllib.parse.quote(guest_path),
-            suffix,
-        ))
-        self.virt_process.stdin.flush()
-        line = self.virt_process.stdout.readline()
+        with self.timed(
+                'copydown', '{} {}'.format(host_path, guest_path)) as record:
+            line = self.virt_command('copydown {}{} {}{}'.format(
+                urllib.parse.quote(host_path),
+                suffix,
+                urllib.parse.quote(guest_path),
+                suffix,
+            ))
+
+            if not suffix:
+                record['bytes'] = os.path.getsize(host_path)
 
         if line != 'ok\n':
             raise WorkerError(
@@ -527,7 +1235,7 @@ class VirtWorker(InteractiveWorker, ContainerWorker, FileProvider):
             self.__cached_copies[host_path] = guest_path
 
     def copy_to_host(self, guest_path, host_path):
-        if self.call(['test', '-e', guest_path]) != 0:
+        if not self.guest_path_exists(guest_path):
             raise WorkerError(
                 'Cannot copy guest:{!r} to host: it does not exist'.format(
                     guest_path))
@@ -535,37 +1243,211 @@ class VirtWorker(InteractiveWorker, ContainerWorker, FileProvider):
         logger.info('Copying guest:{} to host:{}'.format(
             guest_path, host_path))
 
-        self.virt_process.stdin.write('copyup {} {}\n'.format(
-            urllib.parse.quote(guest_path),
-            urllib.parse.quote(host_path),
-        ))
-        self.virt_process.stdin.flush()
-        line = self.virt_process.stdout.readline()
+        with self.timed(
+                'copyup', '{} {}'.format(guest_path, host_path)) as record:
+            line = self.virt_command('copyup {} {}'.format(
+                urllib.parse.quote(guest_path),
+                urllib.parse.quote(host_path),
+            ))
+
+            if os.path.isfile(host_path):
+                record['bytes'] = os.path.getsize(host_path)
+
         if line != 'ok\n':
             raise WorkerError(
                 'Failed to copy guest:{!r} to host:{!r}: {}'.format(
                     guest_path, host_path, line.strip()))
 
+    def copy_tree_to_guest(self, host_dir, guest_dir, *, exclude=(),
+                           keep=frozenset(), owner=None):
+        """
+        Copy the contents of host_dir into guest_dir as a compressed tar
+        stream, creating guest_dir if necessary. Paths matching any of
+        the tar(1) --exclude patterns in exclude are not copied, unless
+        they are one of the paths relative to host_dir in keep. If
+        owner is given, the copied files belong to owner, which is in
+        the same format as for chown(1).
+        """
+        if owner is None:
+            owner = 'root'
+
+        user, _, group = owner.partition(':')
+
+        if not group:
+            group = 'root'
+
+        def filter_(info):
+            if tar_excluded(info.name, exclude, keep=keep):
+                return None
+
+            info.uid = 0
+            info.gid = 0
+            info.uname = user
+            info.gname = group
+            return info
+
+        start = time.time()
+        guest = subprocess.Popen(self.call_argv + [
+            'sh', '-euc', 'mkdir -p "$1"; cd "$1"; exec tar -xzf -',
+            'sh', guest_dir,
+        ], stdin=subprocess.PIPE)
+        gzip = subprocess.Popen(
+            ['gzip', '-1'], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        pump = _Pump(gzip.stdout, guest.stdin)
+
+        try:
+            with tarfile.open(fileobj=gzip.stdin, mode='w|') as tar:
+                tar.add(host_dir, arcname='.', filter=filter_)
+        finally:
+            gzip.stdin.close()
+            status = gzip.wait()
+            pump.join()
+
+            with suppress(BrokenPipeError):
+                guest.stdin.close()
+
+            status = guest.wait() or status
+
+        if status != 0:
+            raise WorkerError(
+                'Failed to copy host:{!r} to guest:{!r}: tar exited with '
+                'status {}'.format(host_dir, guest_dir, status))
+
+        _log_throughput(
+            'host:{}'.format(host_dir), 'guest:{}'.format(guest_dir),
+            pump.count, time.time() - start)
+        self.record_operation(
+            'copy_tree_to_guest', '{} {}'.format(host_dir, guest_dir),
+            start, bytes=pump.count, status=status)
+
+    def copy_tree_to_host(self, guest_dir, host_dir):
+        """
+        Copy the contents of guest_dir into host_dir, which must exist,
+        as a compressed tar stream.
+        """
+        if not self.guest_path_exists(guest_dir):
+            raise WorkerError(
+                'Cannot copy guest:{!r} to host: it does not exist'.format(
+                    guest_dir))
+
+        start = time.time()
+        guest = subprocess.Popen(
+            self.call_argv + ['tar', '-C', guest_dir, '-czf', '-', '.'],
+            stdout=subprocess.PIPE)
+        host = subprocess.Popen(
+            ['tar', '-C', host_dir, '--no-same-owner', '-xzf', '-'],
+            stdin=subprocess.PIPE)
+        pump = _Pump(guest.stdout, host.stdin)
+        pump.join()
+
+        with suppress(BrokenPipeError):
+            host.stdin.close()
+
+        status = guest.wait()
+        status = host.wait() or status
+
+        if status != 0:
+            raise WorkerError(
+                'Failed to copy guest:{!r} to host:{!r}: tar exited with '
+                'status {}'.format(guest_dir, host_dir, status))
+
+        _log_throughput(
+            'guest:{}'.format(guest_dir), 'host:{}'.format(host_dir),
+            pump.count, time.time() - start)
+        self.record_operation(
+            'copy_tree_to_host', '{} {}'.format(guest_dir, host_dir),
+            start, bytes=pump.count, status=status)
+
+    def copy_sparse_file_to_host(self, guest_path, host_dir, *,
+                                 interval=10):
+        """
+        Copy guest_path, a possibly sparse file such as a raw disk
+        image, into host_dir, which must exist, as a compressed tar
+        stream. Holes in the file are skipped when reading it, and
+        recreated on the host. Progress is logged every interval
+        seconds.
+        """
+        if not self.guest_path_exists(guest_path):
+            raise WorkerError(
+                'Cannot copy guest:{!r} to host: it does not exist'.format(
+                    guest_path))
+
+        if (shutil.which('zstd') is not None and
+                self.call(['sh', '-c', 'command -v zstd >/dev/null']) == 0):
+            compression = 'zstd'
+        else:
+            compression = 'gzip'
+
+        blocks, block_size = self.check_output(
+            ['stat', '-c', '%b %B', guest_path],
+            universal_newlines=True).split()
+        allocated = int(blocks) * int(block_size)
+        host_path = os.path.join(host_dir, os.path.basename(guest_path))
+
+        start = time.time()
+        guest = subprocess.Popen(self.call_argv + [
+            'tar', '--sparse',
+            '-C', os.path.dirname(guest_path),
+            '-cf', '-',
+        ] + get_tar_compress_options(compression) + [
+            '--', os.path.basename(guest_path),
+        ], stdout=subprocess.PIPE)
+        host = subprocess.Popen([
+            'tar', '-C', host_dir, '--no-same-owner', '-xf', '-',
+        ] + get_tar_compress_options(compression), stdin=subprocess.PIPE)
+        pump = _Pump(guest.stdout, host.stdin)
+
+        while True:
+            pump.join(interval)
+
+            if not pump.is_alive():
+                break
+
+            with suppress(FileNotFoundError):
+                done = os.stat(host_path).st_blocks * 512
+                seconds = time.time() - start
+                logger.info(
+                    'Copying guest:%s: %.1f of %.1f MiB of data '
+                    '(%.1f MB/s, %.1f MB/s compressed)',
+                    guest_path, done / (1024 * 1024),
+                    allocated / (1024 * 1024),
+                    done / max(seconds, 0.001) / 1e6,
+                    pump.count / max(seconds, 0.001) / 1e6)
+
+        with suppress(BrokenPipeError):
+            host.stdin.close()
+
+        status = guest.wait()
+        status = host.wait() or status
+
+        if status != 0:
+            raise WorkerError(
+                'Failed to copy guest:{!r} to host:{!r}: tar exited with '
+                'status {}'.format(guest_path, host_dir, status))
+
+        _log_throughput(
+            'guest:{}'.format(guest_path), 'host:{}'.format(host_path),
+            pump.count, time.time() - start)
+        self.record_operation(
+            'copy_sparse_file_to_host', '{} {}'.format(guest_path, host_dir),
+            start, bytes=pump.count, status=status)
+
     def open_shell(self):
-        self.virt_process.stdin.write('shell\n')
-        self.virt_process.stdin.flush()
-        line = self.virt_process.stdout.readline()
+        line = self.virt_command('shell')
         if line != 'ok\n':
             logger.warning('Unable to open a shell in guest: %s', line.strip())
 
     def set_up_apt(self):
         logger.info('Configuring apt in %r for %s', self, self.suite)
 
-        with TemporaryDirectory(prefix='vectis-worker-') as tmp:
-            sources_list = os.path.join(tmp, 'sources.list')
-
-            with AtomicWriter(sources_list) as writer:
-                self.write_sources_list(writer)
-
-            self.copy_to_guest(sources_list, '/etc/apt/sources.list')
+        sources_list = io.StringIO()
+        self.write_sources_list(sources_list)
+        self.write_to_guest('/etc/apt/sources.list', sources_list.getvalue())
 
         self.install_apt_keys()
+        self.apt_get_update()
 
+    def apt_get_update(self):
         if self.apt_update:
             self.check_call([
                 'env', 'DEBIAN_FRONTEND=noninteractive',
@@ -573,10 +1455,11 @@ class VirtWorker(InteractiveWorker, ContainerWorker, FileProvider):
             ])
 
     def install_apt_key(self, apt_key):
-        self.copy_to_guest(
-            apt_key,
-            '/etc/apt/trusted.gpg.d/{}-{}'.format(
-                uuid.uuid4(), os.path.basename(apt_key)))
+        with open(apt_key, 'rb') as reader:
+            self.write_to_guest(
+                '/etc/apt/trusted.gpg.d/{}-{}'.format(
+                    uuid.uuid4(), os.path.basename(apt_key)),
+                reader.read())
 
     def make_file_available(
             self,
@@ -594,6 +1477,13 @@ class VirtWorker(InteractiveWorker, ContainerWorker, FileProvider):
                     os.path.commonpath([in_guest, in_dir]) == in_dir):
                 return in_guest
 
+        if (cache and self.cache_mounted and in_dir == self.scratch and
+                owner is None):
+            in_guest = self.cache_disk.make_file_available(self, filename)
+
+            if in_guest is not None:
+                return in_guest
+
         unique = str(uuid.uuid4())
         in_guest = '{}/{}/{}'.format(
             in_dir, unique, os.path.basename(filename))
@@ -622,40 +1512,178 @@ class VirtWorker(InteractiveWorker, ContainerWorker, FileProvider):
         self.check_call(['chmod', '0755', d])
         return d
 
-    def make_dsc_file_available(self, filename, owner=None):
-        d = os.path.dirname(filename) or os.curdir
+    def copy_files_to_guest(self, filenames, guest_dir, *, owner=None):
+        """
+        Copy each of filenames into guest_dir as a single tar stream,
+        creating guest_dir if necessary. If owner is given, guest_dir
+        and the copied files belong to owner, which is in the same
+        format as for chown(1).
+        """
+        if owner is None:
+            owner = 'root'
+
+        user, _, group = owner.partition(':')
+
+        if not group:
+            group = 'root'
+
+        def fix_ownership(info):
+            info.uid = 0
+            info.gid = 0
+            info.uname = user
+            info.gname = group
+            return info
+
+        logger.info('Copying %d files to guest:%s', len(filenames), guest_dir)
+        start = time.time()
+        process = subprocess.Popen(self.call_argv + [
+            'sh', '-euc', 'mkdir -p "$1"; cd "$1"; exec tar -xf -',
+            'sh', guest_dir,
+        ], stdin=subprocess.PIPE)
+
+        try:
+            with tarfile.open(fileobj=process.stdin, mode='w|') as tar:
+                if owner != 'root':
+                    info = tarfile.TarInfo('.')
+                    info.type = tarfile.DIRTYPE
+                    info.mode = 0o755
+                    tar.addfile(fix_ownership(info))
+
+                for filename in filenames:
+                    # Follow symlinks, for example to orig tarballs
+                    with open(filename, 'rb') as reader:
+                        info = tar.gettarinfo(
+                            arcname=os.path.basename(filename),
+                            fileobj=reader)
+                        tar.addfile(fix_ownership(info), reader)
+        finally:
+            process.stdin.close()
+            status = process.wait()
+
+        if status != 0:
+            raise WorkerError(
+                'Failed to copy {!r} to guest:{!r}: tar exited with '
+                'status {}'.format(filenames, guest_dir, status))
 
-        with open(filename) as reader:
-            dsc = Dsc(reader)
+        self.record_operation(
+            'copy_files_to_guest', '{} {}'.format(filenames, guest_dir),
+            start, bytes=sum(os.path.getsize(f) for f in filenames),
+            status=status)
 
+    def make_files_available(self, filenames, *, owner=None):
         to = self.new_directory()
-        files = [to, '{}/{}'.format(to, os.path.basename(filename))]
-        self.copy_to_guest(filename, files[-1])
-
-        for f in dsc['files']:
-            files.append('{}/{}'.format(to, f['name']))
-            self.copy_to_guest(os.path.join(d, f['name']), files[-1])
-
-        if owner is not None:
-            self.check_call(['chown', owner] + files)
-
-        return files[0], os.path.basename(filename)
-
-    def make_changes_file_available(self, filename, owner=None):
-        d = os.path.dirname(filename) or os.curdir
-
-        with open(filename) as reader:
-            changes = Changes(reader)
+        self.copy_files_to_guest(filenames, to, owner=owner)
+        return to
+
+
+class WorkerGroup:
+    """
+    A set of equivalent workers shared between concurrent tasks, each
+    of which leases a worker for as long as it needs one. Workers are
+    opened the first time they are leased, in order, after taking
+    memory_size bytes from memory_budget (a vectis.util.MemoryBudget),
+    and stay open until the group is closed.
+    """
+
+    def __init__(self, workers, *, memory_budget=None, memory_size=None):
+        self.memory_budget = memory_budget
+        self.memory_size = memory_size
+        self.stack = ExitStack()
+        self.__condition = threading.Condition()
+        self.__idle = []
+        self.__opened = 0
+        self.__unopened = list(reversed(workers))
 
-        to = self.new_directory()
-        files = [to, '{}/{}'.format(to, os.path.basename(filename))]
-        self.copy_to_guest(filename, files[-1])
+    def __enter__(self):
+        return self
 
-        for f in changes['files']:
-            files.append('{}/{}'.format(to, f['name']))
-            self.copy_to_guest(os.path.join(d, f['name']), files[-1])
+    def __exit__(self, et, ev, tb):
+        return self.stack.__exit__(et, ev, tb)
+
+    def _open_next(self):
+        """
+        Open the next unused worker and return it, or return None if
+        there are none, or if there is not enough memory for it while
+        another worker from this group is running.
+        """
+        with self.__condition:
+            if not self.__unopened:
+                return None
+
+            worker = self.__unopened.pop()
+            others = self.__opened
+            self.__opened += 1
+
+        try:
+            if self.memory_budget is not None:
+                # If none of our other workers is open, none can become
+                # idle for us to reuse, so wait for memory for as long as
+                # it takes; otherwise keep checking for an idle worker
+                if not self.memory_budget.acquire(
+                        self.memory_size, timeout=(5 if others else None)):
+                    with self.__condition:
+                        self.__unopened.append(worker)
+                        self.__opened -= 1
+
+                    return None
+
+            try:
+                worker.__enter__()
+            except BaseException:
+                # The worker counts itself as open even though opening
+                # it failed, so close it again: otherwise the next lease
+                # would get a worker that was never started. This also
+                # undoes whatever _open() had already set up.
+                worker.__exit__(*sys.exc_info())
+
+                if self.memory_budget is not None:
+                    self.memory_budget.release(self.memory_size)
+
+                raise
+        except BaseException:
+            # Put the worker back so that a later lease can try again,
+            # and wake anyone waiting for it: otherwise they would wait
+            # for a worker that is neither idle nor going to be opened
+            with self.__condition:
+                self.__unopened.append(worker)
+                self.__opened -= 1
+                self.__condition.notify_all()
+
+            raise
+
+        with self.__condition:
+            if self.memory_budget is not None:
+                self.stack.callback(
+                    self.memory_budget.release, self.memory_size)
+
+            self.stack.push(worker)
+
+        return worker
+
+    @contextmanager
+    def lease(self):
+        """
+        Wait for a worker to be idle, or for there to be memory to
+        open a new one, and use it until the end of the with block.
+        """
+        while True:
+            with self.__condition:
+                if self.__idle:
+                    worker = self.__idle.pop()
+                    break
+
+            worker = self._open_next()
+
+            if worker is not None:
+                break
 
-        if owner is not None:
-            self.check_call(['chown', owner] + files)
+            with self.__condition:
+                if not self.__idle:
+                    self.__condition.wait(5)
 
-        return files[0], os.path.basename(filename)
+        try:
+            yield worker
+        finally:
+            with self.__condition:
+                self.__idle.append(worker)
+                self.__condition.notify_all()